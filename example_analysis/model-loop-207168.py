@@ -5,11 +5,10 @@ refl1d_cli.py --fit=dream --steps=100 --burn=100 --store=results model-loop.py
 Use --batch is you dont' want to see the output and pop up the plots.
 """
 import sys
-import numpy as np
 import os
 
-from refl1d.names import QProbe, Parameter, FitProblem
-from tron.bayesian_analysis import model_utils
+from refl1d.names import Parameter
+from tron.bayesian_analysis import data_preparation, model_utils
 
 
 # Parse input arguments ########################################################
@@ -22,6 +21,12 @@ expt_file = sys.argv[2]
 # Third argument is the error information used for setting the prior
 err_file = sys.argv[3]
 
+# Optional fourth argument is the posterior covariance used for a correlated prior
+cov_file = sys.argv[4] if len(sys.argv) > 4 and sys.argv[4] != "none" else None
+
+# Optional fifth argument holds the parameters frozen by the fitting loop
+frozen_file = sys.argv[5] if len(sys.argv) > 5 else None
+
 # 0.1 was used so far (Jan 2023) with good results
 #prior_scale = 0.1
 prior_scale = 1
@@ -30,18 +35,8 @@ prior_scale = 1
 q_min = 0.0
 q_max = 0.4
 
-try:
-    Q, R, dR, dQ = np.loadtxt(reduced_file).T
-except:
-    Q, R, dR = np.loadtxt(reduced_file).T
-    dQ = 0.028*Q
-
-i_min = np.min([i for i in range(len(Q)) if Q[i]>q_min])
-i_max = np.max([i for i in range(len(Q)) if Q[i]<q_max])+1
-
-# SNS data is FWHM
-dQ_std = dQ/2.35
-probe = QProbe(Q[i_min:i_max], dQ_std[i_min:i_max], data=(R[i_min:i_max], dR[i_min:i_max]))
+Q, R, dR, dQ_std = data_preparation.prepare_data(reduced_file, q_min=q_min, q_max=q_max)
+probe = model_utils.make_probe(Q, dQ_std, R=R, dR=dR)
 
 # Experiment ###################################################################
 expt = model_utils.expt_from_json_file(expt_file, probe=probe,
@@ -84,5 +79,7 @@ expt.sample['THF'].interface.range(15.0, 150.0)
 
 #probe.intensity.range(0.95, 1.8)
 
+model_utils.freeze_parameters(expt, frozen_file)
+
 ################################################################################
-problem = FitProblem(expt)
+problem = model_utils.fit_problem(expt, cov_file, prior_scale=prior_scale)
@@ -0,0 +1,101 @@
+"""
+Shared fixtures, built from the example data of run 207168.
+"""
+
+import os
+import shutil
+
+import pytest
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(__file__), "..", "example_analysis")
+DATA_DIR = os.path.join(EXAMPLE_DIR, "data")
+INITIAL_STATE = os.path.join(EXAMPLE_DIR, "dyn-fitting", "207161", "207161_model")
+FINAL_STATE = os.path.join(EXAMPLE_DIR, "dyn-fitting", "207169", "207169_model")
+
+
+@pytest.fixture
+def data_dir():
+    return DATA_DIR
+
+
+@pytest.fixture
+def slices():
+    """
+    Time slices of the example run, in time order.
+    """
+    return sorted(f for f in os.listdir(DATA_DIR) if f.startswith("r207168_t"))
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    """
+    Directory holding a model.py file created from the initial state.
+    """
+    pytest.importorskip("refl1d")
+    from tron.bayesian_analysis import template
+
+    with open(tmp_path / "model.py", "w") as fd:
+        fd.write(template.create_model(f"{INITIAL_STATE}-1-expt.json"))
+    return str(tmp_path)
+
+
+@pytest.fixture
+def make_loop(tmp_path, model_dir):
+    """
+    Return a function creating a FittingLoop for the example run with short fits.
+    """
+    from tron.bayesian_analysis.fitting_loop import FittingLoop
+
+    def _make_loop(results_name="results", **options):
+        options = dict(dict(dream_burn=10, dream_steps=10), **options)
+        results_dir = str(tmp_path / results_name)
+        os.makedirs(results_dir, exist_ok=True)
+        return FittingLoop(
+            DATA_DIR,
+            results_dir,
+            model_dir=model_dir,
+            model_name="model",
+            initial_err_file=f"{INITIAL_STATE}-err.json",
+            initial_expt_file=f"{INITIAL_STATE}-1-expt.json",
+            final_err_file=f"{FINAL_STATE}-err.json",
+            final_expt_file=f"{FINAL_STATE}-1-expt.json",
+            **options,
+        )
+
+    return _make_loop
+
+
+@pytest.fixture(scope="session")
+def fitted_run(tmp_path_factory):
+    """
+    Short DREAM fits of the first three of four data sets of the example run.
+
+    bumps needs at least 20 steps to load the DREAM state back.
+    Returns the data directory, the results directory and the model file.
+    Tests that modify the results should work on a copy.
+    """
+    pytest.importorskip("refl1d")
+    from tron.bayesian_analysis import template
+    from tron.bayesian_analysis.fitting_loop import FittingLoop
+
+    run_dir = tmp_path_factory.mktemp("fitted_run")
+    data_dir = run_dir / "data"
+    data_dir.mkdir()
+    files = sorted(f for f in os.listdir(DATA_DIR) if f.startswith("r207168_t"))[:4]
+    for _file in files:
+        shutil.copy(os.path.join(DATA_DIR, _file), data_dir)
+    with open(run_dir / "model.py", "w") as fd:
+        fd.write(template.create_model(f"{INITIAL_STATE}-1-expt.json"))
+
+    loop = FittingLoop(
+        str(data_dir),
+        str(run_dir / "results"),
+        model_dir=str(run_dir),
+        model_name="model",
+        initial_err_file=f"{INITIAL_STATE}-err.json",
+        initial_expt_file=f"{INITIAL_STATE}-1-expt.json",
+        dream_burn=20,
+        dream_steps=20,
+    )
+    loop.fit(files[:3])
+    return str(data_dir), str(run_dir / "results"), str(run_dir / "model.py")
@@ -0,0 +1,152 @@
+"""
+Tests of the amortized posterior estimates.
+"""
+
+import os
+import json
+import types
+
+import numpy as np
+import pytest
+from scipy.stats import truncnorm
+
+from conftest import DATA_DIR, INITIAL_STATE
+from tron.bayesian_analysis import amortized, model_utils
+
+
+@pytest.fixture
+def problem():
+    """
+    Problem for the first data set, with two fit parameters.
+    """
+    from tron.bayesian_analysis import data_preparation
+
+    Q, R, dR, dQ = data_preparation.prepare_data(
+        os.path.join(DATA_DIR, "r207168_t000000.txt")
+    )
+    probe = model_utils.make_probe(Q, dQ, R=R, dR=dR)
+    expt = model_utils.expt_from_json_file(f"{INITIAL_STATE}-1-expt.json", probe=probe)
+    expt.sample["material"].material.rho.range(1.0, 6.0)
+    expt.sample["material"].thickness.range(10.0, 100.0)
+    return model_utils.fit_problem(expt)
+
+
+def test_truncated_mixture_draws():
+    rng = np.random.default_rng(0)
+    weights = np.asarray([0.5, 0.5])
+    mu = np.asarray([[0.9, 0.5], [5.0, 0.5]])
+    sigma = np.asarray([[0.2, 0.1], [0.1, 0.1]])
+    draws = amortized.truncated_mixture_draws(weights, mu, sigma, 20000, rng)
+    assert draws.shape == (20000, 2)
+    assert np.all((draws >= 0) & (draws <= 1))
+
+    # The second component has no mass in the box, so all draws come from
+    # the first one, truncated to the box rather than clipped onto the bound
+    expected = truncnorm.mean(-0.9 / 0.2, 0.1 / 0.2, loc=0.9, scale=0.2)
+    assert np.mean(draws[:, 0]) == pytest.approx(expected, abs=0.005)
+    assert np.mean(draws[:, 0] == 1) == 0
+
+
+def test_truncated_mixture_draws_no_mass():
+    rng = np.random.default_rng(0)
+    weights = np.asarray([0.25, 0.75])
+    mu = np.asarray([[50.0], [-50.0]])
+    sigma = np.asarray([[0.1], [0.1]])
+    # The component weights are used when no component has mass in the box
+    draws = amortized.truncated_mixture_draws(weights, mu, sigma, 100, rng)
+    assert np.all(np.isfinite(draws))
+    assert np.all((draws >= 0) & (draws <= 1))
+
+
+def test_log_prob_is_mixture_density():
+    pytest.importorskip("torch")
+    import torch
+
+    estimator = amortized.PosteriorEstimator(
+        ["a", "b"], [[0, 0], [1, 1]], np.linspace(0.01, 0.1, 5), n_components=2
+    )
+    log_w = np.log([0.3, 0.7])
+    mu = np.asarray([[0.2, 0.4], [0.6, 0.8]])
+    log_sigma = np.log([[0.1, 0.2], [0.3, 0.05]])
+    out = np.hstack([log_w, mu.ravel(), log_sigma.ravel()])
+    estimator.network = lambda x: torch.as_tensor(
+        np.tile(out, (len(x), 1)), dtype=torch.float32
+    )
+
+    target = np.asarray([0.3, 0.5])
+    features = torch.zeros((1, 10))
+    log_prob = estimator._log_prob(
+        features, torch.as_tensor(target[None, :], dtype=torch.float32)
+    )
+    sigma = np.exp(log_sigma)
+    density = np.sum(
+        np.exp(log_w)
+        * np.prod(np.exp(-0.5 * ((target - mu) / sigma) ** 2) / sigma, axis=1)
+    )
+    # The density is up to the normalization of the Gaussians
+    assert float(log_prob[0]) == pytest.approx(np.log(density), rel=1e-5)
+
+
+def test_train_and_sample(problem, tmp_path):
+    pytest.importorskip("torch")
+    model_file = str(tmp_path / "model.py")
+    with open(model_file, "w") as fd:
+        fd.write("# Model\n")
+    cache_dir = str(tmp_path / "cache")
+    estimator = amortized.load_or_train(
+        problem, model_file, cache_dir, n_samples=500, epochs=5, seed=0
+    )
+    assert len(os.listdir(cache_dir)) == 1
+    loaded = amortized.load_or_train(problem, model_file, cache_dir)
+
+    expt = list(problem.models)[0]
+    data = [expt.probe.Q, expt.probe.R, expt.probe.dR]
+    samples, modes = loaded.sample([data, data], n_draws=100, seed=0)
+    assert samples.shape == (2, 100, 2)
+    low, high = problem.bounds()
+    assert np.all((samples >= low) & (samples <= high))
+    assert np.all((modes >= low) & (modes <= high))
+    np.testing.assert_array_equal(
+        samples, estimator.sample([data, data], n_draws=100, seed=0)[0]
+    )
+
+    stats = loaded.posterior_stats([data], n_draws=100, seed=0)
+    assert list(stats[0]) == problem.labels()
+
+
+def test_validation_zero_width(make_loop, slices, monkeypatch):
+    loop = make_loop(engine="amortized", amortized_validate_every=2)
+    file_list = slices[:3]
+    base_names = [os.path.splitext(f)[0] for f in file_list]
+
+    def posterior_stats(data_list):
+        return [
+            model_utils.gaussian_stats(["a", "b"], [1.0, 2.0], [0.1, 0.1])
+            for _ in data_list
+        ]
+
+    def run_dream_batch(tasks):
+        # The DREAM fit of the last data set failed
+        assert [task[0] for task in tasks] == [base_names[0], base_names[2]]
+        loop.failed_fits[base_names[2]] = dict(returncode=1, log=None)
+        model_utils.save_stats(
+            os.path.join(loop.results_dir, base_names[0], loop.model_name),
+            model_utils.gaussian_stats(["a", "b"], [0.5, 2.0], [0.25, 0.0]),
+        )
+
+    monkeypatch.setattr(
+        amortized,
+        "load_or_train",
+        lambda *args: types.SimpleNamespace(posterior_stats=posterior_stats),
+    )
+    monkeypatch.setattr(loop, "load_problem", lambda *args: None)
+    monkeypatch.setattr(loop, "run_dream_batch", run_dream_batch)
+    loop.fit_amortized(
+        file_list, f"{INITIAL_STATE}-1-expt.json", f"{INITIAL_STATE}-err.json"
+    )
+
+    with open(os.path.join(loop.results_dir, "amortized-validation.json")) as fd:
+        validation = json.load(fd)
+    assert list(validation) == [base_names[0]]
+    assert validation[base_names[0]]["a"] == pytest.approx(2.0)
+    assert validation[base_names[0]]["b"] == 0
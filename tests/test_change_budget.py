@@ -0,0 +1,140 @@
+"""
+Tests of the DREAM budget set by the change between data sets.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from conftest import DATA_DIR, INITIAL_STATE
+
+
+def test_change_statistic():
+    from tron.bayesian_analysis import model_utils
+
+    q = np.linspace(0.01, 0.1, 10)
+    data = [q, np.ones(10), 0.1 * np.ones(10)]
+    shifted = [q, 1.2 * np.ones(10), 0.1 * np.ones(10)]
+    assert model_utils.change_statistic(data, data) == 0
+    assert model_utils.change_statistic(shifted, data) == pytest.approx(2.0)
+    # Only the shared Q values are compared
+    assert model_utils.change_statistic(
+        [q[::2], np.ones(5), 0.1 * np.ones(5)], shifted
+    ) == pytest.approx(2.0)
+    assert model_utils.change_statistic(shifted, data, min_q=0.055) == pytest.approx(
+        2.0
+    )
+    assert model_utils.change_statistic([q + 1, *data[1:]], data) == np.inf
+
+
+def test_change_statistic_q_grids():
+    from tron.bayesian_analysis import model_utils
+
+    q = np.linspace(0.01, 0.1, 10)
+    r = np.linspace(1.0, 2.0, 10)
+    dr = 0.1 * np.ones(10)
+
+    # Partly overlapping grids of different lengths: only Q[3:8] is compared
+    data = [q[3:], r[3:] + 0.1, dr[3:]]
+    previous = [q[:8], r[:8], dr[:8]]
+    assert model_utils.change_statistic(data, previous) == pytest.approx(0.5)
+    assert model_utils.change_statistic(previous, data) == pytest.approx(0.5)
+
+    # Grids with no common Q value cannot be compared
+    midpoints = (q[1:] + q[:-1]) / 2
+    assert (
+        model_utils.change_statistic([midpoints, r[1:], dr[1:]], [q, r, dr]) == np.inf
+    )
+    assert model_utils.change_statistic([q, r, dr], [q, r, dr], min_q=1) == np.inf
+
+
+def test_detect_changes():
+    pytest.importorskip("matplotlib")
+    from tron.bayesian_analysis import data_preparation, model_utils, summary_plots
+
+    files = sorted(f for f in os.listdir(DATA_DIR) if f.startswith("r207168_t"))[:3]
+    t, chi2 = summary_plots.detect_changes(207168, DATA_DIR, first=0, last=3)
+    _, prepared_chi2 = summary_plots.detect_changes(
+        207168, DATA_DIR, first=0, last=3, prepared=True
+    )
+    summary_plots.plt.close("all")
+    assert t == [int(f[len("r207168_t") : -len(".txt")]) for f in files[1:3]]
+
+    # All the points of the data files are compared by default
+    raw = [np.loadtxt(os.path.join(DATA_DIR, f)).T for f in files]
+    expected = []
+    for new, old in zip(raw[1:], raw[:-1]):
+        _, i, j = np.intersect1d(new[0], old[0], return_indices=True)
+        expected.append(
+            np.mean((new[1][i] - old[1][j]) ** 2 / (new[2][i] ** 2 + old[2][j] ** 2))
+        )
+    np.testing.assert_allclose(chi2, expected)
+
+    # Optionally, the points used by the fitting loop
+    prepared = [data_preparation.prepare_data(os.path.join(DATA_DIR, f)) for f in files]
+    np.testing.assert_allclose(
+        prepared_chi2,
+        [model_utils.change_statistic(prepared[i], prepared[i - 1]) for i in (1, 2)],
+    )
+    assert not np.allclose(prepared_chi2, chi2)
+
+
+def test_importance_weights():
+    from tron.bayesian_analysis import model_utils
+
+    weights = model_utils.importance_weights([0.0, np.log(3.0), -np.inf, np.nan])
+    np.testing.assert_allclose(weights, [0.25, 0.75, 0, 0])
+    assert model_utils.effective_sample_size(weights) == pytest.approx(1.6)
+    assert model_utils.effective_sample_size(np.full(4, 0.25)) == pytest.approx(4)
+    np.testing.assert_array_equal(model_utils.importance_weights([-np.inf]), [0])
+
+
+@pytest.fixture
+def previous_fit(make_loop):
+    """
+    Fitting loop with a short DREAM fit of the first data set.
+    """
+    loop = make_loop(
+        dream_burn=20, dream_steps=50, posterior_draws=200, verify_steps=10
+    )
+    inputs = (
+        os.path.join(DATA_DIR, "r207168_t000000.txt"),
+        f"{INITIAL_STATE}-1-expt.json",
+        f"{INITIAL_STATE}-err.json",
+        None,
+    )
+    assert loop.run_dream("previous", *inputs)
+    return loop, inputs
+
+
+def test_reuse_posterior_accepted(previous_fit, monkeypatch):
+    from tron.bayesian_analysis import fitting_loop
+
+    loop, inputs = previous_fit
+    monkeypatch.setattr(fitting_loop, "VERIFY_ZSCORE", np.inf)
+    # The same data set leaves the weights unchanged
+    ess = loop.reuse_posterior("slice", inputs, "previous", inputs)
+    assert ess == pytest.approx(200)
+    slice_dir = os.path.join(loop.results_dir, "slice")
+    assert os.path.isfile(os.path.join(slice_dir, f"{loop.model_name}-err.json"))
+    assert not os.path.exists(os.path.join(slice_dir, "reweighted"))
+
+
+def test_reuse_posterior_rejected(previous_fit, monkeypatch):
+    from tron.bayesian_analysis import fitting_loop
+
+    loop, inputs = previous_fit
+    monkeypatch.setattr(fitting_loop, "VERIFY_ZSCORE", -1.0)
+    assert loop.reuse_posterior("slice", inputs, "previous", inputs) is None
+    slice_dir = os.path.join(loop.results_dir, "slice")
+    # Only the verification chain is left, and it is not a failed fit
+    assert os.listdir(slice_dir) == ["verify"]
+    assert loop.failed_fits == {}
+
+
+def test_reuse_posterior_low_ess(previous_fit):
+    loop, inputs = previous_fit
+    loop.reuse_min_ess = 2.0
+    assert loop.reuse_posterior("slice", inputs, "previous", inputs) is None
+    assert not os.path.exists(os.path.join(loop.results_dir, "slice"))
@@ -0,0 +1,94 @@
+"""
+Tests of the coarse-to-fine fitting order.
+"""
+
+import os
+import shutil
+
+from conftest import FINAL_STATE, INITIAL_STATE
+
+
+def record_levels(loop, monkeypatch, failed=()):
+    """
+    Replace the DREAM fits by copies of the initial state, and record the tasks of each level.
+    """
+    levels = []
+
+    def run_dream_batch(tasks):
+        levels.append(tasks)
+        for task in tasks:
+            if task[0] in failed:
+                continue
+            model_path = os.path.join(loop.results_dir, task[0], loop.model_name)
+            os.makedirs(os.path.dirname(model_path), exist_ok=True)
+            shutil.copy(f"{INITIAL_STATE}-1-expt.json", f"{model_path}-1-expt.json")
+            shutil.copy(f"{INITIAL_STATE}-err.json", f"{model_path}-err.json")
+
+    monkeypatch.setattr(loop, "run_dream_batch", run_dream_batch)
+    return levels
+
+
+def test_coarse_to_fine_order(make_loop, slices, monkeypatch):
+    loop = make_loop(coarse_stride=4, fine_burn=5)
+    file_list = slices[:9]
+    base_names = [os.path.splitext(f)[0] for f in file_list]
+    levels = record_levels(loop, monkeypatch)
+    loop.fit_coarse_to_fine(file_list)
+
+    # Stride 4 with the last data set, then strides 2 and 1
+    assert [[base_names.index(task[0]) for task in level] for level in levels] == [
+        [0, 4, 8],
+        [2, 6],
+        [1, 3, 5, 7],
+    ]
+
+    # The coarsest level starts from the nearer steady state, with the default burn-in
+    coarse = levels[0]
+    assert [task[2] for task in coarse] == [
+        f"{INITIAL_STATE}-1-expt.json",
+        f"{FINAL_STATE}-1-expt.json",
+        f"{FINAL_STATE}-1-expt.json",
+    ]
+    assert [task[3] for task in coarse] == [
+        f"{INITIAL_STATE}-err.json",
+        f"{FINAL_STATE}-err.json",
+        f"{FINAL_STATE}-err.json",
+    ]
+    assert all(len(task) == 4 for task in coarse)
+
+    # Finer levels start from the interpolation of their fitted neighbours
+    for level in levels[1:]:
+        for name, data_file, expt_file, err_file, _, burn in level:
+            model_path = os.path.join(loop.results_dir, name, loop.model_name)
+            assert data_file == os.path.join(loop.dyn_data_dir, f"{name}.txt")
+            assert expt_file == f"{model_path}-interpolated-expt.json"
+            assert os.path.isfile(expt_file)
+            assert os.path.dirname(os.path.dirname(err_file)) == loop.results_dir
+            assert burn == 5
+
+    # Data set 1 is as close to 0 as to 2, and uses the prior of the first
+    assert levels[2][0][3] == os.path.join(
+        loop.results_dir, base_names[0], f"{loop.model_name}-err.json"
+    )
+
+
+def test_coarse_to_fine_failed_neighbours(make_loop, slices, monkeypatch):
+    loop = make_loop(coarse_stride=4)
+    file_list = slices[:9]
+    base_names = [os.path.splitext(f)[0] for f in file_list]
+    failed = {base_names[4], base_names[8]}
+    levels = record_levels(loop, monkeypatch, failed=failed)
+    loop.fit_coarse_to_fine(file_list)
+
+    # Data sets 2 and 6 start from their only fitted neighbour, without interpolation
+    model_path = os.path.join(loop.results_dir, base_names[0], loop.model_name)
+    assert [task[0] for task in levels[1]] == [base_names[2], base_names[6]]
+    for _, _, expt_file, err_file, _, burn in levels[1]:
+        assert expt_file == f"{model_path}-1-expt.json"
+        assert err_file == f"{model_path}-err.json"
+        assert burn == loop.dream_burn
+
+    # The failed fits are not tried again
+    fitted_later = [task[0] for level in levels[1:] for task in level]
+    assert not failed & set(fitted_later)
+    assert len(fitted_later) == 6
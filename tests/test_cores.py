@@ -0,0 +1,48 @@
+"""
+Tests of the core budget shared by DREAM and concurrent fits.
+"""
+
+import pytest
+
+from tron.bayesian_analysis import fitting_loop
+
+
+@pytest.mark.parametrize(
+    "cores, n_tasks, expected",
+    [
+        (None, 4, (1, None)),
+        (8, 0, (1, 8)),
+        (8, 1, (1, 8)),
+        (8, 2, (2, 4)),
+        (8, 3, (3, 2)),
+        (8, 16, (8, 1)),
+        (1, 4, (1, 1)),
+    ],
+)
+def test_split_cores(cores, n_tasks, expected):
+    n_concurrent, per_task = fitting_loop.split_cores(cores, n_tasks)
+    assert (n_concurrent, per_task) == expected
+    if cores is not None:
+        # The budget is never exceeded
+        assert n_concurrent * per_task <= cores
+
+
+def test_thread_env(monkeypatch):
+    monkeypatch.setenv("OMP_NUM_THREADS", "16")
+    env = fitting_loop.thread_env(2)
+    for variable in fitting_loop.THREAD_VARIABLES:
+        assert env[variable] == "2"
+    assert "PATH" in env
+
+
+def test_batch_core_budget(make_loop, monkeypatch):
+    loop = make_loop(cores=4)
+    calls = []
+
+    def run_dream(base_name, *args, cores=None):
+        calls.append((base_name, cores))
+        return True
+
+    monkeypatch.setattr(loop, "run_dream", run_dream)
+    loop.run_dream_batch([(f"slice{i}", None, None, None) for i in range(2)])
+    assert sorted(calls) == [("slice0", 2), ("slice1", 2)]
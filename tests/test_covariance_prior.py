@@ -0,0 +1,158 @@
+"""
+Tests of the correlated prior built from the covariance of the previous fit.
+"""
+
+import os
+import json
+import pickle
+import warnings
+
+import numpy as np
+import pytest
+
+from conftest import DATA_DIR, INITIAL_STATE
+
+
+@pytest.fixture
+def inputs(make_loop, tmp_path):
+    loop = make_loop()
+    problem = loop.load_problem(
+        os.path.join(DATA_DIR, "r207168_t000000.txt"),
+        f"{INITIAL_STATE}-1-expt.json",
+        f"{INITIAL_STATE}-err.json",
+    )
+    names = problem.labels()[:1]
+    cov_file = str(tmp_path / "model-cov.json")
+    with open(cov_file, "w") as fd:
+        json.dump(dict(names=names, mean=[float(problem.getp()[0])], cov=[[1.0]]), fd)
+    return loop, (
+        os.path.join(DATA_DIR, "r207168_t000000.txt"),
+        f"{INITIAL_STATE}-1-expt.json",
+        f"{INITIAL_STATE}-err.json",
+        cov_file,
+    )
+
+
+def test_template_model_uses_covariance(inputs):
+    loop, fit_inputs = inputs
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        assert loop.check_covariance_prior(fit_inputs)
+
+
+def test_model_ignoring_covariance_warns(inputs):
+    loop, fit_inputs = inputs
+    with open(loop.model_file) as fd:
+        script = fd.read()
+    # Build the problem the old way, without the correlated prior
+    with open(loop.model_file, "w") as fd:
+        fd.write(
+            script
+            + "\nfrom refl1d.names import FitProblem\nproblem = FitProblem(expt)\n"
+        )
+    with pytest.warns(UserWarning, match="correlated prior"):
+        loop.check_covariance_prior(fit_inputs)
+
+
+@pytest.fixture
+def expt():
+    """
+    Experiment for the first data set, with two fit parameters.
+    """
+    from tron.bayesian_analysis import data_preparation, model_utils
+
+    Q, R, dR, dQ = data_preparation.prepare_data(
+        os.path.join(DATA_DIR, "r207168_t000000.txt")
+    )
+    probe = model_utils.make_probe(Q, dQ, R=R, dR=dR)
+    expt = model_utils.expt_from_json_file(f"{INITIAL_STATE}-1-expt.json", probe=probe)
+    expt.sample["THF"].interface.range(15.0, 150.0)
+    expt.sample["material"].material.rho.dev(0.5, mean=3.0)
+    return expt
+
+
+def test_prior_covariance_floors():
+    from tron.bayesian_analysis import model_utils
+
+    cov = dict(names=["a rho", "a thickness", "other"], cov=np.eye(3).tolist())
+    expected = 4 * np.eye(3) + np.diag(
+        [model_utils.ERR_MIN_RHO**2, model_utils.ERR_MIN_THICK**2, 0]
+    )
+    np.testing.assert_allclose(model_utils.prior_covariance(cov, 2), expected)
+
+
+def test_correlated_prior(expt):
+    from tron.bayesian_analysis import model_utils
+
+    uncorrelated = model_utils.fit_problem(expt)
+    nllf, _ = uncorrelated.parameter_nllf()
+    residuals = uncorrelated.parameter_residuals()
+    assert nllf > 0
+
+    # Parameter 'missing' is not fit and 'material rho' keeps its own prior
+    names = ["THF interface", "missing"]
+    mean = np.asarray([20.0, 0.0])
+    cov = np.asarray([[4.0, 1.0], [1.0, 1.0]])
+    problem = model_utils.CorrelatedPriorProblem(expt, names, mean, cov)
+    assert problem.prior_names == ["THF interface"]
+
+    delta = expt.sample["THF"].interface.value - mean[0]
+    prior_nllf, _ = problem.parameter_nllf()
+    assert prior_nllf == pytest.approx(nllf + 0.5 * delta**2 / cov[0, 0])
+    prior_residuals = problem.parameter_residuals()
+    assert prior_residuals[: len(residuals)] == pytest.approx(residuals)
+    assert prior_residuals[len(residuals) :] == pytest.approx([delta / 2.0])
+
+
+def test_correlated_prior_lm(expt):
+    from bumps.fitters import fit as bumps_fit
+
+    from tron.bayesian_analysis import model_utils
+
+    # The Levenberg-Marquardt fit is pulled to the mean of a narrow prior
+    fitted = []
+    for problem in (
+        model_utils.fit_problem(expt),
+        model_utils.CorrelatedPriorProblem(expt, ["THF interface"], [40.0], [[1e-4]]),
+    ):
+        result = bumps_fit(problem, method="lm", steps=20)
+        fitted.append(result.x[problem.labels().index("THF interface")])
+    assert abs(fitted[0] - 40.0) > 1.0
+    assert fitted[1] == pytest.approx(40.0, abs=0.1)
+
+
+def test_lm_engine_warns(make_loop, slices, monkeypatch):
+    from tron.bayesian_analysis.fitting_loop import FittingLoop
+
+    monkeypatch.setattr(FittingLoop, "lm_slice", lambda self, *args: 1.0)
+    loop = make_loop(engine="lm", covariance_prior=True)
+    with pytest.warns(UserWarning, match="without the correlated prior"):
+        loop.fit(slices[:1])
+
+
+def test_correlated_prior_whitening(expt):
+    from tron.bayesian_analysis import model_utils
+
+    names = ["THF interface", "material rho"]
+    mean = np.asarray([20.0, 3.0])
+    cov = np.asarray([[4.0, 0.3], [0.3, 0.25]])
+    problem = model_utils.CorrelatedPriorProblem(expt, names, mean, cov)
+    nllf, _ = model_utils.fit_problem(expt).parameter_nllf()
+
+    delta = problem.getp() - mean
+    prior_nllf, _ = problem.parameter_nllf()
+    assert prior_nllf == pytest.approx(nllf + 0.5 * delta @ np.linalg.solve(cov, delta))
+    whitened = problem.prior_residuals()
+    assert np.sum(whitened**2) == pytest.approx(delta @ np.linalg.solve(cov, delta))
+
+
+def test_correlated_prior_pickles(expt):
+    from tron.bayesian_analysis import model_utils
+
+    problem = model_utils.CorrelatedPriorProblem(
+        expt, ["THF interface"], [20.0], [[4.0]]
+    )
+    # DREAM's parallel mapper sends the problem to its workers by pickling it
+    copy = pickle.loads(pickle.dumps(problem))
+    assert type(copy) is model_utils.CorrelatedPriorProblem
+    assert copy.parameter_nllf()[0] == pytest.approx(problem.parameter_nllf()[0])
@@ -0,0 +1,78 @@
+"""
+Tests of the preparation of the reduced data before fitting.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from tron.bayesian_analysis import data_preparation
+
+
+def test_rebin_weights_and_spread():
+    q = np.array([1.0, 1.01, 2.0])
+    r = np.array([1.0, 2.0, 3.0])
+    dr = np.array([1.0, 2.0, 0.5])
+    dq = np.array([0.01, 0.02, 0.03])
+    binned = data_preparation.rebin(np.vstack([q, r, dr, dq]), 0.05)
+
+    # The first two points share a bin, with weights 1 and 1/4
+    assert binned.shape == (4, 2)
+    weights = np.array([1.0, 0.25])
+    q_bin = np.sum(weights * q[:2]) / 1.25
+    assert binned[0, 0] == pytest.approx(q_bin)
+    assert binned[1, 0] == pytest.approx(np.sum(weights * r[:2]) / 1.25)
+    assert binned[2, 0] == pytest.approx(1 / np.sqrt(1.25))
+
+    # The resolution includes the spread of Q within the bin
+    spread = np.sum(weights * (dq[:2] ** 2 + (q[:2] - q_bin) ** 2)) / 1.25
+    assert binned[3, 0] == pytest.approx(np.sqrt(spread))
+    assert binned[3, 0] > np.sum(weights * dq[:2]) / 1.25
+
+    # A point alone in its bin is unchanged
+    np.testing.assert_allclose(binned[:, 1], [2.0, 3.0, 0.5, 0.03])
+
+
+def test_rebin_keeps_single_point():
+    data = np.array([[0.01], [1.0], [0.1], [0.001]])
+    np.testing.assert_array_equal(data_preparation.rebin(data, 0.05), data)
+
+
+def write_data(data_file, r):
+    q = np.linspace(0.01, 0.1, 5)
+    np.savetxt(data_file, np.vstack([q, r, 0.1 * r, 0.02 * q]).T, fmt="%.6e")
+
+
+def test_prepare_data_cache(tmp_path):
+    data_file = str(tmp_path / "r1_t000000.txt")
+    write_data(data_file, np.ones(5))
+    data_preparation._prepare.cache_clear()
+
+    first = data_preparation.prepare_data(data_file)
+    np.testing.assert_allclose(first[1], 1)
+    np.testing.assert_allclose(first[3], 0.02 * first[0] / 2.35)
+
+    # The cached data cannot be modified through the returned array
+    first[1] = 0
+    second = data_preparation.prepare_data(data_file)
+    np.testing.assert_allclose(second[1], 1)
+    assert data_preparation._prepare.cache_info().hits == 1
+
+    # A new file of the same size, with a new modification time, is read again
+    stat = os.stat(data_file)
+    write_data(data_file, 2 * np.ones(5))
+    assert os.stat(data_file).st_size == stat.st_size
+    os.utime(data_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    third = data_preparation.prepare_data(data_file)
+    np.testing.assert_allclose(third[1], 2)
+    assert data_preparation._prepare.cache_info().misses == 2
+
+
+def test_prepare_data_rebin(tmp_path):
+    data_file = str(tmp_path / "r1_t000000.txt")
+    write_data(data_file, np.ones(5))
+    data = data_preparation.prepare_data(data_file)
+    binned = data_preparation.prepare_data(data_file, dq_over_q=1.0)
+    np.testing.assert_allclose(binned, data_preparation.rebin(data, 1.0))
+    assert binned.shape[1] < data.shape[1]
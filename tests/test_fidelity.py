@@ -0,0 +1,72 @@
+"""
+Tests of the multi-fidelity fits, with a decimated burn-in.
+"""
+
+import os
+import json
+import subprocess
+
+from conftest import DATA_DIR, INITIAL_STATE
+
+
+def write_stats(file_path, stats):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "w") as fd:
+        json.dump(stats, fd)
+
+
+def test_check_fidelity_zero_width(make_loop, monkeypatch):
+    loop = make_loop()
+    model_path = os.path.join(loop.results_dir, "slice", loop.model_name)
+    write_stats(f"{model_path}-err.json", {"a": dict(mean=1.0), "b": dict(mean=2.0)})
+
+    def dream_process(base_name, *args, **kwargs):
+        # Parameter b is frozen in the full-data fit
+        write_stats(
+            os.path.join(loop.results_dir, base_name, f"{loop.model_name}-err.json"),
+            {"a": dict(mean=0.5, std=0.25), "b": dict(mean=2.0, std=0.0)},
+        )
+        return subprocess.CompletedProcess([], 0)
+
+    monkeypatch.setattr(loop, "dream_process", dream_process)
+    zscore = loop.check_fidelity("slice", None, None, None, None, 10, 10, None)
+    assert zscore == {"a": 2.0, "b": 0.0}
+
+
+def test_check_fidelity_no_shared_parameters(make_loop, monkeypatch):
+    loop = make_loop()
+    model_path = os.path.join(loop.results_dir, "slice", loop.model_name)
+    write_stats(f"{model_path}-err.json", {"a": dict(mean=1.0)})
+
+    def dream_process(base_name, *args, **kwargs):
+        write_stats(
+            os.path.join(loop.results_dir, base_name, f"{loop.model_name}-err.json"),
+            {"c": dict(mean=0.5, std=0.25)},
+        )
+        return subprocess.CompletedProcess([], 0)
+
+    monkeypatch.setattr(loop, "dream_process", dream_process)
+    assert loop.check_fidelity("slice", None, None, None, None, 10, 10, None) == {}
+
+
+def test_decimated_burn_in_agrees_with_exact(make_loop, slices):
+    loop = make_loop(
+        dream_burn=100,
+        dream_steps=100,
+        fidelity_decimate=2,
+        fidelity_burn=20,
+        fidelity_check_every=1,
+    )
+    assert loop.run_dream(
+        "slice",
+        os.path.join(DATA_DIR, slices[0]),
+        f"{INITIAL_STATE}-1-expt.json",
+        f"{INITIAL_STATE}-err.json",
+    )
+
+    # The full-data fit is compared to the fit with a decimated burn-in
+    model_path = os.path.join(loop.results_dir, "slice", loop.model_name)
+    with open(f"{model_path}-fidelity-check.json", "r") as fd:
+        zscore = json.load(fd)
+    assert len(zscore) > 0
+    assert max(abs(z) for z in zscore.values()) < 3
@@ -0,0 +1,107 @@
+"""
+Tests of the content-addressed cache of fit results.
+"""
+
+import os
+
+from tron.bayesian_analysis import fit_cache
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fd:
+        fd.write(text)
+
+
+def read(path):
+    with open(path) as fd:
+        return fd.read()
+
+
+def make_result(result_dir, text="result", size=0):
+    write(os.path.join(result_dir, "model-err.json"), text)
+    write(os.path.join(result_dir, "model-chain.mc"), "x" * size)
+    return result_dir
+
+
+def test_fit_key(tmp_path):
+    write(str(tmp_path / "a.txt"), "data")
+    write(str(tmp_path / "b.txt"), "data")
+    write(str(tmp_path / "c.txt"), "other data")
+    a, b, c = (str(tmp_path / name) for name in ("a.txt", "b.txt", "c.txt"))
+
+    # Only the contents of the files matter
+    key = fit_cache.fit_key([a, None], dict(burn=10))
+    assert key == fit_cache.fit_key([b, None], dict(burn=10))
+    assert key != fit_cache.fit_key([c, None], dict(burn=10))
+    assert key != fit_cache.fit_key([a, a], dict(burn=10))
+    assert key != fit_cache.fit_key([a, None], dict(burn=20))
+
+
+def test_store_and_restore(tmp_path):
+    cache = fit_cache.FitCache(str(tmp_path / "cache"))
+    result_dir = make_result(str(tmp_path / "results" / "slice"))
+    key = "ab" + "0" * 62
+    assert not cache.restore(key, str(tmp_path / "restored"))
+
+    cache.store(key, result_dir)
+    assert os.path.isdir(cache.path(key))
+    assert os.path.dirname(cache.path(key)) == str(tmp_path / "cache" / "ab")
+
+    # Restoring replaces the previous results
+    restored = str(tmp_path / "restored")
+    write(os.path.join(restored, "stale.txt"), "stale")
+    assert cache.restore(key, restored)
+    assert sorted(os.listdir(restored)) == ["model-chain.mc", "model-err.json"]
+    assert read(os.path.join(restored, "model-err.json")) == "result"
+
+    # Results written later in the results directory do not change the cache
+    write(os.path.join(restored, "model-err.json"), "refit")
+    write(os.path.join(restored, "model-cov.json"), "covariance")
+    with open(os.path.join(restored, "model-chain.mc"), "a") as fd:
+        fd.write("more")
+    entry = cache.path(key)
+    assert read(os.path.join(entry, "model-err.json")) == "result"
+    assert read(os.path.join(entry, "model-chain.mc")) == ""
+    assert not os.path.exists(os.path.join(entry, "model-cov.json"))
+
+    # An existing entry is kept as it is
+    cache.store(key, make_result(str(tmp_path / "other"), text="other"))
+    assert read(os.path.join(entry, "model-err.json")) == "result"
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = fit_cache.FitCache(str(tmp_path / "cache"), max_bytes=10**9)
+    keys = [f"{i:02d}" + "0" * 62 for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.store(key, make_result(str(tmp_path / key), size=1000))
+        os.utime(cache.path(key), (i, i))
+    assert [entry for entry, _, _ in cache.entries()] == [
+        cache.path(key) for key in keys
+    ]
+
+    # Incomplete entries are ignored
+    os.makedirs(f"{cache.path(keys[0])}.123.tmp")
+    assert len(cache.entries()) == 3
+    assert all(size > 1000 for _, _, size in cache.entries())
+
+    # Using the oldest entry makes it the most recent
+    assert cache.restore(keys[0], str(tmp_path / "restored"))
+    cache.max_bytes = 2500
+    assert cache.evict() == 1
+    assert not os.path.exists(cache.path(keys[1]))
+    assert os.path.isdir(cache.path(keys[0]))
+    assert os.path.isdir(cache.path(keys[2]))
+
+    # Storing past the limit evicts the least recently used entries
+    cache.store("ff" + "0" * 62, make_result(str(tmp_path / "new"), size=1000))
+    assert [os.path.basename(entry) for entry, _, _ in cache.entries()] == [
+        keys[0],
+        "ff" + "0" * 62,
+    ]
+
+
+def test_empty_cache(tmp_path):
+    cache = fit_cache.FitCache(str(tmp_path / "cache"), max_bytes=0)
+    assert cache.entries() == []
+    assert cache.evict() == 0
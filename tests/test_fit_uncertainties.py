@@ -0,0 +1,184 @@
+"""
+Tests of the vectorised SLD uncertainty band of slab models.
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("refl1d")
+
+from refl1d import uncertainty as errors
+from refl1d.names import Experiment, FitProblem, FreeInterface, Magnetism
+
+from tron.bayesian_analysis import fit_uncertainties, model_utils
+
+from conftest import INITIAL_STATE
+
+# Largest difference with refl1d, in SLD units. The profiles are computed
+# analytically here and interpolated from a 0.1 A grid in refl1d.
+TOLERANCE = 0.01
+
+
+def make_experiment():
+    return model_utils.expt_from_json_file(
+        f"{INITIAL_STATE}-1-expt.json", keep_original_ranges=True
+    )
+
+
+def make_problem(tie_interface=False):
+    expt = make_experiment()
+    if tie_interface:
+        expt.sample["Cu"].interface = expt.sample["Ti"].interface * 0.5
+    return FitProblem(expt)
+
+
+def make_points(problem, n_points=300):
+    rng = np.random.default_rng(0)
+    low, high = problem.bounds()
+    points = problem.getp() + 0.02 * (high - low) * rng.standard_normal(
+        (n_points, len(low))
+    )
+    return np.clip(points, low, high)
+
+
+def refl1d_contour(problem, points, cl=90, align=-1):
+    # Same steps as the refl1d branch of get_sld_contour
+    original = problem.getp()
+    profiles, slabs, _, _ = errors.calc_errors(problem, points)
+    problem.setp(original)
+    group = list(errors.align_profiles(profiles, slabs, align).values())[0]
+    z = np.hstack([line[0] for line in group])
+    zp = np.linspace(np.min(z), np.max(z), 200)
+    data, _ = errors._build_profile_matrix(group, 1, zp, [cl])
+    return data
+
+
+def assert_same_band(contour, expected, tolerance=TOLERANCE):
+    # The z ranges differ slightly, compare on the refl1d grid
+    for row in (1, 2, 3):
+        values = np.interp(expected[0], contour[0], contour[row])
+        assert np.max(np.abs(values - expected[row])) < tolerance
+
+
+@pytest.mark.parametrize("tie_interface", [False, True])
+def test_slab_contour_matches_refl1d(tie_interface):
+    problem = make_problem(tie_interface)
+    points = make_points(problem)
+    best = problem.getp()
+
+    contour = fit_uncertainties.slab_contour(problem, points, cl=90, align=-1)
+    np.testing.assert_array_equal(problem.getp(), best)
+    assert contour.shape == (4, 200)
+    assert np.all(contour[2] <= contour[3])
+    assert_same_band(contour, refl1d_contour(problem, points))
+
+
+def test_deferred_parameters():
+    problem = make_problem(tie_interface=True)
+    points = make_points(problem, n_points=5)
+    labels = problem.labels()
+    assert "Cu interface" not in labels
+
+    # The expression is evaluated for each point
+    values = fit_uncertainties.slab_values(problem, points)
+    ti = points[:, labels.index("Ti interface")]
+    np.testing.assert_allclose(values[:, 2, 3], 0.5 * ti)
+    np.testing.assert_allclose(values[:, 3, 3], ti)
+    np.testing.assert_array_equal(
+        values[:, 1, 2], points[:, labels.index("material thickness")]
+    )
+
+
+def test_other_layers_fall_back_to_refl1d():
+    expt = make_experiment()
+    thf, material, cu, ti, si = list(expt.sample)
+    free = FreeInterface(
+        below=material.material, above=cu.material, thickness=20, dz=[1, 1], dp=[1, 1]
+    )
+    problem = FitProblem(
+        Experiment(sample=thf | material | free | cu | ti | si, probe=expt.probe)
+    )
+    points = make_points(problem, n_points=20)
+
+    with pytest.raises(ValueError):
+        fit_uncertainties.slab_values(problem, points)
+    with pytest.raises(ValueError):
+        fit_uncertainties.slab_contour(problem, points)
+
+    contours = fit_uncertainties.get_sld_contour(problem, None, points=points, align=-1)
+    assert len(contours) == 1
+    np.testing.assert_allclose(contours[0], refl1d_contour(problem, points))
+
+
+def test_magnetic_models_are_not_slabs():
+    # Only the layers are checked, the reflectivity is never computed
+    expt = make_experiment()
+    expt.sample["Cu"].magnetism = Magnetism(rhoM=1.0)
+    problem = FitProblem(expt)
+    with pytest.raises(ValueError):
+        fit_uncertainties.slab_values(problem, make_points(problem, n_points=2))
+
+
+def test_multiple_models_are_not_slabs():
+    problem = FitProblem([make_experiment(), make_experiment()])
+    with pytest.raises(ValueError):
+        fit_uncertainties.slab_values(problem, make_points(problem, n_points=2))
+
+
+def adaptive(problem, points, **options):
+    options = dict(dict(align=-1, points=points, seed=0), **options)
+    return fit_uncertainties.adaptive_sld_contour(problem, None, **options)
+
+
+def test_adaptive_stops_when_band_converges():
+    problem = make_problem()
+    points = make_points(problem, n_points=2000)
+    full = fit_uncertainties.slab_contour(problem, points, cl=90, align=-1)
+
+    contours, n_draws = adaptive(problem, points, batch_size=100, tolerance=0.02)
+    assert n_draws < len(points)
+    assert n_draws % 100 == 0
+    assert_same_band(contours[0], full, tolerance=0.05)
+
+    # A tighter tolerance needs more draws
+    _, more_draws = adaptive(problem, points, batch_size=100, tolerance=0.005)
+    assert more_draws > n_draws
+
+
+def test_adaptive_uses_all_draws():
+    problem = make_problem()
+    points = make_points(problem)
+
+    # A negative tolerance is never reached
+    contours, n_draws = adaptive(problem, points, batch_size=100, tolerance=-1)
+    assert n_draws == len(points)
+    np.testing.assert_allclose(
+        contours[0], fit_uncertainties.slab_contour(problem, points, cl=90, align=-1)
+    )
+
+    contours, n_draws = adaptive(
+        problem, points, batch_size=100, tolerance=-1, max_draws=150
+    )
+    assert n_draws == 150
+
+
+def test_adaptive_refl1d_fallback():
+    expt = make_experiment()
+    thf, material, cu, ti, si = list(expt.sample)
+    free = FreeInterface(
+        below=material.material, above=cu.material, thickness=20, dz=[1, 1], dp=[1, 1]
+    )
+    problem = FitProblem(
+        Experiment(sample=thf | material | free | cu | ti | si, probe=expt.probe)
+    )
+    points = make_points(problem, n_points=40)
+    best = problem.getp()
+
+    contours, n_draws = adaptive(problem, points, batch_size=20, tolerance=-1)
+    assert n_draws == len(points)
+    np.testing.assert_array_equal(problem.getp(), best)
+
+    # Same profiles as a single call to refl1d, in a different order
+    expected = fit_uncertainties.get_sld_contour(problem, None, points=points, align=-1)
+    assert len(contours) == 1
+    np.testing.assert_allclose(contours[0], expected[0])
@@ -0,0 +1,32 @@
+"""
+Tests of the parameters frozen by the fitting loop.
+"""
+
+import os
+
+import pytest
+
+from conftest import DATA_DIR, INITIAL_STATE
+
+INPUTS = (
+    os.path.join(DATA_DIR, "r207168_t000000.txt"),
+    f"{INITIAL_STATE}-1-expt.json",
+    f"{INITIAL_STATE}-err.json",
+)
+
+
+def test_template_model_freezes(make_loop):
+    loop = make_loop(freeze=True)
+    assert loop.check_freezing(*INPUTS)
+    assert loop.frozen == {}
+
+
+def test_model_ignoring_frozen_file_warns(make_loop):
+    loop = make_loop(freeze=True)
+    with open(loop.model_file) as fd:
+        script = fd.read()
+    with open(loop.model_file, "w") as fd:
+        fd.write(script.replace("model_utils.freeze_parameters(expt, frozen_file)", ""))
+    with pytest.warns(UserWarning, match="without freezing"):
+        assert not loop.check_freezing(*INPUTS)
+    assert loop.frozen == {}
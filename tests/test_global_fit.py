@@ -0,0 +1,101 @@
+"""
+Tests of the joint fit of all data sets, with parameters as splines in time.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from conftest import DATA_DIR, INITIAL_STATE
+from tron.bayesian_analysis import data_preparation, global_fit, model_utils
+
+MODEL = """import sys
+import numpy as np
+from tron.bayesian_analysis import model_utils
+
+Q, R, dR, dQ = np.loadtxt(sys.argv[1]).T
+probe = model_utils.make_probe(Q, dQ, R=R, dR=dR)
+expt = model_utils.expt_from_json_file(sys.argv[2], probe=probe)
+expt.sample["material"].material.rho.range(1.0, 6.0)
+expt.sample["material"].thickness.range(10.0, 100.0)
+problem = model_utils.fit_problem(expt)
+"""
+
+
+@pytest.mark.parametrize("n_knots, degree", [(1, 0), (2, 1), (3, 2), (6, 3)])
+def test_spline_basis(n_knots, degree):
+    times = np.linspace(10, 50, 9)
+    basis = global_fit.spline_basis(times, n_knots)
+    assert basis.shape == (9, n_knots)
+    # The basis is a partition of unity, clamped to the first and last coefficients
+    np.testing.assert_allclose(np.sum(basis, axis=1), 1)
+    np.testing.assert_allclose(basis[0], np.eye(n_knots)[0])
+    np.testing.assert_allclose(basis[-1], np.eye(n_knots)[-1])
+    # A polynomial of the spline degree is represented exactly
+    values = (times - 10) ** degree
+    coeffs, *_ = np.linalg.lstsq(basis, values, rcond=None)
+    np.testing.assert_allclose(basis @ coeffs, values, atol=1e-8 * np.max(values))
+
+
+@pytest.fixture
+def drifting_run(tmp_path):
+    """
+    Data sets with a static SLD and a thickness drifting in time.
+    """
+    model_file = str(tmp_path / "model.py")
+    with open(model_file, "w") as fd:
+        fd.write(MODEL)
+
+    Q, _, _, dQ = data_preparation.prepare_data(
+        os.path.join(DATA_DIR, "r207168_t000000.txt")
+    )
+    expt = model_utils.expt_from_json_file(
+        f"{INITIAL_STATE}-1-expt.json", probe=model_utils.make_probe(Q, dQ)
+    )
+    rng = np.random.default_rng(0)
+    times = np.linspace(0, 100, 5)
+    thickness = 40.0 + 0.2 * times
+    expt.sample["material"].material.rho.value = 4.0
+    data_files = []
+    for t, value in zip(times, thickness):
+        expt.sample["material"].thickness.value = value
+        expt.update()
+        _, r = expt.reflectivity()
+        data_files.append(str(tmp_path / f"r1_t{int(t):06d}.txt"))
+        np.savetxt(
+            data_files[-1],
+            np.vstack(
+                [Q, r * (1 + 0.05 * rng.standard_normal(len(r))), 0.05 * r, dQ]
+            ).T,
+        )
+    return model_file, data_files, times, thickness
+
+
+def test_global_fit_recovers_drift(drifting_run):
+    model_file, data_files, times, thickness = drifting_run
+    joint = global_fit.GlobalFit(
+        model_file,
+        data_files,
+        times,
+        f"{INITIAL_STATE}-1-expt.json",
+        f"{INITIAL_STATE}-err.json",
+        static_parameters=["material rho"],
+        n_knots=3,
+        processes=2,
+    )
+    assert joint.names == ["material rho", "material thickness"]
+    values, errors, chisq = joint.fit()
+
+    assert values.shape == errors.shape == (5, 2)
+    np.testing.assert_allclose(values[:, 0], 4.0, atol=0.05)
+    np.testing.assert_allclose(values[:, 1], thickness, atol=2.0)
+    np.testing.assert_allclose(chisq, 1, atol=0.3)
+
+    # The static parameter has the same uncertainty for all data sets, and
+    # the uncertainties are consistent with the deviations from the truth
+    np.testing.assert_allclose(errors[:, 0], errors[0, 0])
+    assert np.all(errors > 0)
+    assert np.all(
+        np.abs(values - np.vstack([np.full(5, 4.0), thickness]).T) < 4 * errors
+    )
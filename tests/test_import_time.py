@@ -0,0 +1,42 @@
+"""
+Import-time regression test for the modules loaded by the user interface.
+
+The fitting and plotting libraries are imported when they are used, so that
+the interface starts quickly.
+"""
+
+import sys
+import json
+import subprocess
+
+# Modules imported by ui.bayesian_ui
+UI_MODULES = ["template", "fitting_loop", "summary_plots"]
+
+# Libraries that must not be loaded by these imports
+HEAVY_MODULES = ["refl1d", "bumps", "matplotlib.pyplot"]
+
+# Generous bound on the import time, in seconds
+MAX_IMPORT_TIME = 5.0
+
+_SCRIPT = f"""
+import sys
+import json
+import time
+
+t0 = time.perf_counter()
+from tron.bayesian_analysis import {", ".join(UI_MODULES)}
+elapsed = time.perf_counter() - t0
+print(json.dumps(dict(elapsed=elapsed, modules=sorted(sys.modules))))
+"""
+
+
+def test_ui_imports():
+    # A fresh interpreter, so that modules imported by other tests do not count
+    output = subprocess.run(
+        [sys.executable, "-c", _SCRIPT], capture_output=True, text=True, check=True
+    )
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+
+    loaded = [name for name in HEAVY_MODULES if name in result["modules"]]
+    assert loaded == []
+    assert result["elapsed"] < MAX_IMPORT_TIME
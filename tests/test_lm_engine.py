@@ -0,0 +1,78 @@
+"""
+Tests of the two-stage engine: Levenberg-Marquardt fits, then DREAM on selected data sets.
+"""
+
+import os
+import json
+
+import pytest
+
+from conftest import INITIAL_STATE
+
+
+@pytest.mark.parametrize(
+    "options, selected",
+    [
+        (dict(), []),
+        (dict(dream_every=3), [0, 3, 6]),
+        (dict(dream_chisq_jump=2.0), [2, 5]),
+        (dict(dream_last=2), [6, 7]),
+        (dict(dream_every=4, dream_chisq_jump=2.0, dream_last=1), [0, 2, 4, 5, 7]),
+    ],
+)
+def test_select_dream_slices(make_loop, options, selected):
+    loop = make_loop(engine="lm", **options)
+    chisq = [1.0, 1.2, 3.0, 2.0, 1.5, 3.5, 3.0, 2.0]
+    assert loop.select_dream_slices(chisq) == selected
+
+
+def test_two_stage_fit(make_loop, slices, monkeypatch):
+    loop = make_loop(engine="lm", lm_steps=20, dream_every=2)
+    dream_inputs = dict()
+    run_dream = loop.run_dream
+
+    def record_dream(
+        base_name, data_file, starting_expt, starting_err, *args, **kwargs
+    ):
+        dream_inputs[base_name] = (starting_expt, starting_err)
+        return run_dream(
+            base_name, data_file, starting_expt, starting_err, *args, **kwargs
+        )
+
+    monkeypatch.setattr(loop, "run_dream", record_dream)
+    loaded = []
+    load_problem = loop.load_problem
+
+    def record_load(data_file, starting_expt, *args):
+        loaded.append(starting_expt)
+        return load_problem(data_file, starting_expt, *args)
+
+    monkeypatch.setattr(loop, "load_problem", record_load)
+
+    file_list = slices[:3]
+    loop.fit(file_list)
+    base_names = [os.path.splitext(f)[0] for f in file_list]
+
+    # Each LM fit starts from the result of the previous one
+    assert loaded[0] == f"{INITIAL_STATE}-1-expt.json"
+    for name, starting_expt in zip(base_names, loaded[1:]):
+        assert starting_expt == os.path.join(
+            loop.results_dir, name, "model-1-expt.json"
+        )
+
+    # DREAM starts from the LM fit of the previous data set
+    assert loop.dream_slices == [base_names[0], base_names[2]]
+    assert dream_inputs[base_names[0]] == (
+        f"{INITIAL_STATE}-1-expt.json",
+        f"{INITIAL_STATE}-err.json",
+    )
+    assert dream_inputs[base_names[2]] == loop.lm_results(base_names[1])
+
+    for name in base_names:
+        model_path = os.path.join(loop.results_dir, name, "model")
+        with open(f"{model_path}-err.json") as fd:
+            stats = json.load(fd)
+        with open(loop.lm_results(name)[1]) as fd:
+            lm_stats = json.load(fd)
+        # Only the selected data sets have DREAM results
+        assert (stats == lm_stats) == (name not in loop.dream_slices)
@@ -0,0 +1,75 @@
+"""
+Tests of the compact posterior saved after each DREAM fit.
+"""
+
+import os
+import json
+import shutil
+
+import numpy as np
+
+from tron.bayesian_analysis import model_utils
+
+
+def test_posterior_round_trip(tmp_path):
+    model_path = str(tmp_path / "model")
+    points = np.random.default_rng(0).normal(size=(500, 2))
+    posterior_file = model_utils.save_posterior_points(
+        model_path, ["a", "b"], points, n_draws=100, portion=0.5
+    )
+    assert posterior_file == f"{model_path}-posterior.npy"
+    assert model_utils.has_posterior(model_path)
+    with open(f"{model_path}-posterior.json") as fd:
+        assert json.load(fd) == dict(names=["a", "b"], portion=0.5)
+
+    # Evenly spaced samples, stored in float32 and memory-mapped
+    names, loaded = model_utils.load_posterior(model_path)
+    assert names == ["a", "b"]
+    assert isinstance(loaded, np.memmap)
+    assert loaded.dtype == np.float32
+    index = np.linspace(0, 499, 100).astype(int)
+    np.testing.assert_allclose(loaded, points[index], rtol=1e-6)
+
+    _, thinned = model_utils.load_posterior(model_path, n_draws=10)
+    np.testing.assert_array_equal(thinned, loaded[np.linspace(0, 99, 10).astype(int)])
+    names, read = model_utils.posterior_points(model_path, n_draws=10)
+    np.testing.assert_array_equal(read, thinned)
+
+
+def test_save_posterior_from_dream(fitted_run, make_loop):
+    _, results_dir, _ = fitted_run
+    loop = make_loop(posterior_draws=50)
+    shutil.copytree(
+        os.path.join(results_dir, "r207168_t000000"),
+        os.path.join(loop.results_dir, "slice"),
+    )
+    model_path = os.path.join(loop.results_dir, "slice", loop.model_name)
+    names, points = model_utils.posterior_points(model_path, n_draws=50)
+
+    loop.save_posterior("slice")
+    # The chains are kept by default
+    for suffix in model_utils.CHAIN_SUFFIXES:
+        assert os.path.isfile(f"{model_path}{suffix}")
+    compact_names, compact = model_utils.load_posterior(model_path)
+    assert compact_names == names
+    np.testing.assert_allclose(compact, points, rtol=1e-6)
+
+
+def test_save_posterior_drops_chains(fitted_run, make_loop):
+    _, results_dir, _ = fitted_run
+    loop = make_loop(keep_chains=False)
+    shutil.copytree(
+        os.path.join(results_dir, "r207168_t000000"),
+        os.path.join(loop.results_dir, "slice"),
+    )
+    model_path = os.path.join(loop.results_dir, "slice", loop.model_name)
+    loop.save_posterior("slice")
+    for suffix in model_utils.CHAIN_SUFFIXES:
+        assert not os.path.exists(f"{model_path}{suffix}")
+    assert os.path.isfile(f"{model_path}-err.json")
+
+    # The compact posterior is used in place of the chains
+    names, points = model_utils.posterior_points(model_path)
+    compact_names, compact = model_utils.load_posterior(model_path)
+    assert names == compact_names
+    np.testing.assert_array_equal(points, compact)
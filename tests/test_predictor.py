@@ -0,0 +1,98 @@
+"""
+Tests of the starting point extrapolated from the previous fits.
+"""
+
+import os
+import json
+
+import numpy as np
+import pytest
+
+from conftest import INITIAL_STATE
+
+
+def series(values):
+    return [{"a": dict(best=v, mean=v + 1)} for v in values]
+
+
+def test_predict_parameters_linear():
+    from tron.bayesian_analysis import model_utils
+
+    models = series([1.0, 3.0, 5.0])
+    predicted = model_utils.predict_parameters([0, 1, 2], models, 4)
+    assert predicted["a"] == pytest.approx(9.0)
+    predicted = model_utils.predict_parameters([0, 1, 2], models, 4, which="mean")
+    assert predicted["a"] == pytest.approx(10.0)
+
+
+def test_predict_parameters_order():
+    from tron.bayesian_analysis import model_utils
+
+    models = series([0.0, 1.0, 4.0])
+    assert model_utils.predict_parameters([0, 1, 2], models, 3, order=2)[
+        "a"
+    ] == pytest.approx(9.0)
+    # The order is reduced to what the number of fits allows
+    assert model_utils.predict_parameters([0, 1], models[:2], 3, order=2)[
+        "a"
+    ] == pytest.approx(3.0)
+    assert model_utils.predict_parameters([0], models[:1], 3)["a"] == 0.0
+
+
+def test_predict_parameters_new_parameter():
+    from tron.bayesian_analysis import model_utils
+
+    models = series([0.0, 1.0])
+    models[-1]["b"] = dict(best=2.0)
+    predicted = model_utils.predict_parameters([0, 1], models, 2)
+    assert predicted == pytest.approx({"a": 2.0, "b": 2.0})
+
+
+def test_predicted_expt_file_clips(tmp_path):
+    from tron.bayesian_analysis import model_utils
+
+    output_file = str(tmp_path / "predicted-expt.json")
+    values = {"material rho": 10.0, "Ti rho": -1.0, "unknown": 1.0}
+    clipped = model_utils.predicted_expt_file(
+        f"{INITIAL_STATE}-1-expt.json", values, output_file
+    )
+    # material rho is fit within [1, 6]
+    assert clipped == {"material rho": 6.0, "Ti rho": -1.0, "unknown": 1.0}
+
+    expt = model_utils.expt_from_json_file(output_file, keep_original_ranges=True)
+    assert expt.sample["material"].material.rho.value == 6.0
+    assert expt.sample["Ti"].material.rho.value == -1.0
+
+
+def test_predict_window(make_loop, tmp_path):
+    from tron.bayesian_analysis import model_utils
+
+    loop = make_loop(predictor=True, predictor_window=2)
+    last_cov = str(tmp_path / "last-cov.json")
+    with open(last_cov, "w") as fd:
+        json.dump(
+            dict(
+                names=["material rho", "Ti rho"],
+                mean=[3.0, -2.0],
+                cov=np.eye(2).tolist(),
+            ),
+            fd,
+        )
+
+    # Only the last two fits are extrapolated
+    models = [
+        {"material rho": dict(best=v), "Ti rho": dict(best=-2.0)}
+        for v in [5.0, 3.0, 3.5]
+    ]
+    expt_file, cov_file = loop.predict(
+        "r207168_t000030", [0, 10, 20], models, f"{INITIAL_STATE}-1-expt.json", last_cov
+    )
+    assert os.path.dirname(expt_file) == os.path.join(
+        loop.results_dir, "r207168_t000030"
+    )
+    expt = model_utils.expt_from_json_file(expt_file, keep_original_ranges=True)
+    assert expt.sample["material"].material.rho.value == pytest.approx(4.0)
+    with open(cov_file) as fd:
+        cov = json.load(fd)
+    assert cov["mean"] == pytest.approx([4.0, -2.0])
+    assert cov["cov"] == np.eye(2).tolist()
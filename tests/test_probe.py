@@ -0,0 +1,81 @@
+"""
+Tests of the probes sharing their calculation points between data sets on the same Q grid.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("refl1d")
+
+from refl1d.names import QProbe
+
+from conftest import DATA_DIR, INITIAL_STATE
+from tron.bayesian_analysis import data_preparation, model_utils
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(model_utils, "_PROBE_GRIDS", model_utils.OrderedDict())
+
+
+def load_data(index):
+    data_file = os.path.join(DATA_DIR, f"r207168_t{30 * index:06d}.txt")
+    return data_preparation.prepare_data(data_file)
+
+
+def reflectivity(probe):
+    expt = model_utils.expt_from_json_file(f"{INITIAL_STATE}-1-expt.json", probe=probe)
+    return expt.reflectivity()[1]
+
+
+@pytest.mark.parametrize("oversampling", [None, 5])
+def test_probes_share_calc_points(oversampling):
+    Q, R, dR, dQ = load_data(0)
+    _, R2, dR2, _ = load_data(1)
+    first = model_utils.make_probe(Q, dQ, R=R, dR=dR, oversampling=oversampling)
+    second = model_utils.make_probe(Q, dQ, R=R2, dR=dR2, oversampling=oversampling)
+    assert second.calc_Q is first.calc_Q
+    assert len(model_utils._PROBE_GRIDS) == 1
+    np.testing.assert_array_equal(second.R, R2)
+
+    # Same theory as a probe built without the cache
+    uncached = QProbe(Q, dQ, R=R2, dR=dR2)
+    if oversampling is not None:
+        uncached.oversample(oversampling)
+        assert len(first.calc_Q) > len(Q)
+    np.testing.assert_array_equal(second.calc_Q, uncached.calc_Q)
+    np.testing.assert_allclose(reflectivity(second), reflectivity(uncached))
+
+
+def test_subset_of_cached_grid():
+    Q, R, dR, dQ = load_data(0)
+    model_utils.make_probe(Q, dQ, R=R, dR=dR, oversampling=5)
+    subset = slice(10, -10)
+    probe = model_utils.make_probe(
+        Q[subset], dQ[subset], R=R[subset], dR=dR[subset], oversampling=5
+    )
+    assert len(model_utils._PROBE_GRIDS) == 2
+
+    # The points outside the resolution of the subset are dropped
+    assert probe.calc_Q.min() >= np.min(Q[subset] - 4 * dQ[subset])
+    assert probe.calc_Q.max() <= np.max(Q[subset] + 4 * dQ[subset])
+
+    # Oversampling points are random, so the theory is compared to a
+    # converged resolution rather than to a new probe with the same oversampling
+    converged = QProbe(Q[subset], dQ[subset], R=R[subset], dR=dR[subset])
+    converged.oversample(500)
+    np.testing.assert_allclose(reflectivity(probe), reflectivity(converged), rtol=0.01)
+
+
+def test_other_refl1d_versions(monkeypatch):
+    import refl1d
+
+    # The private calculation points are only set with refl1d 1.0
+    monkeypatch.setattr(refl1d, "__version__", "2.0.0")
+    Q, R, dR, dQ = load_data(0)
+    probe = model_utils.make_probe(Q, dQ, R=R, dR=dR, oversampling=5)
+    assert len(model_utils._PROBE_GRIDS) == 0
+    assert probe.oversampling == 5
+    assert len(probe.calc_Q) > len(Q)
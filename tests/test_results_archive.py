@@ -0,0 +1,192 @@
+"""
+Tests of the per-run archive of fit results.
+"""
+
+import os
+import json
+import shutil
+
+import numpy as np
+import pytest
+
+from conftest import INITIAL_STATE
+from tron.bayesian_analysis import results_archive
+from tron.bayesian_analysis.fitting_loop import FittingLoop
+
+
+@pytest.fixture
+def results_dir(tmp_path):
+    """
+    Results directory with the outputs of one fit.
+    """
+    slice_dir = tmp_path / "r1_t000000"
+    slice_dir.mkdir()
+    np.savetxt(slice_dir / "model-1-profile.dat", np.arange(6.0).reshape(3, 2))
+    with open(slice_dir / "model-err.json", "w") as fd:
+        json.dump(dict(a=1), fd)
+    with open(slice_dir / "model-chain.mc.gz", "wb") as fd:
+        fd.write(b"\x00chain")
+    with open(slice_dir / "model.py", "w") as fd:
+        fd.write("# not archived")
+    return str(tmp_path)
+
+
+def test_archive_round_trip(results_dir):
+    model_path = os.path.join(results_dir, "r1_t000000", "model")
+    archived = results_archive.archive_results(results_dir)
+    assert archived == 3
+    assert os.listdir(os.path.dirname(model_path)) == ["model.py"]
+    assert sorted(results_archive.members(results_dir)) == [
+        "r1_t000000/model-1-profile.dat",
+        "r1_t000000/model-chain.mc.gz",
+        "r1_t000000/model-err.json",
+    ]
+
+    # Files are read from the archive with the paths of the directory layout
+    assert results_archive.isfile(f"{model_path}-err.json")
+    assert not os.path.exists(f"{model_path}-err.json")
+    assert not results_archive.isfile(f"{model_path}-cov.json")
+    assert results_archive.load_json(f"{model_path}-err.json") == dict(a=1)
+    np.testing.assert_array_equal(
+        results_archive.loadtxt(f"{model_path}-1-profile.dat"),
+        np.arange(6.0).reshape(3, 2),
+    )
+    assert results_archive.read_bytes(f"{model_path}-chain.mc.gz") == b"\x00chain"
+    with pytest.raises(FileNotFoundError):
+        results_archive.read_bytes(f"{model_path}-cov.json")
+
+    # Files written after archiving go next to the files left in place
+    results_archive.write_bytes(f"{model_path}-cov.json", b"{}")
+    assert os.path.isfile(f"{model_path}-cov.json")
+    assert results_archive.load_json(f"{model_path}-cov.json") == dict()
+
+
+def test_archive_slice(results_dir):
+    slice_dir = os.path.join(results_dir, "r1_t000000")
+    model_path = os.path.join(slice_dir, "model")
+
+    # Nested fits and the inputs of the frozen parameters are left in place
+    os.makedirs(os.path.join(slice_dir, "verify"))
+    with open(os.path.join(slice_dir, "verify", "model-err.json"), "w") as fd:
+        json.dump(dict(a=2), fd)
+    os.makedirs(os.path.join(results_dir, "frozen"))
+    with open(os.path.join(results_dir, "frozen", "model-frozen.json"), "w") as fd:
+        json.dump(dict(b=1), fd)
+
+    archived = results_archive.archive_slice(results_dir, "r1_t000000")
+    assert archived == [
+        "r1_t000000/model-1-profile.dat",
+        "r1_t000000/model-chain.mc.gz",
+        "r1_t000000/model-err.json",
+    ]
+    assert sorted(os.listdir(slice_dir)) == ["model.py", "verify"]
+    assert os.listdir(os.path.join(slice_dir, "verify")) == ["model-err.json"]
+    assert results_archive.archive_results(results_dir) == 0
+    assert os.listdir(os.path.join(results_dir, "frozen")) == ["model-frozen.json"]
+    assert sorted(results_archive.members(results_dir)) == archived
+
+    # The slice directory is removed once it is empty
+    shutil.rmtree(os.path.join(slice_dir, "verify"))
+    os.remove(f"{model_path}.py")
+    with open(f"{model_path}-expt.json", "w") as fd:
+        json.dump(dict(c=1), fd)
+    assert results_archive.archive_slice(results_dir, "r1_t000000") == [
+        "r1_t000000/model-expt.json"
+    ]
+    assert not os.path.exists(slice_dir)
+
+    # Files written afterwards go to the archive
+    results_archive.write_bytes(f"{model_path}-cov.json", b"{}")
+    assert not os.path.exists(slice_dir)
+    assert results_archive.load_json(f"{model_path}-cov.json") == dict()
+    assert results_archive.load_json(f"{model_path}-err.json") == dict(a=1)
+
+
+def test_append_replaces(results_dir):
+    model_path = os.path.join(results_dir, "r1_t000000", "model")
+    results_archive.archive_results(results_dir)
+    assert results_archive.read_bytes(f"{model_path}-err.json") == b'{"a": 1}'
+
+    results_archive.append(results_dir, "r1_t000000/model-err.json", b'{"a": 2}')
+    assert results_archive.load_json(f"{model_path}-err.json") == dict(a=2)
+    assert len(results_archive.members(results_dir)) == 3
+
+    # The other files are unchanged
+    assert results_archive.read_bytes(f"{model_path}-chain.mc.gz") == b"\x00chain"
+
+
+def test_interrupted_append(results_dir):
+    model_path = os.path.join(results_dir, "r1_t000000", "model")
+    results_archive.archive_results(results_dir)
+    index_file = os.path.join(results_dir, results_archive.INDEX_FILE)
+
+    # Data written without its index line, then a partial index line
+    with open(os.path.join(results_dir, results_archive.ARCHIVE_FILE), "ab") as fd:
+        fd.write(b"lost")
+    with open(index_file, "a") as fd:
+        fd.write('{"name": "r1_t000000/model-cov.json", "off')
+    assert not results_archive.isfile(f"{model_path}-cov.json")
+    assert results_archive.load_json(f"{model_path}-err.json") == dict(a=1)
+
+    # The next append is still read back
+    results_archive.append(results_dir, "r1_t000000/model-cov.json", b"[1]")
+    assert results_archive.load_json(f"{model_path}-cov.json") == [1]
+    assert results_archive.read_bytes(f"{model_path}-chain.mc.gz") == b"\x00chain"
+
+
+def test_local_files(results_dir):
+    model_path = os.path.join(results_dir, "r1_t000000", "model")
+    suffixes = ["-err.json", "-chain.mc.gz", "-missing.mc.gz"]
+
+    # Files on disk are used in place
+    with results_archive.local_files(model_path, suffixes) as local_path:
+        assert local_path == model_path
+
+    # Archived files are extracted to a temporary directory
+    results_archive.archive_results(results_dir)
+    with results_archive.local_files(model_path, suffixes) as local_path:
+        assert local_path != model_path
+        assert os.path.basename(local_path) == "model"
+        with open(f"{local_path}-chain.mc.gz", "rb") as fd:
+            assert fd.read() == b"\x00chain"
+        assert os.path.isfile(f"{local_path}-err.json")
+        assert not os.path.exists(f"{local_path}-missing.mc.gz")
+    assert not os.path.exists(os.path.dirname(local_path))
+
+
+def test_archive_after_each_fit(make_loop, slices, monkeypatch):
+    slices = slices[:3]
+    loop = make_loop(archive_results=True)
+
+    # Record the archive at the start of each fit and write the results of a
+    # successful fit, with a plot and a nested fit that are not archived
+    archived = []
+
+    def run_dream(self, base_name, data_file, starting_expt, starting_err, *args):
+        archived.append(sorted(results_archive.members(self.results_dir)))
+        model_path = os.path.join(self.results_dir, base_name, self.model_name)
+        os.makedirs(os.path.join(os.path.dirname(model_path), "verify"))
+        shutil.copy(f"{INITIAL_STATE}-1-expt.json", f"{model_path}-1-expt.json")
+        shutil.copy(f"{INITIAL_STATE}-err.json", f"{model_path}-err.json")
+        shutil.copy(f"{INITIAL_STATE}-err.json", f"{model_path}-1-refl.png")
+        shutil.copy(
+            f"{INITIAL_STATE}-err.json",
+            os.path.join(os.path.dirname(model_path), "verify", "model-err.json"),
+        )
+        return True
+
+    monkeypatch.setattr(FittingLoop, "run_dream", run_dream)
+    loop.fit(slices)
+
+    # Each fit starts after the previous ones were archived
+    base_names = [os.path.splitext(f)[0] for f in slices]
+    for i, members in enumerate(archived):
+        assert members == sorted(
+            f"{name}/model{suffix}"
+            for name in base_names[:i]
+            for suffix in ("-1-expt.json", "-err.json")
+        )
+    for name in base_names:
+        slice_dir = os.path.join(loop.results_dir, name)
+        assert sorted(os.listdir(slice_dir)) == ["model-1-refl.png", "verify"]
+        assert os.listdir(os.path.join(slice_dir, "verify")) == ["model-err.json"]
@@ -0,0 +1,109 @@
+"""
+Tests of the ensemble Kalman filter on a linear-Gaussian problem.
+"""
+
+import numpy as np
+import pytest
+
+
+class LinearProblem:
+    """
+    Problem with residuals (A x - y) / sigma, following the FitProblem interface.
+    """
+
+    def __init__(self, names, A, y, sigma, x0):
+        self.names = names
+        self.A = np.asarray(A)
+        self.y = np.asarray(y)
+        self.sigma = sigma
+        self.x = np.asarray(x0, dtype=float)
+
+    def labels(self):
+        return list(self.names)
+
+    def getp(self):
+        return self.x.copy()
+
+    def setp(self, x):
+        self.x = np.asarray(x, dtype=float)
+
+    def bounds(self):
+        return np.full(len(self.x), -np.inf), np.full(len(self.x), np.inf)
+
+    def residuals(self):
+        return (self.A @ self.x - self.y) / self.sigma
+
+
+@pytest.fixture
+def linear_problem():
+    rng = np.random.default_rng(1)
+    A = rng.normal(size=(6, 2))
+    y = A @ np.array([1.0, -2.0]) + 0.5 * rng.normal(size=6)
+    return LinearProblem(["a", "b"], A, y, 0.5, [0.0, 0.0])
+
+
+def test_update_matches_analytic_posterior(linear_problem):
+    from tron.bayesian_analysis import sequential_filter
+
+    prior_mean = np.array([0.5, -1.0])
+    prior_cov = np.diag([1.0, 4.0])
+    ensemble_filter = sequential_filter.EnsembleFilter(
+        ["a", "b"], prior_mean, np.sqrt(np.diag(prior_cov)), n_members=4000, seed=0
+    )
+    ensemble_filter.update(linear_problem)
+
+    # Posterior of a linear model with a Gaussian prior and Gaussian noise
+    A = linear_problem.A / linear_problem.sigma
+    y = linear_problem.y / linear_problem.sigma
+    cov = np.linalg.inv(np.linalg.inv(prior_cov) + A.T @ A)
+    mean = cov @ (np.linalg.solve(prior_cov, prior_mean) + A.T @ y)
+
+    std = np.sqrt(np.diag(cov))
+    assert np.all(np.abs(np.mean(ensemble_filter.ensemble, axis=0) - mean) < 0.1 * std)
+    assert np.all(
+        np.abs(np.cov(ensemble_filter.ensemble.T) - cov) < 0.1 * np.outer(std, std)
+    )
+    assert ensemble_filter.chisq.shape == (4000,)
+
+
+def test_forecast_random_walk():
+    from tron.bayesian_analysis import model_utils, sequential_filter
+
+    names = ["a rho", "b"]
+    ensemble_filter = sequential_filter.EnsembleFilter(
+        names, [1.0, 2.0], [0.0, 0.0], n_members=2000, process_noise=2.0, seed=0
+    )
+    problem = LinearProblem(names, np.eye(2), [0, 0], 1.0, [0.0, 0.0])
+    ensemble_filter.forecast(problem)
+
+    # Parameter 'b' has no minimum prior width and infinite bounds
+    std = np.std(ensemble_filter.ensemble, axis=0)
+    assert std[0] == pytest.approx(2.0 * model_utils.ERR_MIN_RHO, rel=0.1)
+    assert std[1] == 0
+
+
+def test_align_new_parameter():
+    from tron.bayesian_analysis import sequential_filter
+
+    ensemble_filter = sequential_filter.EnsembleFilter(
+        ["a"], [1.0], [0.0], n_members=10, seed=0
+    )
+    problem = LinearProblem(["b", "a"], np.eye(2), [0, 0], 1.0, [5.0, 0.0])
+    ensemble_filter.forecast(problem)
+    # Parameters that were not in the ensemble start from the problem value
+    assert ensemble_filter.names == ["b", "a"]
+    np.testing.assert_array_equal(ensemble_filter.ensemble[:, 0], 5.0)
+    np.testing.assert_array_equal(ensemble_filter.ensemble[:, 1], 1.0)
+
+
+def test_stats(linear_problem):
+    from tron.bayesian_analysis import sequential_filter
+
+    ensemble_filter = sequential_filter.EnsembleFilter(
+        ["a", "b"], [0.0, 0.0], [1.0, 1.0], n_members=200, seed=0
+    )
+    ensemble_filter.update(linear_problem)
+    stats = ensemble_filter.stats()
+    assert sorted(stats) == ["a", "b"]
+    assert stats["a"]["best"] == ensemble_filter.best[0]
+    assert stats["b"]["std"] == pytest.approx(np.std(ensemble_filter.ensemble[:, 1]))
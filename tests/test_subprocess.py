@@ -0,0 +1,59 @@
+"""
+Tests of the timeouts, retries and logs of the refl1d processes.
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+from conftest import DATA_DIR, INITIAL_STATE
+
+
+def test_timeout_and_retries(make_loop, slices):
+    loop = make_loop(fit_timeout=0.5, fit_retries=1)
+    loop.fit(slices[:2])
+
+    # Both slices were killed twice and skipped
+    with open(os.path.join(loop.results_dir, "failed-fits.json"), "r") as fd:
+        failed = json.load(fd)
+    assert sorted(failed) == [os.path.splitext(f)[0] for f in slices[:2]]
+    for base_name, failure in failed.items():
+        assert failure["returncode"] != 0
+        with open(failure["log"], "r") as fd:
+            log = fd.read()
+        assert log.count("# Attempt") == 2
+        assert log.count("# Timed out after 0.5 s") == 2
+        # The retry uses a new random seed
+        assert "--seed=" in log.split("# Attempt 2")[1]
+        assert not os.path.isfile(
+            os.path.join(loop.results_dir, base_name, f"{loop.model_name}-err.json")
+        )
+
+
+def test_fit_log(make_loop, slices):
+    loop = make_loop()
+    assert loop.run_dream(
+        "slice",
+        os.path.join(DATA_DIR, slices[0]),
+        f"{INITIAL_STATE}-1-expt.json",
+        f"{INITIAL_STATE}-err.json",
+    )
+    with open(loop.log_file("slice"), "r") as fd:
+        log = fd.read()
+    assert log.count("# Attempt") == 1
+    # refl1d runs with the interpreter of the fitting loop
+    assert f"# Attempt 1: {sys.executable} -m refl1d.main" in log
+    assert loop.last_output.returncode == 0
+    assert loop.last_output.stderr.strip() in log
+
+
+def test_process_exited_before_kill(make_loop, monkeypatch):
+    loop = make_loop(fit_timeout=0.1)
+    process = subprocess.Popen(["sleep", "1"], start_new_session=True)
+
+    def killpg(pid, sig):
+        raise ProcessLookupError(pid)
+
+    monkeypatch.setattr(os, "killpg", killpg)
+    assert loop.wait_process(process) == "Timed out after 0.1 s"
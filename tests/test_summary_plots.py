@@ -0,0 +1,209 @@
+"""
+Tests of the summary figures of a run.
+"""
+
+import os
+import gzip
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from conftest import FINAL_STATE, INITIAL_STATE
+from tron.bayesian_analysis import summary_plots
+
+FIGURES = ["dyn", "sld", "trend", "maps"]
+
+
+@pytest.fixture
+def run(fitted_run, tmp_path):
+    """
+    Arguments of summary_plots.main for a copy of the fitted run.
+    """
+    data_dir, results_dir, model_file = fitted_run
+    shutil.copytree(results_dir, tmp_path / "results")
+    return dict(
+        dynamic_run=207168,
+        dyn_data_dir=data_dir,
+        model_file=model_file,
+        initial_state=f"{INITIAL_STATE}-1-expt.json",
+        final_state=f"{FINAL_STATE}-1-expt.json",
+        results_dir=str(tmp_path / "results"),
+    )
+
+
+class RecordingExecutor(ThreadPoolExecutor):
+    """
+    Single-thread executor recording the function and first argument of each task.
+    """
+
+    def __init__(self, submitted):
+        super().__init__(1)
+        self.submitted = submitted
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted.append((fn.__name__, args[0]))
+        return super().submit(fn, *args, **kwargs)
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    """
+    List of the tasks submitted by render_runs, which run in this process.
+    """
+    submitted = []
+    monkeypatch.setattr(
+        summary_plots, "_pool", lambda processes=None: RecordingExecutor(submitted)
+    )
+    return submitted
+
+
+def figure_files(run, names):
+    return [
+        f
+        for name in names
+        for f in summary_plots._figure_files(run["results_dir"], name, 207168)
+    ]
+
+
+def test_render_headless(run):
+    # Figures are drawn in spawned worker processes, without a display
+    summary_plots.main(processes=2, **run)
+    for figure_file in figure_files(run, FIGURES):
+        assert os.path.getsize(figure_file) > 0
+    for name in ["r207168_t000000", "r207168_t000030", "r207168_t000060"]:
+        assert os.path.isfile(
+            os.path.join(run["results_dir"], name, "model-1-contour.npz")
+        )
+
+
+def test_second_run_skips_everything(run, submitted):
+    summary_plots.main(**run)
+    assert len(submitted) == 7
+    mtimes = {f: os.stat(f).st_mtime_ns for f in figure_files(run, FIGURES)}
+
+    submitted.clear()
+    summary_plots.main(**run)
+    assert submitted == []
+    assert {f: os.stat(f).st_mtime_ns for f in mtimes} == mtimes
+
+    # Unless the figures are forced
+    summary_plots.main(force=True, **run)
+    assert len(submitted) == 7
+
+
+def test_changed_chain_is_rendered_again(run, submitted):
+    summary_plots.main(**run)
+    model_path = os.path.join(run["results_dir"], "r207168_t000030", "model")
+
+    # Same chain, with a new time stamp in the gzip header
+    chain_file = f"{model_path}-chain.mc.gz"
+    with open(chain_file, "rb") as fd:
+        chain = gzip.decompress(fd.read())
+    with open(chain_file, "wb") as fd:
+        fd.write(gzip.compress(chain, mtime=1))
+
+    submitted.clear()
+    summary_plots.main(**run)
+    assert submitted == [
+        ("sld_contour", f"{model_path}-1-profile.dat"),
+        ("render_figure", summary_plots.plot_dyn_sld),
+    ]
+
+
+def test_manifest_file_hash(tmp_path):
+    manifest = summary_plots.SummaryManifest(str(tmp_path))
+    data_file = str(tmp_path / "data.txt")
+    with open(data_file, "w") as fd:
+        fd.write("1 2 3\n")
+    inputs = manifest.inputs([data_file], dict(first_item=0))
+    manifest.update("figure", inputs)
+    manifest.save()
+
+    # The manifest is read back, and the figure is current once its outputs exist
+    manifest = summary_plots.SummaryManifest(str(tmp_path))
+    assert manifest.inputs([data_file], dict(first_item=0)) == inputs
+    assert not manifest.is_current("figure", inputs, [str(tmp_path / "figure.png")])
+    assert manifest.is_current("figure", inputs, [data_file])
+    assert manifest.inputs([data_file], dict(first_item=1)) != inputs
+    assert summary_plots.SummaryManifest(str(tmp_path), force=True).artifacts == {}
+
+    # A file with the same size and time stamp is not hashed again
+    stat = os.stat(data_file)
+    with open(data_file, "w") as fd:
+        fd.write("4 5 6\n")
+    os.utime(data_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert manifest.inputs([data_file], dict(first_item=0)) == inputs
+    os.utime(data_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert manifest.inputs([data_file], dict(first_item=0)) != inputs
+
+
+def test_long_run_maps(run, submitted, monkeypatch):
+    # Above MAX_LINE_SLICES, the curves of each data set are not drawn
+    monkeypatch.setattr(summary_plots, "MAX_LINE_SLICES", 2)
+    summary_plots.main(**run)
+    assert sorted(name for name, _ in submitted) == ["render_figure"] * 2
+    for figure_file in figure_files(run, ["trend", "maps"]):
+        assert os.path.isfile(figure_file)
+    for figure_file in figure_files(run, ["dyn", "sld"]):
+        assert not os.path.isfile(figure_file)
+
+
+def test_bin_onto_grid():
+    edges = np.asarray([0.0, 1.0, 2.0, 3.0])
+    grid = summary_plots.bin_onto_grid(
+        [np.asarray([0.2, 0.8, 2.5, 3.0]), np.asarray([1.5, 4.0])],
+        [np.asarray([1.0, 3.0, 5.0, 7.0]), np.asarray([2.0, 9.0])],
+        edges,
+    )
+    # Points are averaged in each bin, the last bin includes its upper edge,
+    # and points outside the grid are dropped
+    np.testing.assert_array_equal(grid, [[2.0, np.nan, 6.0], [np.nan, 2.0, np.nan]])
+
+
+def test_maps(run):
+    file_list = summary_plots.dyn_file_list(207168, run["dyn_data_dir"])
+    assert [f[0] for f in file_list] == [0, 30, 60]
+
+    grid = summary_plots.plot_refl_map(file_list, run["dyn_data_dir"], n_q=40)
+    assert grid.shape == (3, 40)
+    grid = summary_plots.plot_residual_map(
+        file_list, run["results_dir"], model_name="model", n_q=40
+    )
+    assert grid.shape == (3, 40)
+    assert np.nanmax(np.abs(grid)) < 10
+    grid = summary_plots.plot_sld_map(
+        file_list, run["results_dir"], model_name="model", n_z=100
+    )
+    assert grid.shape == (3, 100)
+    # Profiles shorter than the longest one are padded with NaN
+    assert np.all(np.isfinite(grid[:, :90]))
+    summary_plots.plt.close("all")
+
+
+def test_sld_contour_is_reproducible(fitted_run, capsys, monkeypatch):
+    _, results_dir, _ = fitted_run
+    profile_file = os.path.join(results_dir, "r207168_t000030", "model-1-profile.dat")
+
+    # Record the draw count returned with the band
+    counts = []
+    adaptive_sld_contour = summary_plots.fit_uncertainties.adaptive_sld_contour
+
+    def recording(*args, **kwargs):
+        contours, n_draws = adaptive_sld_contour(*args, **kwargs)
+        counts.append(n_draws)
+        return contours, n_draws
+
+    monkeypatch.setattr(
+        summary_plots.fit_uncertainties, "adaptive_sld_contour", recording
+    )
+
+    first = summary_plots.sld_contour(profile_file)
+    second = summary_plots.sld_contour(profile_file)
+    assert first.shape == (4, 200)
+    np.testing.assert_array_equal(first, second)
+    assert counts[0] == counts[1] > 0
+
+    output = capsys.readouterr().out
+    assert output.count(f"{counts[0]} posterior draws") == 2
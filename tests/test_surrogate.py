@@ -0,0 +1,150 @@
+"""
+Tests of the reflectivity surrogate and of its use by the fitting loop.
+"""
+
+import os
+import types
+
+import numpy as np
+import pytest
+
+from conftest import DATA_DIR, INITIAL_STATE
+from tron.bayesian_analysis import model_utils, surrogate
+
+
+def test_surrogate_follows_frozen_parameters(make_loop, monkeypatch):
+    loop = make_loop()
+    labels = ["a", "b", "c"]
+    trained = []
+
+    def load_or_train(problem, model_file, cache_dir):
+        trained.append(problem.labels())
+        return types.SimpleNamespace(names=problem.labels())
+
+    def prescreen(model, problem):
+        assert list(model.names) == problem.labels()
+        return dict()
+
+    monkeypatch.setattr(
+        loop,
+        "load_problem",
+        lambda *args: types.SimpleNamespace(labels=lambda: list(labels)),
+    )
+    monkeypatch.setattr(surrogate, "load_or_train", load_or_train)
+    monkeypatch.setattr(surrogate, "prescreen", prescreen)
+    monkeypatch.setattr(model_utils, "predicted_expt_file", lambda *args: None)
+
+    loop.surrogate_start("t0", "data", "expt", "err")
+    loop.surrogate_start("t1", "data", "expt", "err")
+    assert trained == [["a", "b", "c"]]
+
+    # Parameter b was frozen
+    labels.remove("b")
+    loop.surrogate_start("t2", "data", "expt", "err")
+    assert trained == [["a", "b", "c"], ["a", "c"]]
+
+
+@pytest.fixture
+def problem():
+    """
+    Problem for the first data set, with three fit parameters.
+    """
+    from tron.bayesian_analysis import data_preparation
+
+    Q, R, dR, dQ = data_preparation.prepare_data(
+        os.path.join(DATA_DIR, "r207168_t000000.txt")
+    )
+    probe = model_utils.make_probe(Q, dQ, R=R, dR=dR)
+    expt = model_utils.expt_from_json_file(f"{INITIAL_STATE}-1-expt.json", probe=probe)
+    expt.sample["THF"].interface.range(15.0, 150.0)
+    expt.sample["material"].material.rho.range(1.0, 6.0)
+    expt.sample["material"].thickness.range(10.0, 100.0)
+    return model_utils.fit_problem(expt)
+
+
+@pytest.fixture
+def model_file(tmp_path):
+    model_file = str(tmp_path / "model.py")
+    with open(model_file, "w") as fd:
+        fd.write("# Model\n")
+    return model_file
+
+
+def simulate(problem, points):
+    expt = list(problem.models)[0]
+    curves = []
+    for point in points:
+        problem.setp(point)
+        _, r = expt.reflectivity()
+        curves.append(np.log10(np.maximum(r, surrogate.R_MIN)))
+    return np.asarray(curves)
+
+
+def test_surrogate_training(problem):
+    pytest.importorskip("torch")
+    trained = surrogate.ReflectivitySurrogate.train(
+        problem, n_samples=1000, epochs=50, seed=0
+    )
+    assert trained.names == problem.labels()
+
+    # The surrogate does much better than the mean curve on new parameters
+    points = np.random.default_rng(1).uniform(*problem.bounds(), size=(50, 3))
+    curves = simulate(problem, points)
+    error = np.mean((trained.predict(points) - curves) ** 2)
+    assert error < 0.3 * np.mean((trained.offset - curves) ** 2)
+
+
+def test_surrogate_cache(problem, model_file, tmp_path, monkeypatch):
+    pytest.importorskip("torch")
+    cache_dir = str(tmp_path / "cache")
+    trained = surrogate.load_or_train(
+        problem, model_file, cache_dir, n_samples=50, epochs=2, seed=0
+    )
+    key = surrogate.surrogate_key(model_file, problem)
+    assert os.listdir(cache_dir) == [f"model-{key}.pt"]
+
+    # The second call loads the cached weights
+    def train(*args, **kwargs):
+        raise AssertionError("The surrogate should not be trained again")
+
+    monkeypatch.setattr(surrogate.ReflectivitySurrogate, "train", train)
+    loaded = surrogate.load_or_train(problem, model_file, cache_dir)
+    points = problem.getp()[None, :]
+    np.testing.assert_allclose(loaded.predict(points), trained.predict(points))
+
+
+def test_surrogate_key(problem, model_file):
+    key = surrogate.surrogate_key(model_file, problem)
+    assert surrogate.surrogate_key(model_file, problem) == key
+
+    # Changing the model file, the parameter ranges or the Q values changes the key
+    with open(model_file, "a") as fd:
+        fd.write("# Changed\n")
+    assert surrogate.surrogate_key(model_file, problem) != key
+    key = surrogate.surrogate_key(model_file, problem)
+
+    expt = list(problem.models)[0]
+    expt.sample["THF"].interface.range(15.0, 100.0)
+    problem.model_reset()
+    assert surrogate.surrogate_key(model_file, problem) != key
+    key = surrogate.surrogate_key(model_file, problem)
+
+    expt.probe.Q = expt.probe.Q * 1.01
+    assert surrogate.surrogate_key(model_file, problem) != key
+
+
+def test_prescreen(problem):
+    pytest.importorskip("torch")
+    trained = surrogate.ReflectivitySurrogate.train(
+        problem, n_samples=1000, epochs=50, seed=0
+    )
+    start = problem.getp()
+    values = surrogate.prescreen(trained, problem, n_steps=50, seed=0)
+    assert list(values) == problem.labels()
+    point = np.asarray(list(values.values()))
+    low, high = problem.bounds()
+    assert np.all((point >= low) & (point <= high))
+
+    # The exact model validates the candidates, and the starting point is kept
+    np.testing.assert_array_equal(problem.getp(), start)
+    assert problem.nllf(point) <= problem.nllf(start)
@@ -0,0 +1,90 @@
+"""
+Tests of the work queue, with local workers fitting the example data.
+"""
+
+import os
+import time
+import shutil
+import sqlite3
+
+import pytest
+
+pytest.importorskip("refl1d")
+
+from conftest import INITIAL_STATE
+from tron.bayesian_analysis import work_queue
+from tron.bayesian_analysis.fitting_loop import FittingLoop
+
+
+def test_local_workers(tmp_path, make_loop, slices):
+    slices = slices[:2]
+    db_path = str(tmp_path / "queue.db")
+    queue = work_queue.WorkQueue(db_path, lease_time=0.1)
+    runs = []
+    for name in ["run_a", "run_b"]:
+        loop = make_loop(name)
+        work_queue.submit_fit(queue, loop, slices)
+        runs.append(loop.results_dir)
+
+    # A worker that died while holding the first slice of the first run
+    lost_task = queue.lease("dead-worker")
+    time.sleep(0.2)
+
+    work_queue.run_workers(db_path, 2)
+
+    tasks = queue.tasks()
+    assert [t["state"] for t in tasks] == ["done"] * len(tasks)
+
+    # The expired lease was reclaimed by one of the workers
+    with sqlite3.connect(db_path) as db:
+        attempts, worker = db.execute(
+            "SELECT attempts, worker FROM tasks WHERE id=?", (lost_task["id"],)
+        ).fetchone()
+    assert attempts == 2
+    assert worker != "dead-worker"
+    assert not queue.heartbeat(lost_task["id"], "dead-worker")
+
+    for results_dir in runs:
+        run_tasks = [t for t in tasks if t["run"] == results_dir]
+        assert [t["slice"] for t in run_tasks] == [
+            os.path.splitext(f)[0] for f in slices
+        ]
+        # Each slice is fit once the previous slice of its run is done
+        fit_times = [os.path.getmtime(t["result"]["err"]) for t in run_tasks]
+        assert fit_times == sorted(fit_times)
+
+
+def test_slices_start_from_previous_slice(tmp_path, make_loop, slices, monkeypatch):
+    slices = slices[:3]
+    queue = work_queue.WorkQueue(str(tmp_path / "queue.db"))
+    loop = make_loop()
+    work_queue.submit_fit(queue, loop, slices)
+
+    # Record the starting files and write the results of a successful fit
+    started = []
+
+    def run_dream(self, base_name, data_file, starting_expt, starting_err, *args):
+        started.append((base_name, starting_expt, starting_err))
+        model_path = os.path.join(self.results_dir, base_name, self.model_name)
+        os.makedirs(os.path.dirname(model_path), exist_ok=True)
+        shutil.copy(f"{INITIAL_STATE}-1-expt.json", f"{model_path}-1-expt.json")
+        shutil.copy(f"{INITIAL_STATE}-err.json", f"{model_path}-err.json")
+        return True
+
+    monkeypatch.setattr(FittingLoop, "run_dream", run_dream)
+    while (task := queue.lease("worker")) is not None:
+        queue.complete(task["id"], "worker", work_queue.execute_task(task))
+
+    base_names = [os.path.splitext(f)[0] for f in slices]
+    assert started[0] == (
+        base_names[0],
+        f"{INITIAL_STATE}-1-expt.json",
+        f"{INITIAL_STATE}-err.json",
+    )
+    for i in (1, 2):
+        model_path = os.path.join(loop.results_dir, base_names[i - 1], loop.model_name)
+        assert started[i] == (
+            base_names[i],
+            f"{model_path}-1-expt.json",
+            f"{model_path}-err.json",
+        )
@@ -0,0 +1,349 @@
+"""
+Amortized inference for time-resolved data sets.
+
+A mixture density network is trained on noisy reflectivity curves
+simulated over the parameter ranges of a model. Once trained, it
+returns approximate posteriors for all the time slices of a run in
+a single forward pass. It only runs on the CPU.
+"""
+
+import os
+
+import numpy as np
+
+try:
+    import torch
+
+    HAS_TORCH = True
+except ImportError:
+    HAS_TORCH = False
+
+from . import model_utils
+from .surrogate import R_MIN, surrogate_key
+
+
+def data_features(q_grid, data):
+    """
+    Return the network input for a measured reflectivity curve.
+
+    The reflectivity and its uncertainty are interpolated onto the
+    training Q grid and log-scaled. Negative or vanishing points are
+    replaced by a fraction of their uncertainty.
+
+    Parameters
+    ----------
+    q_grid : array
+        Q values used for training
+    data : array
+        Q, R, dR[, dQ] columns of the data set
+    """
+    q, r, dr = data[0], data[1], data[2]
+    log_r = np.log10(np.maximum(r, np.maximum(dr / 10, R_MIN)))
+    log_dr = np.log10(np.maximum(dr, R_MIN))
+    return np.hstack([np.interp(q_grid, q, log_r), np.interp(q_grid, q, log_dr)])
+
+
+def truncated_mixture_draws(weights, mu, sigma, n_draws, rng):
+    """
+    Draw from a Gaussian mixture truncated to the unit box.
+
+    Each component is weighted by its mass inside the box, and each
+    coordinate is drawn from its truncated normal, so that no draw is
+    moved onto a bound.
+
+    Parameters
+    ----------
+    weights : array
+        Weight of each component
+    mu, sigma : array
+        Mean and width of each component, with shape (components, parameters)
+    n_draws : int
+        Number of draws
+    rng : Generator
+        Random number generator
+
+    Returns
+    -------
+        array of draws, with shape (draws, parameters)
+    """
+    from scipy.special import ndtr
+    from scipy.stats import truncnorm
+
+    cdf_low, cdf_high = ndtr(-mu / sigma), ndtr((1 - mu) / sigma)
+    mass = weights * np.prod(cdf_high - cdf_low, axis=1)
+    # Components with no mass left in the box keep their own weight
+    p = mass / mass.sum() if mass.sum() > 0 else weights / weights.sum()
+    component = rng.choice(len(weights), size=n_draws, p=p)
+
+    loc, scale = mu[component], sigma[component]
+    draws = truncnorm.rvs(
+        -loc / scale, (1 - loc) / scale, loc=loc, scale=scale, random_state=rng
+    )
+    # Only guards against rounding
+    return np.clip(draws, 0, 1)
+
+
+class PosteriorEstimator:
+    """
+    Mixture density network giving the posterior of the fit parameters of a model.
+    """
+
+    def __init__(self, names, bounds, q, n_components=5, hidden=256, n_layers=3):
+        """
+        Create an untrained estimator.
+
+        Parameters
+        ----------
+        names : list
+            Name of each fit parameter
+        bounds : array
+            Parameter ranges, as a 2 x N array
+        q : array
+            Q values of the training curves
+        n_components : int
+            Number of Gaussian components in the mixture
+        hidden : int
+            Number of units in each hidden layer
+        n_layers : int
+            Number of hidden layers
+        """
+        if not HAS_TORCH:
+            raise ImportError("Amortized inference requires pytorch")
+        self.names = list(names)
+        self.bounds = np.asarray(bounds, dtype=float)
+        self.q = np.asarray(q, dtype=float)
+        self.n_components = n_components
+        self.hidden = hidden
+        self.n_layers = n_layers
+
+        n_pars = len(self.names)
+        layers = []
+        n_in = 2 * len(self.q)
+        for _ in range(n_layers):
+            layers += [torch.nn.Linear(n_in, hidden), torch.nn.SiLU()]
+            n_in = hidden
+        # Mixture weights, means and log-widths for each component
+        layers.append(torch.nn.Linear(n_in, n_components * (1 + 2 * n_pars)))
+        self.network = torch.nn.Sequential(*layers).to("cpu")
+
+        # Input normalization, set during training
+        self.offset = np.zeros(2 * len(self.q))
+        self.scale = np.ones(2 * len(self.q))
+
+    def _mixture(self, features):
+        """
+        Return the log-weights, means and widths of the mixture, in normalized units.
+        """
+        n_pars = len(self.names)
+        offset = torch.as_tensor(self.offset, dtype=torch.float32)
+        scale = torch.as_tensor(self.scale, dtype=torch.float32)
+        out = self.network((features - offset) / scale)
+        log_w = torch.log_softmax(out[:, : self.n_components], dim=1)
+        mu = out[:, self.n_components : self.n_components * (1 + n_pars)]
+        log_sigma = out[:, self.n_components * (1 + n_pars) :]
+        shape = (-1, self.n_components, n_pars)
+        return log_w, mu.reshape(shape), torch.clamp(log_sigma.reshape(shape), -7, 2)
+
+    def _log_prob(self, features, targets):
+        log_w, mu, log_sigma = self._mixture(features)
+        z = (targets[:, None, :] - mu) / torch.exp(log_sigma)
+        log_n = -0.5 * torch.sum(z**2, dim=2) - torch.sum(log_sigma, dim=2)
+        return torch.logsumexp(log_w + log_n, dim=1)
+
+    @classmethod
+    def train(
+        cls,
+        problem,
+        n_samples=20000,
+        epochs=200,
+        batch_size=512,
+        seed=None,
+        **kwargs,
+    ):
+        """
+        Train an estimator on noisy curves simulated over the parameter ranges of a problem.
+
+        The uncertainties of the simulated curves are scaled from those of
+        the data held by the problem, assuming counting statistics.
+
+        Parameters
+        ----------
+        problem : FitProblem
+            Problem loaded from the model file, with finite parameter ranges
+        n_samples : int
+            Number of simulated curves
+        epochs : int
+            Number of training epochs
+        batch_size : int
+            Mini-batch size
+        seed : int
+            Seed for the random number generators
+        kwargs : dict
+            Additional arguments passed to the constructor
+        """
+        rng = np.random.default_rng(seed)
+        if seed is not None:
+            torch.manual_seed(seed)
+        expt = list(problem.models)[0]
+        q, dr_ref = expt.probe.Q, expt.probe.dR
+        bounds = problem.bounds()
+        estimator = cls(problem.labels(), bounds, q, **kwargs)
+
+        original = problem.getp()
+        _, r_ref = expt.reflectivity()
+        r_ref = np.maximum(r_ref, R_MIN)
+        points = rng.uniform(bounds[0], bounds[1], size=(n_samples, len(original)))
+        features = []
+        for point in points:
+            problem.setp(point)
+            _, r = expt.reflectivity()
+            dr = dr_ref * np.sqrt(np.maximum(r, R_MIN) / r_ref)
+            r_noisy = r + dr * rng.standard_normal(len(r))
+            features.append(data_features(q, [q, r_noisy, dr]))
+        problem.setp(original)
+        features = np.asarray(features)
+
+        estimator.offset = np.mean(features, axis=0)
+        estimator.scale = np.std(features, axis=0) + 1e-6
+        x = torch.as_tensor(features, dtype=torch.float32)
+        y = torch.as_tensor(estimator._normalize(points), dtype=torch.float32)
+
+        optimizer = torch.optim.Adam(estimator.network.parameters(), lr=1e-3)
+        scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs)
+        for _ in range(epochs):
+            order = torch.randperm(n_samples)
+            for i in range(0, n_samples, batch_size):
+                batch = order[i : i + batch_size]
+                optimizer.zero_grad()
+                loss = -torch.mean(estimator._log_prob(x[batch], y[batch]))
+                loss.backward()
+                optimizer.step()
+            scheduler.step()
+        return estimator
+
+    def _normalize(self, points):
+        low, high = self.bounds
+        return (np.atleast_2d(points) - low) / (high - low)
+
+    def sample(self, data_list, n_draws=1000, seed=None):
+        """
+        Draw posterior samples for a list of data sets in one forward pass.
+
+        Parameters
+        ----------
+        data_list : list
+            Q, R, dR[, dQ] columns of each data set
+        n_draws : int
+            Number of samples for each data set
+        seed : int
+            Seed for the random number generator
+
+        Returns
+        -------
+            tuple of the samples, with shape (data sets, draws, parameters),
+            and of the mode of each posterior
+        """
+        rng = np.random.default_rng(seed)
+        features = np.asarray([data_features(self.q, data) for data in data_list])
+        with torch.no_grad():
+            log_w, mu, log_sigma = self._mixture(
+                torch.as_tensor(features, dtype=torch.float32)
+            )
+        weights = np.exp(log_w.numpy())
+        mu, sigma = mu.numpy(), np.exp(log_sigma.numpy())
+
+        low, high = self.bounds
+        samples = []
+        for i in range(len(data_list)):
+            draws = truncated_mixture_draws(weights[i], mu[i], sigma[i], n_draws, rng)
+            samples.append(low + draws * (high - low))
+        modes = low + np.clip(
+            mu[np.arange(len(data_list)), np.argmax(weights, axis=1)], 0, 1
+        ) * (high - low)
+        return np.asarray(samples), modes
+
+    def posterior_stats(self, data_list, n_draws=1000, seed=None):
+        """
+        Return the parameter statistics of each data set in the -err.json format.
+
+        Parameters
+        ----------
+        data_list : list
+            Q, R, dR[, dQ] columns of each data set
+        n_draws : int
+            Number of samples for each data set
+        seed : int
+            Seed for the random number generator
+        """
+        samples, modes = self.sample(data_list, n_draws=n_draws, seed=seed)
+        return [
+            model_utils.posterior_stats(self.names, points, best)
+            for points, best in zip(samples, modes)
+        ]
+
+    def save(self, file_path):
+        """
+        Save the estimator weights and settings.
+        """
+        torch.save(
+            dict(
+                names=self.names,
+                bounds=self.bounds,
+                q=self.q,
+                n_components=self.n_components,
+                hidden=self.hidden,
+                n_layers=self.n_layers,
+                offset=self.offset,
+                scale=self.scale,
+                state=self.network.state_dict(),
+            ),
+            file_path,
+        )
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        Load an estimator saved with save().
+        """
+        data = torch.load(file_path, map_location="cpu", weights_only=False)
+        estimator = cls(
+            data["names"],
+            data["bounds"],
+            data["q"],
+            n_components=data["n_components"],
+            hidden=data["hidden"],
+            n_layers=data["n_layers"],
+        )
+        estimator.offset = data["offset"]
+        estimator.scale = data["scale"]
+        estimator.network.load_state_dict(data["state"])
+        return estimator
+
+
+def load_or_train(problem, model_file, cache_dir, **kwargs):
+    """
+    Return the posterior estimator for a model, training it if it is not in the cache.
+
+    Parameters
+    ----------
+    problem : FitProblem
+        Problem loaded from the model file
+    model_file : str
+        refl1d model file
+    cache_dir : str
+        Directory where trained estimators are stored
+    kwargs : dict
+        Additional arguments passed to PosteriorEstimator.train
+    """
+    model_name = os.path.splitext(os.path.basename(model_file))[0]
+    cache_file = os.path.join(
+        cache_dir, f"{model_name}-posterior-{surrogate_key(model_file, problem)}.pt"
+    )
+    if os.path.isfile(cache_file):
+        return PosteriorEstimator.load(cache_file)
+
+    print(f"Training posterior estimator for {model_file}")
+    estimator = PosteriorEstimator.train(problem, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    estimator.save(cache_file)
+    return estimator
@@ -0,0 +1,156 @@
+"""
+Preparation of reduced reflectivity data before fitting.
+
+The model scripts, the fitting loop and the summary plots all read the
+time slices through prepare_data, so that they see the same points.
+"""
+
+import os
+import functools
+
+import numpy as np
+
+# Q range used by the model scripts
+Q_MIN = 0.0
+Q_MAX = 0.4
+
+# Relative Q resolution (FWHM) used when a data file has no dQ column
+DEFAULT_DQ_OVER_Q = 0.028
+
+# The resolution of the SNS data is given as a FWHM
+FWHM_TO_SIGMA = 1 / 2.35
+
+
+def read_data(data_file):
+    """
+    Read a reduced data file.
+
+    Parameters
+    ----------
+    data_file : str
+        File with Q, R, dR and, optionally, dQ (FWHM) columns
+
+    Returns
+    -------
+        array with Q, R, dR and dQ (FWHM) rows
+    """
+    data = np.loadtxt(data_file, ndmin=2)
+    if data.size == 0:
+        return np.empty((4, 0))
+    data = data.T
+    if len(data) < 4:
+        return np.vstack([data[:3], DEFAULT_DQ_OVER_Q * data[0]])
+    return data[:4]
+
+
+def select_points(data, q_min=Q_MIN, q_max=Q_MAX, drop_bad=True):
+    """
+    Keep the points within a Q range, and optionally drop those with dR >= R.
+
+    Parameters
+    ----------
+    data : array
+        Q, R, dR and dQ rows
+    q_min, q_max : float
+        Points with q_min < Q < q_max are kept
+    drop_bad : bool
+        If True, drop the points with no signal, for which dR >= R or dR <= 0
+
+    Returns
+    -------
+        array with the selected columns
+    """
+    q, r, dr = data[:3]
+    keep = (q > q_min) & (q < q_max)
+    if drop_bad:
+        keep &= (dr < r) & (dr > 0)
+    return data[:, keep]
+
+
+def rebin(data, dq_over_q):
+    """
+    Rebin data onto a logarithmic Q grid.
+
+    Points are combined with weights 1/dR^2. The resolution of each bin
+    includes the spread of the Q values it contains.
+
+    Parameters
+    ----------
+    data : array
+        Q, R, dR and dQ (1-sigma) rows, in increasing Q
+    dq_over_q : float
+        Relative width of the bins
+
+    Returns
+    -------
+        array with Q, R, dR and dQ (1-sigma) rows, without the empty bins
+    """
+    q, r, dr, dq = data
+    if len(q) < 2:
+        return data
+    n_bins = max(1, int(np.ceil(np.log(q[-1] / q[0]) / np.log1p(dq_over_q))))
+    edges = q[0] * (1 + dq_over_q) ** np.arange(n_bins + 1)
+    index = np.clip(np.searchsorted(edges, q, side="right") - 1, 0, n_bins - 1)
+
+    weights = 1 / dr**2
+    sum_w = np.bincount(index, weights, minlength=n_bins)
+    filled = sum_w > 0
+    sum_w = sum_w[filled]
+    q_bin = np.bincount(index, weights * q, minlength=n_bins)[filled] / sum_w
+    r_bin = np.bincount(index, weights * r, minlength=n_bins)[filled] / sum_w
+
+    # Spread of the Q values around the centre of their bin
+    centre = np.zeros(n_bins)
+    centre[filled] = q_bin
+    spread = dq**2 + (q - centre[index]) ** 2
+    dq_bin = np.sqrt(
+        np.bincount(index, weights * spread, minlength=n_bins)[filled] / sum_w
+    )
+    return np.vstack([q_bin, r_bin, 1 / np.sqrt(sum_w), dq_bin])
+
+
+@functools.lru_cache(maxsize=256)
+def _prepare(data_file, mtime, size, q_min, q_max, drop_bad, dq_over_q):
+    # The modification time and size are part of the key, so edited files are read again
+    data = select_points(read_data(data_file), q_min, q_max, drop_bad=drop_bad)
+    data[3] = data[3] * FWHM_TO_SIGMA
+    if dq_over_q:
+        data = rebin(data, dq_over_q)
+    data.setflags(write=False)
+    return data
+
+
+def prepare_data(data_file, q_min=Q_MIN, q_max=Q_MAX, drop_bad=True, dq_over_q=None):
+    """
+    Return the data points of a reduced data file that are used for fitting.
+
+    The points are selected in Q and the points without signal are dropped.
+    The resolution is converted from FWHM to a standard deviation, and the
+    data can be rebinned. Results are cached for each file.
+
+    Parameters
+    ----------
+    data_file : str
+        Reduced data file
+    q_min, q_max : float
+        Points with q_min < Q < q_max are kept
+    drop_bad : bool
+        If True, drop the points with dR >= R
+    dq_over_q : float
+        If given, rebin the data with this relative bin width
+
+    Returns
+    -------
+        array with Q, R, dR and dQ (1-sigma) rows
+    """
+    stat = os.stat(data_file)
+    data = _prepare(
+        os.path.abspath(data_file),
+        stat.st_mtime_ns,
+        stat.st_size,
+        q_min,
+        q_max,
+        drop_bad,
+        dq_over_q,
+    )
+    return data.copy()
@@ -0,0 +1,176 @@
+"""
+Content-addressed cache of fit results.
+
+Each fit is stored under a key computed from the contents of its inputs
+and from the fitting settings, so that a rerun can reuse the results of the
+data sets whose inputs did not change, whatever their file names.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+
+# Bytes read at a time when hashing a file
+_CHUNK_SIZE = 1 << 20
+
+
+def file_digest(file_path):
+    """
+    Return the SHA-256 digest of the contents of a file.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fit_key(files, settings):
+    """
+    Return the cache key of a fit.
+
+    Parameters
+    ----------
+    files : list
+        Input files of the fit, such as the data, model and starting state.
+        None may be given for an optional input that is not used.
+    settings : dict
+        Fitting settings that affect the result
+
+    Returns
+    -------
+        hexadecimal key
+    """
+    digest = hashlib.sha256()
+    for file_path in files:
+        digest.update(b"-" if file_path is None else file_digest(file_path).encode())
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def _tree_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+class FitCache:
+    """
+    Directory of fit results, keyed by fit_key, with a size limit.
+
+    When the cache grows past its limit, the entries that were used least
+    recently are removed.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            Directory holding the cached results
+        max_bytes : int
+            Largest total size of the cached results
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        """
+        Return the directory holding the results for a key.
+        """
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def restore(self, key, result_dir):
+        """
+        Copy the cached results for a key into a results directory.
+
+        The files are not hard-linked: refl1d and the fitting loop write their
+        outputs in place, which would also change the cached results.
+
+        Parameters
+        ----------
+        key : str
+            Cache key of the fit
+        result_dir : str
+            Results directory of the fit, which is replaced
+
+        Returns
+        -------
+            True if the key was found
+        """
+        entry = self.path(key)
+        if not os.path.isdir(entry):
+            return False
+        if os.path.isdir(result_dir):
+            shutil.rmtree(result_dir)
+        shutil.copytree(entry, result_dir)
+
+        # The modification time of an entry records when it was last used
+        os.utime(entry)
+        return True
+
+    def store(self, key, result_dir):
+        """
+        Copy the results of a fit into the cache, then enforce the size limit.
+
+        Parameters
+        ----------
+        key : str
+            Cache key of the fit
+        result_dir : str
+            Results directory of the fit
+        """
+        entry = self.path(key)
+        if os.path.isdir(entry):
+            os.utime(entry)
+            return
+
+        # Copy to a temporary directory first, so that an entry is never incomplete
+        staging = f"{entry}.{os.getpid()}.tmp"
+        shutil.copytree(result_dir, staging)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # Another process stored the same fit
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """
+        Return the path, last use and size of each entry, least recently used first.
+        """
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                if key.endswith(".tmp") or not os.path.isdir(entry):
+                    continue
+                entries.append((entry, os.path.getmtime(entry), _tree_size(entry)))
+        return sorted(entries, key=lambda item: item[1])
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits its size limit.
+
+        Returns
+        -------
+            number of entries removed
+        """
+        entries = self.entries()
+        total = sum(size for _, _, size in entries)
+        removed = 0
+        for entry, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
@@ -3,17 +3,38 @@
   This currently works for inverted geometry and fixed substrate roughness, as it aligns
   the profiles to that point before doing the statistics.
 """
-from refl1d import uncertainty as errors
+import itertools
+
 import numpy as np
 
+SQRT1_2 = 1.0 / np.sqrt(2.0)
+
+
+def get_sld_contour(problem, state, cl=90, npoints=200, trim=1000, portion=.3, index=1, align='auto',
+                    points=None):
+    """
+        Compute the SLD uncertainty band from a DREAM state, or from posterior
+        samples passed as points, with columns in the order of problem.labels().
+
+        Models made of slabs are computed with slab_contour when aligned on an
+        interface. Other models, and align='auto', go through refl1d.uncertainty.
+    """
+    if points is None:
+        points, _logp = state.sample(portion=portion)
+        points = points[-trim:-1]
+
+    if align != 'auto':
+        try:
+            return [slab_contour(problem, points, cl=cl, npoints=npoints, index=index, align=align)]
+        except ValueError:
+            pass
+
+    from refl1d import uncertainty as errors
 
-def get_sld_contour(problem, state, cl=90, npoints=200, trim=1000, portion=.3, index=1, align='auto'):
-    points, _logp = state.sample(portion=portion)
-    points = points[-trim:-1]
     original = problem.getp()
     _profiles, slabs, Q, residuals = errors.calc_errors(problem, points)
     problem.setp(original)
-    
+
     profiles = errors.align_profiles(_profiles, slabs, align)
 
     # Group 1 is rho
@@ -28,4 +49,211 @@ def get_sld_contour(problem, state, cl=90, npoints=200, trim=1000, portion=.3, i
         # Columns are z, best, low, high
         data, cols = errors._build_profile_matrix(group, index, zp, [cl])
         contours.append(data)
-    return contours
\ No newline at end of file
+    return contours
+
+
+def slab_values(problem, points):
+    """
+        Return the rho, irho, thickness and interface of each layer for a set of points.
+
+        Fitted parameters are read from the points directly, so the reflectivity
+        is never computed. Only parameters defined by an expression need the
+        model to be updated for each point.
+
+        :param problem: FitProblem with a single, non-magnetic, slab model.
+        :param points: Parameter values, with one row per point.
+        :return: Array of shape (points, layers, 4).
+    """
+    models = list(problem.models)
+    if len(models) != 1:
+        raise ValueError("Only single-model problems are supported")
+    layers = list(models[0].sample)
+    if any(not hasattr(getattr(layer, 'material', None), 'rho') or getattr(layer, 'magnetism', None) is not None
+           for layer in layers):
+        raise ValueError("Only non-magnetic slab models are supported")
+
+    points = np.atleast_2d(points)
+    labels = problem.labels()
+    values = np.empty((len(points), len(layers), 4))
+    deferred = []
+    for k, layer in enumerate(layers):
+        for m, par in enumerate([layer.material.rho, layer.material.irho, layer.thickness, layer.interface]):
+            if not par.fixed and par.name in labels:
+                values[:, k, m] = points[:, labels.index(par.name)]
+            elif par.fittable:
+                values[:, k, m] = par.value
+            else:
+                # Expressions and references to other parameters
+                deferred.append((k, m, par))
+
+    if deferred:
+        original = problem.getp()
+        for j, point in enumerate(points):
+            problem.setp(point)
+            for k, m, par in deferred:
+                values[j, k, m] = par.value
+        problem.setp(original)
+    return values
+
+
+def _find_offsets(thickness, align):
+    # Vectorized version of refl1d.uncertainty._find_offset, one row per point
+    idx = int(align)
+    return np.sum(thickness[:, :idx], axis=1) + np.sum((align - idx) * thickness[:, idx:idx + 1], axis=1)
+
+
+def slab_profiles(values, z, index=1, shift=None):
+    """
+        Compute the smooth SLD profiles of a set of slab models on a common z grid.
+        Interfaces are error functions, as in refl1d.
+
+        :param values: Array of shape (points, layers, 4), as returned by slab_values.
+        :param z: Common z grid.
+        :param index: 1 for rho, 2 for irho.
+        :param shift: Offset added to the z position of each model.
+        :return: Array of shape (points, len(z)).
+    """
+    from scipy.special import erf
+
+    sld = values[:, :, index - 1]
+    sigma = values[:, :-1, 3][:, :, None]
+    interfaces = np.cumsum(values[:, :-1, 2], axis=1)
+    if shift is not None:
+        interfaces = interfaces + shift[:, None]
+    delta = z[None, None, :] - interfaces[:, :, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        blend = np.where(sigma > 0, 0.5 * erf(SQRT1_2 * delta / np.where(sigma > 0, sigma, 1)) + 0.5,
+                         1.0 * (delta >= 0))
+    return sld[:, :1] + np.einsum('pi,piz->pz', np.diff(sld, axis=1), blend)
+
+
+def _slab_grid(problem, points, npoints=200, align=-1):
+    # Layer values of the best fit followed by the points, their alignment shift and the z grid
+    values = slab_values(problem, np.vstack([problem.getp(), points]))
+
+    # Align on the inner layers, as refl1d does
+    offsets = _find_offsets(values[:, 1:-1, 2], align)
+    shift = offsets[0] - offsets
+
+    # The profiles extend three roughness widths past the first and last interfaces
+    interfaces = np.cumsum(values[:, :-1, 2], axis=1) + shift[:, None]
+    z_min = np.min(interfaces[:, 0] - 3 * values[:, 0, 3])
+    z_max = np.max(interfaces[:, -1] + 3 * values[:, -2, 3])
+    return values, shift, np.linspace(z_min, z_max, npoints)
+
+
+def _band(profiles, cl):
+    # Low and high limits, with the same quantile estimator as refl1d._build_profile_matrix
+    from scipy.stats.mstats import mquantiles
+
+    return np.asarray(mquantiles(profiles, [(100 - cl) / 200, (100 + cl) / 200], axis=0))
+
+
+def slab_contour(problem, points, cl=90, npoints=200, index=1, align=-1):
+    """
+        Compute the SLD uncertainty band of a slab model for all points at once.
+
+        The profiles are aligned on the interface given by align, as in
+        refl1d.uncertainty.align_profiles, and the first row is the best fit.
+
+        :param problem: FitProblem with a single, non-magnetic, slab model, set to the best fit.
+        :param points: Posterior samples, with columns in the order of problem.labels().
+        :param cl: Confidence level, in percent.
+        :param npoints: Number of points on the z grid.
+        :param index: 1 for rho, 2 for irho.
+        :param align: Interface number plus fractional distance within the next layer.
+        :return: Array with rows z, best, low and high.
+    """
+    values, shift, zp = _slab_grid(problem, points, npoints=npoints, align=align)
+    profiles = slab_profiles(values, zp, index=index, shift=shift)
+    return np.vstack([zp, profiles[0], _band(profiles, cl)])
+
+
+def _slab_batches(problem, points, batch_size, npoints, index, align):
+    # Yield the number of draws and the profile matrix after each batch, for slab models
+    values, shift, zp = _slab_grid(problem, points, npoints=npoints, align=align)
+    profiles = slab_profiles(values[:1], zp, index=index, shift=shift[:1])
+    for start in range(1, len(values), batch_size):
+        stop = start + batch_size
+        batch = slab_profiles(values[start:stop], zp, index=index, shift=shift[start:stop])
+        profiles = np.vstack([profiles, batch])
+        yield len(profiles) - 1, [(zp, profiles)]
+
+
+def _refl1d_batches(problem, points, batch_size, npoints, index, align):
+    # Yield the number of draws and the profile matrix of each model after each batch
+    from refl1d import uncertainty as errors
+
+    original = problem.getp()
+    groups = dict()
+    n_draws = 0
+    for start in range(0, len(points), batch_size):
+        batch = points[start:start + batch_size]
+        _profiles, slabs, Q, residuals = errors.calc_errors(problem, batch)
+        problem.setp(original)
+
+        # Each batch starts with the best fit, which is only kept once.
+        # The model keys are new objects for each call, so models are matched by position.
+        for k, group in enumerate(errors.align_profiles(_profiles, slabs, align).values()):
+            groups[k] = groups.get(k, group[:1]) + group[1:]
+        n_draws += len(batch)
+
+        matrices = []
+        for group in groups.values():
+            z = np.hstack([line[0] for line in group])
+            zp = np.linspace(np.min(z), np.max(z), npoints)
+            matrices.append((zp, np.vstack([np.interp(zp, line[0], line[index]) for line in group])))
+        yield n_draws, matrices
+
+
+def adaptive_sld_contour(problem, state, cl=90, npoints=200, portion=.3, index=1, align=-1, points=None,
+                         tolerance=0.02, batch_size=100, max_draws=None, seed=None):
+    """
+        Compute the SLD uncertainty band using only as many posterior draws as needed.
+
+        Random draws are added in batches until the low and high limits of the band
+        change by less than the tolerance when a batch is added.
+
+        :param problem: FitProblem set to the best fit.
+        :param state: DREAM state, used when points is not given.
+        :param cl: Confidence level, in percent.
+        :param npoints: Number of points on the z grid.
+        :param portion: Portion of the chain to draw from.
+        :param index: 1 for rho, 2 for irho.
+        :param align: Interface to align the profiles on, or 'auto'.
+        :param points: Posterior samples, with columns in the order of problem.labels().
+        :param tolerance: Largest change of the band limits, in SLD units, to stop adding draws.
+        :param batch_size: Number of draws added at each step.
+        :param max_draws: Maximum number of draws. All the samples are available by default.
+        :param seed: Seed for the random order of the draws.
+        :return: List of arrays with rows z, best, low and high, and the number of draws used.
+    """
+    if points is None:
+        points, _logp = state.sample(portion=portion)
+    rng = np.random.default_rng(seed)
+    points = np.asarray(points)[rng.permutation(len(points))[:max_draws]]
+
+    batches = None
+    if align != 'auto':
+        try:
+            batches = _slab_batches(problem, points, batch_size, npoints, index, align)
+            first = next(batches)
+        except ValueError:
+            batches = None
+    if batches is None:
+        batches = _refl1d_batches(problem, points, batch_size, npoints, index, align)
+        first = next(batches)
+
+    previous = None
+    for n_draws, matrices in itertools.chain([first], batches):
+        limits = [(zp, _band(profiles, cl)) for zp, profiles in matrices]
+        if previous is not None:
+            change = max(np.max(np.abs(np.vstack([np.interp(zp, z0, row) for row in band0]) - band))
+                         for (z0, band0), (zp, band) in zip(previous, limits))
+            if change < tolerance:
+                break
+        previous = limits
+    batches.close()
+
+    contours = [np.vstack([zp, profiles[0], band]) for (zp, profiles), (_, band) in zip(matrices, limits)]
+    return contours, n_draws
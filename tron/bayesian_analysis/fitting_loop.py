@@ -3,13 +3,161 @@ Fitting loop for time-resolved data sets.
 """
 
 import os
+import sys
 import time
 import json
+import signal
 import subprocess
+import collections
 import shutil
-from typing import List, Optional, Dict, Any
+import threading
+import warnings
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Dict, Any, Tuple
 
-from . import model_utils
+from . import (
+    data_preparation,
+    fit_cache,
+    freezing,
+    model_utils,
+    results_archive,
+    sequential_filter,
+)
+
+# Environment variables controlling the number of BLAS/OpenMP threads
+THREAD_VARIABLES: List[str] = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+# Number of lines at the end of a refl1d log kept with the process result
+LOG_TAIL_LINES: int = 50
+
+# Time, in seconds, between checks for the timeout or cancellation of a refl1d process
+POLL_TIME: float = 1.0
+
+# Largest difference between the re-weighted posterior mean of a data set and the
+# mean found by its verification chain, in units of the posterior width
+VERIFY_ZSCORE: float = 3.0
+
+# Fitting options that do not change the result of a fit, left out of the fit cache key
+CACHE_IGNORED: List[str] = [
+    "cores",
+    "global_processes",
+    "fit_cache_dir",
+    "fit_cache_max_gb",
+    "archive_results",
+    "fit_timeout",
+    "fit_retries",
+]
+
+# Fitting options saved along with the results, with their default values
+FIT_OPTIONS: Dict[str, Any] = dict(
+    cores=None,
+    compact_posterior=False,
+    posterior_draws=1000,
+    keep_chains=True,
+    covariance_prior=False,
+    predictor=False,
+    predictor_order=1,
+    predictor_window=3,
+    engine="dream",
+    dream_burn=1000,
+    dream_steps=1000,
+    change_budget=False,
+    change_reuse=1.5,
+    change_full=10.0,
+    budget_min_fraction=0.25,
+    reuse_min_ess=0.1,
+    verify_steps=100,
+    coarse_stride=0,
+    fine_burn=None,
+    fidelity_decimate=1,
+    fidelity_burn=100,
+    fidelity_check_every=0,
+    freeze=False,
+    freeze_after=3,
+    freeze_max_shift=1.0,
+    freeze_max_drift=0.5,
+    freeze_max_correlation=0.3,
+    fit_cache_dir=None,
+    fit_cache_max_gb=10.0,
+    archive_results=False,
+    fit_timeout=None,
+    fit_retries=1,
+    filter_members=64,
+    filter_process_noise=1.0,
+    filter_iterations=4,
+    filter_flag_chisq=3.0,
+    lm_steps=200,
+    dream_every=0,
+    dream_chisq_jump=0.0,
+    dream_last=0,
+    surrogate=False,
+    surrogate_burn=200,
+    surrogate_dir=None,
+    amortized_validate_every=0,
+    global_knots=5,
+    global_static=None,
+    global_processes=None,
+)
+
+
+def _mtime(file_path: str) -> Optional[int]:
+    # Modification time of a file, or None if it does not exist
+    try:
+        return os.stat(file_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def thread_env(threads: int = 1) -> Dict[str, str]:
+    """
+    Return a copy of the environment with the BLAS/OpenMP thread count pinned.
+
+    Parameters
+    ----------
+    threads : int, optional
+        Number of threads allowed in each process (default: 1).
+
+    Returns
+    -------
+    dict
+        Environment for a child process.
+
+    """
+    env = dict(os.environ)
+    for variable in THREAD_VARIABLES:
+        env[variable] = str(threads)
+    return env
+
+
+def split_cores(cores: Optional[int], n_tasks: int) -> Tuple[int, Optional[int]]:
+    """
+    Split a core budget between tasks that can run concurrently.
+
+    Parameters
+    ----------
+    cores : int, optional
+        Total number of cores. If None, tasks run one at a time without a budget.
+    n_tasks : int
+        Number of tasks.
+
+    Returns
+    -------
+    tuple
+        Number of concurrent tasks and number of cores for each task.
+
+    """
+    if cores is None or n_tasks < 1:
+        return 1, cores
+    per_task = max(1, cores // n_tasks)
+    return max(1, min(n_tasks, cores // per_task)), per_task
 
 
 class FittingLoop:
@@ -17,128 +165,1927 @@ class FittingLoop:
     Class representing a fitting loop for time-resolved data sets.
     """
 
-    def __init__(
+    def __init__(
+        self,
+        dyn_data_dir: str,
+        results_dir: str,
+        model_dir: Optional[str] = None,
+        model_name: str = "__model",
+        initial_err_file: Optional[str] = None,
+        initial_expt_file: Optional[str] = None,
+        final_err_file: Optional[str] = None,
+        final_expt_file: Optional[str] = None,
+        covariance_prior: bool = False,
+        cores: Optional[int] = None,
+        compact_posterior: bool = False,
+        posterior_draws: int = 1000,
+        keep_chains: bool = True,
+        predictor: bool = False,
+        predictor_order: int = 1,
+        predictor_window: int = 3,
+        engine: str = "dream",
+        dream_burn: int = 1000,
+        dream_steps: int = 1000,
+        change_budget: bool = False,
+        change_reuse: float = 1.5,
+        change_full: float = 10.0,
+        budget_min_fraction: float = 0.25,
+        reuse_min_ess: float = 0.1,
+        verify_steps: int = 100,
+        coarse_stride: int = 0,
+        fine_burn: Optional[int] = None,
+        fidelity_decimate: int = 1,
+        fidelity_burn: int = 100,
+        fidelity_check_every: int = 0,
+        freeze: bool = False,
+        freeze_after: int = 3,
+        freeze_max_shift: float = 1.0,
+        freeze_max_drift: float = 0.5,
+        freeze_max_correlation: float = 0.3,
+        fit_cache_dir: Optional[str] = None,
+        fit_cache_max_gb: float = 10.0,
+        archive_results: bool = False,
+        fit_timeout: Optional[float] = None,
+        fit_retries: int = 1,
+        filter_members: int = 64,
+        filter_process_noise: float = 1.0,
+        filter_iterations: int = 4,
+        filter_flag_chisq: float = 3.0,
+        lm_steps: int = 200,
+        dream_every: int = 0,
+        dream_chisq_jump: float = 0.0,
+        dream_last: int = 0,
+        surrogate: bool = False,
+        surrogate_burn: int = 200,
+        surrogate_dir: Optional[str] = None,
+        amortized_validate_every: int = 0,
+        global_knots: int = 5,
+        global_static: Optional[List[str]] = None,
+        global_processes: Optional[int] = None,
+    ) -> None:
+        """
+        Initialize the FittingLoop object.
+
+        Parameters
+        ----------
+        dyn_data_dir : str
+            Directory where the dynamic data is stored.
+        results_dir : str
+            Directory where the results will be stored.
+        model_dir : str, optional
+            Directory where the model is stored.
+        model_name : str, optional
+            Name of the model file.
+        initial_err_file : str, optional
+            File path of the initial error file.
+        initial_expt_file : str, optional
+            File path of the initial experiment file.
+        final_err_file : str, optional
+            File path of the final error file.
+        final_expt_file : str, optional
+            File path of the final experiment file.
+        covariance_prior : bool, optional
+            If True, the posterior covariance of each fit is used as a
+            correlated prior for the next one. Only the DREAM fits of the
+            sequential engines save a covariance: with engine="lm", the fits
+            are done without the correlated prior (default: False).
+        cores : int, optional
+            Number of cores the loop may use. DREAM evaluates its population
+            on that many worker processes, BLAS/OpenMP libraries are limited
+            to one thread per process, and the budget is split when several
+            fits run concurrently (default: None, no budget).
+        compact_posterior : bool, optional
+            If True, save a thinned float32 posterior sample after each DREAM
+            fit, which is used in place of the full chains (default: False).
+        posterior_draws : int, optional
+            Number of samples kept in the compact posterior (default: 1000).
+        keep_chains : bool, optional
+            If False, delete the full DREAM chains once the compact posterior
+            is saved (default: True).
+        predictor : bool, optional
+            If True, the starting point and prior centre of each fit are
+            extrapolated from the previous fits (default: False).
+        predictor_order : int, optional
+            Order of the polynomial in time used for the extrapolation (default: 1).
+        predictor_window : int, optional
+            Number of previous fits used for the extrapolation (default: 3).
+        engine : str, optional
+            Fitting engine, either "dream" to run a DREAM fit for each data set,
+            "filter" to use an ensemble Kalman filter and only run DREAM on
+            the data sets it flags, "lm" to run a Levenberg-Marquardt fit
+            for each data set followed by DREAM on a selection of them, or
+            "amortized" to estimate all posteriors at once with a trained
+            network, or "global" to fit all data sets jointly with splines in
+            time (default: "dream").
+        dream_burn : int, optional
+            Number of DREAM burn-in steps (default: 1000).
+        dream_steps : int, optional
+            Number of DREAM sampling steps (default: 1000).
+        change_budget : bool, optional
+            If True, the DREAM budget of each data set is scaled with its change
+            from the previous data set, as measured by model_utils.change_statistic.
+            Data sets that did not change are fit by re-weighting the previous
+            posterior and running a short verification chain (default: False).
+        change_reuse : float, optional
+            Change below which the previous posterior is re-weighted (default: 1.5).
+        change_full : float, optional
+            Change above which the full DREAM budget is used (default: 10).
+        budget_min_fraction : float, optional
+            Fraction of the DREAM budget used for the smallest changes that
+            are fit (default: 0.25).
+        reuse_min_ess : float, optional
+            Smallest effective sample size of the re-weighted posterior, as a
+            fraction of the number of samples, for it to be used (default: 0.1).
+        verify_steps : int, optional
+            Number of burn-in and sampling steps of the verification chain (default: 100).
+        coarse_stride : int, optional
+            With the "dream" engine, if larger than 1, fit every Nth data set
+            first, starting from the nearer steady state, then fill in the data
+            sets in between by halving the stride, starting each fit from the
+            interpolation of its fitted neighbours. The fits of each level run
+            concurrently (default: 0, data sets are fit in time order).
+        fine_burn : int, optional
+            Number of DREAM burn-in steps for the data sets started from an
+            interpolation (default: dream_burn).
+        fidelity_decimate : int, optional
+            If larger than 1, the DREAM burn-in runs on every Nth Q point of the
+            data, and the fit is then continued on the full data from the best
+            point found, with a burn-in of fidelity_burn steps. Only the Q points
+            are decimated, the model is computed as for the full data
+            (default: 1, off).
+        fidelity_burn : int, optional
+            Number of burn-in steps on the full data after the decimated
+            burn-in (default: 100).
+        fidelity_check_every : int, optional
+            With fidelity_decimate, also fit every Nth data set on the full data
+            only and save the comparison in a -fidelity-check.json file
+            (default: 0, none).
+        freeze : bool, optional
+            With the "dream" engine, freeze the parameters that the steady states
+            agree on and that are stable and uncorrelated with the evolving
+            parameters over the first data sets. The decision is saved in
+            frozen-parameters.json, along with estimates of the normalization
+            and background of each data set, which are frozen if the model
+            fits them (default: False).
+        freeze_after : int, optional
+            Number of data sets to fit before selecting the frozen parameters
+            (default: 3). With 0, the selection only uses the steady states.
+        freeze_max_shift : float, optional
+            Largest change of a frozen parameter between the steady states, in
+            units of their combined uncertainty (default: 1).
+        freeze_max_drift : float, optional
+            Largest spread of the posterior means of a frozen parameter over the
+            fitted data sets, in units of its posterior width (default: 0.5).
+        freeze_max_correlation : float, optional
+            Largest posterior correlation of a frozen parameter with an evolving
+            parameter (default: 0.3).
+        fit_cache_dir : str, optional
+            With the "dream" engine, directory where fit results are cached,
+            keyed by the contents of the data set, model file and starting
+            state, and by the fitting options. Data sets whose key is found
+            are not fit again, and their cached results are copied into the
+            results directory (default: None, no cache).
+        fit_cache_max_gb : float, optional
+            Size limit of the fit cache, in GB. The results used least recently
+            are removed first (default: 10).
+        archive_results : bool, optional
+            If True, the outputs of each fit are moved to a single archive in
+            the results directory as soon as the fit is done. The other files
+            written by refl1d, such as the plots, and the sub-directories of
+            the fit are left in place. See results_archive for the files that
+            are archived (default: False).
+        fit_timeout : float, optional
+            Wall-clock time limit of each refl1d process, in seconds. A process
+            that runs longer is killed (default: None, no limit).
+        fit_retries : int, optional
+            Number of times a failed refl1d process is started again, with a
+            different random seed. Data sets that still fail are skipped, and
+            listed in a failed-fits.json file in the results directory
+            (default: 1).
+        filter_members : int, optional
+            Number of members in the filter ensemble (default: 64).
+        filter_process_noise : float, optional
+            Width of the parameter random walk between two data sets, in units
+            of the minimum prior width of each parameter (default: 1).
+        filter_iterations : int, optional
+            Number of filter updates for each data set (default: 4).
+        filter_flag_chisq : float, optional
+            Data sets for which the filter reaches a chi^2 above this value
+            are fit with DREAM (default: 3).
+        lm_steps : int, optional
+            Maximum number of Levenberg-Marquardt iterations (default: 200).
+        dream_every : int, optional
+            With the "lm" engine, fit every Nth data set with DREAM (default: 0, none).
+        dream_chisq_jump : float, optional
+            With the "lm" engine, fit with DREAM the data sets for which chi^2
+            increases by more than this factor compared to the previous data
+            set (default: 0, none).
+        dream_last : int, optional
+            With the "lm" engine, fit the last N data sets with DREAM (default: 0).
+        surrogate : bool, optional
+            If True, a neural network surrogate of the model is used to find the
+            starting point of each DREAM fit, which then uses a shorter burn-in
+            (default: False).
+        surrogate_burn : int, optional
+            Number of DREAM burn-in steps after the surrogate pre-screening (default: 200).
+        surrogate_dir : str, optional
+            Directory where trained surrogates and posterior estimators are
+            cached (default: a surrogates directory next to the model file).
+        amortized_validate_every : int, optional
+            With the "amortized" engine, fit every Nth data set with DREAM to
+            validate the estimated posteriors (default: 0, none).
+        global_knots : int, optional
+            With the "global" engine, number of spline coefficients for each
+            time-varying parameter (default: 5).
+        global_static : list, optional
+            With the "global" engine, names of the parameters shared by all
+            data sets (default: none).
+        global_processes : int, optional
+            With the "global" engine, number of worker processes (default:
+            the core budget, or the number of CPUs).
+
+        """
+        self.fit_forward: bool = True
+        self.dyn_file_list: List[str] = []
+        self.model_dir: Optional[str] = model_dir
+        self.model_name: str = model_name
+        self.dyn_data_dir: str = dyn_data_dir
+        self.results_dir: str = results_dir
+        self.initial_err_file: Optional[str] = initial_err_file
+        self.initial_expt_file: Optional[str] = initial_expt_file
+        self.final_err_file: Optional[str] = final_err_file
+        self.final_expt_file: Optional[str] = final_expt_file
+        self.covariance_prior: bool = covariance_prior
+        self.cores: Optional[int] = cores
+        self.compact_posterior: bool = compact_posterior
+        self.posterior_draws: int = posterior_draws
+        self.keep_chains: bool = keep_chains
+        self.predictor: bool = predictor
+        self.predictor_order: int = predictor_order
+        self.predictor_window: int = predictor_window
+        self.engine: str = engine
+        self.dream_burn: int = dream_burn
+        self.dream_steps: int = dream_steps
+        self.change_budget: bool = change_budget
+        self.change_reuse: float = change_reuse
+        self.change_full: float = change_full
+        self.budget_min_fraction: float = budget_min_fraction
+        self.reuse_min_ess: float = reuse_min_ess
+        self.verify_steps: int = verify_steps
+        self.coarse_stride: int = coarse_stride
+        self.fine_burn: Optional[int] = fine_burn
+        self.fidelity_decimate: int = fidelity_decimate
+        self.fidelity_burn: int = fidelity_burn
+        self.fidelity_check_every: int = fidelity_check_every
+        self.freeze: bool = freeze
+        self.freeze_after: int = freeze_after
+        self.freeze_max_shift: float = freeze_max_shift
+        self.freeze_max_drift: float = freeze_max_drift
+        self.freeze_max_correlation: float = freeze_max_correlation
+        self.fit_cache_dir: Optional[str] = fit_cache_dir
+        self.fit_cache_max_gb: float = fit_cache_max_gb
+        self.archive_results: bool = archive_results
+        self.fit_timeout: Optional[float] = fit_timeout
+        self.fit_retries: int = fit_retries
+        self.filter_members: int = filter_members
+        self.filter_process_noise: float = filter_process_noise
+        self.filter_iterations: int = filter_iterations
+        self.filter_flag_chisq: float = filter_flag_chisq
+        self.lm_steps: int = lm_steps
+        self.dream_every: int = dream_every
+        self.dream_chisq_jump: float = dream_chisq_jump
+        self.dream_last: int = dream_last
+        self.surrogate: bool = surrogate
+        self.surrogate_burn: int = surrogate_burn
+        self.surrogate_dir: Optional[str] = surrogate_dir
+        self.amortized_validate_every: int = amortized_validate_every
+        self.global_knots: int = global_knots
+        self.global_static: Optional[List[str]] = global_static
+        self.global_processes: Optional[int] = global_processes
+        self.dream_slices: List[str] = []
+        self.fit_budgets: Dict[str, Dict[str, Any]] = dict()
+        self.frozen: Dict[str, float] = dict()
+        self.frozen_nuisance: Dict[str, Dict[str, float]] = dict()
+        self.failed_fits: Dict[str, Dict[str, Any]] = dict()
+        self.last_output: str = ""
+        # Set from another thread to kill the running refl1d process
+        self.cancel_event: Optional[threading.Event] = None
+        self._filter: Optional[sequential_filter.EnsembleFilter] = None
+        self._surrogate = None
+        self._fit_cache: Optional[fit_cache.FitCache] = None
+
+    def save(self, file_path: str) -> None:
+        """
+        Save all the settings to a file.
+
+        Parameters
+        ----------
+        file_path : str
+            File path to save the settings.
+
+        """
+        meta_data: Dict[str, Any] = dict(
+            model_dir=self.model_dir,
+            model_name=self.model_name,
+            dyn_data_dir=self.dyn_data_dir,
+            results_dir=self.results_dir,
+            initial_err_file=self.initial_err_file,
+            initial_expt_file=self.initial_expt_file,
+            final_err_file=self.final_err_file,
+            final_expt_file=self.final_expt_file,
+            dyn_file_list=self.dyn_file_list,
+            fit_forward=self.fit_forward,
+        )
+        meta_data.update({k: getattr(self, k) for k in FIT_OPTIONS})
+        with open(file_path, "w") as fd:
+            json.dump(meta_data, fd)
+
+    def load(self, file_path: str) -> None:
+        """
+        Load settings from a file.
+
+        Parameters
+        ----------
+        file_path : str
+            File path to load the settings from.
+
+        """
+        with open(file_path, "r") as fd:
+            meta_data = json.load(fd)
+        self.model_dir = meta_data["model_dir"]
+        self.model_name = meta_data["model_name"]
+        self.dyn_data_dir = meta_data["dyn_data_dir"]
+        self.results_dir = meta_data["results_dir"]
+        self.initial_err_file = meta_data["initial_err_file"]
+        self.initial_expt_file = meta_data["initial_expt_file"]
+        self.final_err_file = meta_data["final_err_file"]
+        self.final_expt_file = meta_data["final_expt_file"]
+        self.fit_forward = meta_data["fit_forward"]
+        self.dyn_file_list = meta_data["dyn_file_list"]
+        for key, default in FIT_OPTIONS.items():
+            setattr(self, key, meta_data.get(key, default))
+
+    def __str__(self) -> str:
+        """
+        Return a string representation of the FittingLoop object.
+
+        Returns
+        -------
+        str
+            String representation of the FittingLoop object.
+
+        """
+        return (
+            f"Model: {os.path.join(self.model_dir, self.model_name)}\n"
+            f"Data: {self.dyn_data_dir}\n"
+            f"Results: {self.results_dir}\n"
+            f"Initial state: {self.initial_expt_file}\n"
+            f"Final state: {self.final_expt_file}"
+        )
+
+    def print_initial_final(self) -> None:
+        """
+        Print the initial and final models.
+        """
+        print(self)
+        with open(self.initial_err_file, "r") as fd:
+            initial_model = json.load(fd)
+        with open(self.final_err_file, "r") as fd:
+            final_model = json.load(fd)
+        model_utils.print_model(initial_model, final_model)
+
+    def save_covariance(self, base_name: str) -> str:
+        """
+        Estimate the posterior covariance of a fit and save it next to its results.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+
+        Returns
+        -------
+        str
+            File path of the -cov.json file.
+
+        """
+        model_path = os.path.join(self.results_dir, base_name, self.model_name)
+        if model_utils.has_posterior(model_path):
+            cov = model_utils.covariance_from_points(
+                *model_utils.load_posterior(model_path)
+            )
+        else:
+            from bumps.dream.state import load_state
+
+            cov = model_utils.covariance_from_state(load_state(model_path))
+
+        cov_file = f"{model_path}-cov.json"
+        with open(cov_file, "w") as fd:
+            json.dump(cov, fd)
+        return cov_file
+
+    def predict(
+        self,
+        base_name: str,
+        times: List[float],
+        models: List[Dict[str, Any]],
+        last_expt: str,
+        last_cov: Optional[str],
+    ) -> Tuple[str, Optional[str]]:
+        """
+        Extrapolate the previous fits to the time of the next data set.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the next fit.
+        times : list
+            Time of each previous fit.
+        models : list
+            Content of the -err.json file of each previous fit.
+        last_expt : str
+            File path of the -expt.json file of the last fit.
+        last_cov : str, optional
+            File path of the -cov.json file of the last fit.
+
+        Returns
+        -------
+        tuple
+            File paths of the predicted -expt.json and -cov.json files.
+
+        """
+        values = model_utils.predict_parameters(
+            times[-self.predictor_window :],
+            models[-self.predictor_window :],
+            self.file_time(base_name),
+            order=self.predictor_order,
+        )
+
+        model_path = os.path.join(self.results_dir, base_name, self.model_name)
+        os.makedirs(os.path.dirname(model_path), exist_ok=True)
+
+        predicted_expt = f"{model_path}-predicted-expt.json"
+        values = model_utils.predicted_expt_file(last_expt, values, predicted_expt)
+
+        predicted_cov = None
+        if last_cov is not None:
+            cov = results_archive.load_json(last_cov)
+            predicted_cov = f"{model_path}-predicted-cov.json"
+            with open(predicted_cov, "w") as fd:
+                json.dump(model_utils.recenter_covariance(cov, values), fd)
+
+        return predicted_expt, predicted_cov
+
+    @staticmethod
+    def file_time(file_name: str) -> int:
+        """
+        Return the time encoded in the name of a time-resolved data file.
+
+        Parameters
+        ----------
+        file_name : str
+            Data file name, of the form r<run>_t<time>.txt
+
+        Returns
+        -------
+        int
+            Time of the data set.
+
+        """
+        _base_name, _ = os.path.splitext(os.path.basename(file_name))
+        return int(_base_name.split("_t")[-1])
+
+    def run_dream(
+        self,
+        base_name: str,
+        data_file: str,
+        starting_expt: str,
+        starting_err: str,
+        starting_cov: Optional[str] = None,
+        burn: Optional[int] = None,
+        cores: Optional[int] = None,
+        steps: Optional[int] = None,
+    ) -> bool:
+        """
+        Fit a data set with DREAM, using the refl1d command line.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+        data_file : str
+            File path of the data set to fit.
+        starting_expt : str
+            File path of the starting -expt.json file.
+        starting_err : str
+            File path of the -err.json file used for the prior.
+        starting_cov : str, optional
+            File path of the -cov.json file used for a correlated prior.
+        burn : int, optional
+            Number of burn-in steps, if different from dream_burn.
+        cores : int, optional
+            Number of cores for the fit, if different from the loop budget.
+        steps : int, optional
+            Number of sampling steps, if different from dream_steps.
+
+        Returns
+        -------
+        bool
+            True if the fit succeeded. A failed fit is recorded in failed_fits.
+
+        """
+        burn = self.dream_burn if burn is None else burn
+        steps = self.dream_steps if steps is None else steps
+        cores = self.cores if cores is None else cores
+
+        fit_expt, fit_burn = starting_expt, burn
+        if self.fidelity_decimate > 1 and burn > self.fidelity_burn:
+            fit_expt = self.decimated_burn_in(
+                base_name,
+                data_file,
+                starting_expt,
+                starting_err,
+                starting_cov,
+                burn,
+                cores,
+            )
+            fit_burn = self.fidelity_burn
+
+        self.last_output = self.dream_process(
+            base_name,
+            data_file,
+            fit_expt,
+            starting_err,
+            starting_cov,
+            burn=fit_burn,
+            steps=steps,
+            cores=cores,
+        )
+        if self.last_output.returncode != 0:
+            self.failed_fits[base_name] = dict(
+                returncode=self.last_output.returncode,
+                log=self.log_file(base_name),
+            )
+            print(
+                f"    DREAM fit of {base_name} failed, see {self.log_file(base_name)}"
+            )
+            return False
+        self.dream_slices.append(base_name)
+
+        if self.compact_posterior:
+            self.save_posterior(base_name)
+
+        if (
+            fit_burn != burn
+            and self.fidelity_check_every > 0
+            and (len(self.dream_slices) - 1) % self.fidelity_check_every == 0
+        ):
+            self.check_fidelity(
+                base_name,
+                data_file,
+                starting_expt,
+                starting_err,
+                starting_cov,
+                burn,
+                steps,
+                cores,
+            )
+        return True
+
+    def log_file(self, base_name: str) -> str:
+        """
+        Return the file path of the refl1d output of a fit.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+
+        Returns
+        -------
+        str
+            File path of the -dream.log file.
+
+        """
+        return os.path.join(self.results_dir, base_name, f"{self.model_name}-dream.log")
+
+    def dream_process(
+        self,
+        base_name: str,
+        data_file: str,
+        starting_expt: str,
+        starting_err: str,
+        starting_cov: Optional[str],
+        burn: int,
+        steps: int,
+        cores: Optional[int],
+    ) -> subprocess.CompletedProcess:
+        """
+        Run the refl1d command line for a DREAM fit.
+
+        The output of refl1d is written to the -dream.log file of the fit. A
+        process that fails, that runs longer than fit_timeout or that does not
+        write its -err.json file is started again with a different random
+        seed, up to fit_retries times.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+        data_file : str
+            File path of the data set to fit.
+        starting_expt : str
+            File path of the starting -expt.json file.
+        starting_err : str
+            File path of the -err.json file used for the prior.
+        starting_cov : str, optional
+            File path of the -cov.json file used for a correlated prior.
+        burn : int
+            Number of burn-in steps.
+        steps : int
+            Number of sampling steps.
+        cores : int, optional
+            Number of cores for the fit.
+
+        Returns
+        -------
+        CompletedProcess
+            Last refl1d process, with a non-zero return code if the fit failed
+            and the end of the log as stderr.
+
+        """
+        # refl1d runs in the same environment as the fitting loop
+        command = [
+            sys.executable,
+            "-m",
+            "refl1d.main",
+            "--fit=dream",
+            f"--steps={steps}",
+            f"--burn={burn}",
+            "--batch",
+            "--overwrite",
+            f"--store={os.path.join(self.results_dir, base_name)}",
+            os.path.join(self.model_dir, f"{self.model_name}.py"),
+            data_file,
+            starting_expt,
+            starting_err,
+        ]
+        frozen_file = self.frozen_file(data_file)
+        if starting_cov is not None or frozen_file is not None:
+            command.append(starting_cov or "none")
+        if frozen_file is not None:
+            command.append(frozen_file)
+
+        env = None
+        if cores is not None:
+            env = thread_env(1)
+            if cores > 1:
+                command.insert(3, f"--parallel={cores}")
+
+        store = os.path.join(self.results_dir, base_name)
+        os.makedirs(store, exist_ok=True)
+        log_file = self.log_file(base_name)
+        err_file = os.path.join(store, f"{self.model_name}-err.json")
+        rng = np.random.default_rng()
+
+        returncode, attempt_command = None, command
+        for attempt in range(self.fit_retries + 1):
+            if self.cancelled():
+                break
+            attempt_command = list(command)
+            if attempt > 0:
+                attempt_command.insert(3, f"--seed={rng.integers(2**31 - 1)}")
+            # An earlier result, such as a Levenberg-Marquardt fit, is kept on failure
+            previous_err = _mtime(err_file)
+
+            with open(log_file, "a") as fd:
+                fd.write(f"# Attempt {attempt + 1}: {' '.join(attempt_command)}\n")
+                fd.flush()
+                process = subprocess.Popen(
+                    attempt_command,
+                    stdout=fd,
+                    stderr=subprocess.STDOUT,
+                    env=env,
+                    start_new_session=True,
+                )
+                killed = self.wait_process(process)
+                returncode = process.returncode
+                if killed is not None:
+                    fd.write(f"# {killed}\n")
+                elif returncode == 0 and _mtime(err_file) in (None, previous_err):
+                    returncode = 1
+                    fd.write(f"# No {os.path.basename(err_file)} file written\n")
+            if returncode == 0 or self.cancelled():
+                break
+
+        tail = ""
+        if os.path.isfile(log_file):
+            with open(log_file, "r") as fd:
+                tail = "".join(collections.deque(fd, maxlen=LOG_TAIL_LINES))
+        return subprocess.CompletedProcess(attempt_command, returncode, "", tail)
+
+    def cancelled(self) -> bool:
+        """
+        Return True if the fits were cancelled through cancel_event.
+        """
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def wait_process(self, process: subprocess.Popen) -> Optional[str]:
+        """
+        Wait for a refl1d process, killing it on timeout or cancellation.
+
+        Parameters
+        ----------
+        process : Popen
+            refl1d process, started in its own process group.
+
+        Returns
+        -------
+        str
+            Reason the process was killed, or None if it finished.
+
+        """
+        deadline = None
+        if self.fit_timeout is not None:
+            deadline = time.monotonic() + self.fit_timeout
+        while True:
+            timeout = POLL_TIME
+            if deadline is not None:
+                timeout = min(timeout, max(deadline - time.monotonic(), 0))
+            try:
+                process.wait(timeout=timeout)
+                return None
+            except subprocess.TimeoutExpired:
+                pass
+
+            if self.cancelled():
+                reason = "Cancelled"
+            elif deadline is not None and time.monotonic() >= deadline:
+                reason = f"Timed out after {self.fit_timeout} s"
+            else:
+                continue
+            # The process group also holds the workers of a parallel fit
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                # The process exited since the last check
+                pass
+            process.wait()
+            return reason
+
+    def decimated_burn_in(
+        self,
+        base_name: str,
+        data_file: str,
+        starting_expt: str,
+        starting_err: str,
+        starting_cov: Optional[str],
+        burn: int,
+        cores: Optional[int],
+    ) -> str:
+        """
+        Run the DREAM burn-in on every fidelity_decimate-th Q point of a data set.
+
+        Only the data is decimated: the model script computes the reflectivity
+        of the remaining Q points with its usual resolution, and the models
+        created by template.create_model do not oversample it. The fit is
+        stored in a decimated sub-directory of the results.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+        data_file : str
+            File path of the data set to fit.
+        starting_expt : str
+            File path of the starting -expt.json file.
+        starting_err : str
+            File path of the -err.json file used for the prior.
+        starting_cov : str, optional
+            File path of the -cov.json file used for a correlated prior.
+        burn : int
+            Number of burn-in steps.
+        cores : int, optional
+            Number of cores for the fit.
+
+        Returns
+        -------
+        str
+            File path of the -expt.json file to continue the fit from, which
+            is the starting file if the burn-in failed.
+
+        """
+        decimated_name = os.path.join(base_name, "decimated")
+        decimated_dir = os.path.join(self.results_dir, decimated_name)
+        os.makedirs(decimated_dir, exist_ok=True)
+        decimated_data = os.path.join(decimated_dir, os.path.basename(data_file))
+        np.savetxt(decimated_data, np.loadtxt(data_file)[:: self.fidelity_decimate])
+
+        output = self.dream_process(
+            decimated_name,
+            decimated_data,
+            starting_expt,
+            starting_err,
+            starting_cov,
+            burn=burn,
+            steps=1,
+            cores=cores,
+        )
+        decimated_expt = os.path.join(decimated_dir, f"{self.model_name}-1-expt.json")
+        if output.returncode != 0 or not os.path.isfile(decimated_expt):
+            return starting_expt
+        return decimated_expt
+
+    def check_fidelity(
+        self,
+        base_name: str,
+        data_file: str,
+        starting_expt: str,
+        starting_err: str,
+        starting_cov: Optional[str],
+        burn: int,
+        steps: int,
+        cores: Optional[int],
+    ) -> Dict[str, float]:
+        """
+        Compare a decimated burn-in fit to a fit on the full data only.
+
+        The full-data fit is stored in an exact sub-directory of the results,
+        and the difference of the posterior means, in units of the standard
+        deviation of the full-data fit, is saved in a -fidelity-check.json file.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+        data_file : str
+            File path of the data set to fit.
+        starting_expt : str
+            File path of the starting -expt.json file.
+        starting_err : str
+            File path of the -err.json file used for the prior.
+        starting_cov : str, optional
+            File path of the -cov.json file used for a correlated prior.
+        burn : int
+            Number of burn-in steps.
+        steps : int
+            Number of sampling steps.
+        cores : int, optional
+            Number of cores for the fit.
+
+        Returns
+        -------
+        dict
+            Difference for each parameter, empty if the full-data fit failed.
+
+        """
+        exact_name = os.path.join(base_name, "exact")
+        output = self.dream_process(
+            exact_name,
+            data_file,
+            starting_expt,
+            starting_err,
+            starting_cov,
+            burn=burn,
+            steps=steps,
+            cores=cores,
+        )
+        if output.returncode != 0:
+            print(f"    Fidelity check failed, see {self.log_file(exact_name)}")
+            return dict()
+
+        model_path = os.path.join(self.results_dir, base_name, self.model_name)
+        with open(f"{model_path}-err.json", "r") as fd:
+            stats = json.load(fd)
+        with open(
+            os.path.join(self.results_dir, exact_name, f"{self.model_name}-err.json"),
+            "r",
+        ) as fd:
+            exact_stats = json.load(fd)
+
+        # Frozen parameters have no width
+        zscore = {
+            par: (stats[par]["mean"] - exact_stats[par]["mean"])
+            / max(exact_stats[par]["std"], 1e-12)
+            for par in stats
+            if par in exact_stats
+        }
+        with open(f"{model_path}-fidelity-check.json", "w") as fd:
+            json.dump(zscore, fd, indent=2)
+        largest = max(map(abs, zscore.values()), default=0)
+        print(f"    Fidelity check: largest difference {largest:.2g} sigma")
+        return zscore
+
+    def save_posterior(self, base_name: str) -> str:
+        """
+        Save the compact posterior of a DREAM fit and apply the retention policy.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+
+        Returns
+        -------
+        str
+            File path of the -posterior.npy file.
+
+        """
+        from bumps.dream.state import load_state
+
+        model_path = os.path.join(self.results_dir, base_name, self.model_name)
+        posterior_file = model_utils.save_posterior(
+            model_path, load_state(model_path), n_draws=self.posterior_draws
+        )
+        if not self.keep_chains:
+            model_utils.remove_chains(model_path)
+        return posterior_file
+
+    def archive_slice(self, base_name: str) -> None:
+        """
+        Move the outputs of a fit to the results archive, with archive_results.
+
+        The outputs of the previous data sets are read back from the archive
+        by the following fits.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+
+        """
+        if self.archive_results and os.path.isdir(
+            os.path.join(self.results_dir, base_name)
+        ):
+            results_archive.archive_slice(self.results_dir, base_name)
+
+    def run_dream_batch(self, tasks: List[Tuple]) -> None:
+        """
+        Run independent DREAM fits, concurrently when a core budget is set.
+
+        Parameters
+        ----------
+        tasks : list
+            Positional arguments of run_dream for each fit.
+
+        """
+        # Fits found in the fit cache are restored instead
+        pending = []
+        for task in tasks:
+            key = None
+            if self._fit_cache is not None:
+                # Data file, starting state and covariance, as in fit_sequence
+                inputs = tuple(task[1:5]) + (None,) * (5 - min(len(task), 5))
+                burn = task[5] if len(task) > 5 else None
+                key = self.cache_key(inputs, burn=burn)
+                if self._fit_cache.restore(
+                    key, os.path.join(self.results_dir, task[0])
+                ):
+                    print(f"Restored {task[0]} from the fit cache")
+                    continue
+            print(f"Fitting {task[0]} with DREAM")
+            pending.append((task, key))
+
+        n_concurrent, cores = split_cores(self.cores, len(pending))
+        with ThreadPoolExecutor(n_concurrent) as executor:
+            fitted = list(
+                executor.map(
+                    lambda item: self.run_dream(*item[0], cores=cores), pending
+                )
+            )
+
+        for (task, key), success in zip(pending, fitted):
+            if success and key is not None:
+                self._fit_cache.store(key, os.path.join(self.results_dir, task[0]))
+        for task in tasks:
+            self.archive_slice(task[0])
+
+    def load_problem(
+        self,
+        data_file: str,
+        starting_expt: str,
+        starting_err: str,
+        starting_cov: Optional[str] = None,
+    ):
+        """
+        Load the model for a data set in the current process.
+
+        Parameters
+        ----------
+        data_file : str
+            File path of the data set to fit.
+        starting_expt : str
+            File path of the starting -expt.json file.
+        starting_err : str
+            File path of the -err.json file used for the prior.
+        starting_cov : str, optional
+            File path of the -cov.json file used for a correlated prior.
+
+        Returns
+        -------
+        FitProblem
+            Problem for the data set.
+
+        """
+        from bumps.fitproblem import load_problem
+
+        args = [data_file, starting_expt, starting_err]
+        frozen_file = self.frozen_file(data_file)
+        if starting_cov is not None or frozen_file is not None:
+            args.append(starting_cov or "none")
+        if frozen_file is not None:
+            args.append(frozen_file)
+        return load_problem(os.path.join(self.model_dir, f"{self.model_name}.py"), args)
+
+    def check_covariance_prior(self, inputs: Tuple) -> bool:
+        """
+        Warn if the model ignores the covariance file it is given.
+
+        Models that do not build their problem with model_utils.fit_problem,
+        as the models created by template.create_model do, fit without the
+        correlated prior.
+
+        Parameters
+        ----------
+        inputs : tuple
+            Data file, starting -expt.json, -err.json and -cov.json files of a fit.
+
+        Returns
+        -------
+        bool
+            True once the check is done.
+
+        """
+        problem = self.load_problem(*inputs)
+        # Only the problems with a correlated prior have prior_names
+        if not hasattr(problem, "prior_names"):
+            warnings.warn(
+                f"The model {self.model_file} does not use the covariance given as "
+                "its fourth argument: the fits do not use a correlated prior. "
+                "Build the problem with model_utils.fit_problem, as in template.py."
+            )
+        return True
+
+    def check_freezing(
+        self, data_file: str, starting_expt: str, starting_err: str
+    ) -> bool:
+        """
+        Check that the model freezes the parameters given as its fifth argument.
+
+        Models that do not call model_utils.freeze_parameters, as the models
+        created by template.create_model do, would still fit the parameters
+        that the loop records as frozen.
+
+        Parameters
+        ----------
+        data_file : str
+            File path of the first data set to fit.
+        starting_expt : str
+            File path of the starting -expt.json file.
+        starting_err : str
+            File path of the -err.json file used for the prior.
+
+        Returns
+        -------
+        bool
+            True if the model freezes the parameters it is given.
+
+        """
+        problem = self.load_problem(data_file, starting_expt, starting_err)
+        name = problem.labels()[0]
+        self.frozen = {name: float(problem.getp()[0])}
+        try:
+            problem = self.load_problem(data_file, starting_expt, starting_err)
+        finally:
+            self.frozen = dict()
+        if name in problem.labels():
+            warnings.warn(
+                f"The model {self.model_file} does not freeze the parameters given "
+                "as its fifth argument: the fits are done without freezing. "
+                "Call model_utils.freeze_parameters, as in template.py."
+            )
+            return False
+        return True
+
+    @property
+    def model_file(self) -> str:
+        """
+        File path of the refl1d model.
+        """
+        return os.path.join(self.model_dir, f"{self.model_name}.py")
+
+    @property
+    def cache_dir(self) -> str:
+        """
+        Directory where trained networks for the model are cached.
+        """
+        return self.surrogate_dir or os.path.join(self.model_dir, "surrogates")
+
+    def fit_amortized(
+        self, dyn_file_list: List[str], starting_expt: str, starting_err: str
+    ) -> None:
+        """
+        Estimate the posterior of all data sets with a trained network.
+
+        The network is trained for the model on first use and cached. A
+        sample of the data sets can then be fit with DREAM, and the
+        comparison is saved in amortized-validation.json.
+
+        Parameters
+        ----------
+        dyn_file_list : list
+            List of time-resolved data sets, in fitting order.
+        starting_expt : str
+            File path of the starting -expt.json file.
+        starting_err : str
+            File path of the -err.json file of the starting state.
+
+        """
+        from . import amortized
+
+        data_files = [os.path.join(self.dyn_data_dir, f) for f in dyn_file_list]
+        problem = self.load_problem(data_files[0], starting_expt, starting_err)
+        estimator = amortized.load_or_train(problem, self.model_file, self.cache_dir)
+
+        data_list = [data_preparation.prepare_data(f) for f in data_files]
+        all_stats = estimator.posterior_stats(data_list)
+
+        base_names = [os.path.splitext(f)[0] for f in dyn_file_list]
+        for base_name, stats in zip(base_names, all_stats):
+            model_utils.save_stats(
+                os.path.join(self.results_dir, base_name, self.model_name), stats
+            )
+
+        if self.amortized_validate_every <= 0:
+            return
+
+        # Compare the estimates to DREAM for a sample of data sets, in units
+        # of the DREAM standard deviation
+        selected = range(0, len(base_names), self.amortized_validate_every)
+        self.run_dream_batch(
+            [
+                (base_names[i], data_files[i], starting_expt, starting_err)
+                for i in selected
+            ]
+        )
+
+        validation = dict()
+        for i in selected:
+            # The amortized estimate is left in place of a failed DREAM fit
+            if base_names[i] in self.failed_fits:
+                continue
+            dream_stats = results_archive.load_json(
+                os.path.join(
+                    self.results_dir, base_names[i], f"{self.model_name}-err.json"
+                )
+            )
+            validation[base_names[i]] = {
+                par: (all_stats[i][par]["mean"] - dream_stats[par]["mean"])
+                / max(dream_stats[par]["std"], 1e-12)
+                for par in all_stats[i]
+                if par in dream_stats
+            }
+            model_utils.print_model(all_stats[i], dream_stats)
+
+        with open(
+            os.path.join(self.results_dir, "amortized-validation.json"), "w"
+        ) as fd:
+            json.dump(validation, fd, indent=2)
+
+    def fit_global(
+        self, dyn_file_list: List[str], starting_expt: str, starting_err: str
+    ) -> None:
+        """
+        Fit all data sets jointly, with time-varying parameters as splines in time.
+
+        The per-data set results are saved as .par and -err.json files, and
+        in the trend format used by summary_plots.trend_data.
+
+        Parameters
+        ----------
+        dyn_file_list : list
+            List of time-resolved data sets.
+        starting_expt : str
+            File path of the starting -expt.json file.
+        starting_err : str
+            File path of the -err.json file of the starting state.
+
+        """
+        from . import global_fit
+
+        times = [self.file_time(f) for f in dyn_file_list]
+        joint = global_fit.GlobalFit(
+            self.model_file,
+            [os.path.join(self.dyn_data_dir, f) for f in dyn_file_list],
+            times,
+            starting_expt,
+            starting_err,
+            static_parameters=self.global_static,
+            n_knots=self.global_knots,
+            processes=self.global_processes or self.cores,
+        )
+        values, errors, chisq = joint.fit()
+
+        base_names = [os.path.splitext(f)[0] for f in dyn_file_list]
+        global_fit.save_slice_results(
+            self.results_dir, base_names, self.model_name, joint.names, values, errors
+        )
+        global_fit.save_trend(
+            os.path.join(self.results_dir, f"trend-{self.model_name}.json"),
+            joint.names,
+            times,
+            values,
+            errors,
+            chisq,
+        )
+
+    def fit_coarse_to_fine(self, dyn_file_list: List[str]) -> None:
+        """
+        Fit the data sets from the coarsest to the finest time resolution.
+
+        Every coarse_stride-th data set, and the last one, are fit first,
+        starting from the nearer steady state. The stride is then halved
+        until all data sets are fit, and each new data set starts from the
+        linear interpolation in time of the closest fitted data sets on
+        either side. The fits of each level run concurrently.
+
+        Parameters
+        ----------
+        dyn_file_list : list
+            List of time-resolved data sets, ordered in increasing times.
+
+        """
+        n_files = len(dyn_file_list)
+        times = [self.file_time(f) for f in dyn_file_list]
+        base_names = [os.path.splitext(f)[0] for f in dyn_file_list]
+        data_files = [os.path.join(self.dyn_data_dir, f) for f in dyn_file_list]
+
+        def results(i):
+            model_path = os.path.join(self.results_dir, base_names[i], self.model_name)
+            return f"{model_path}-1-expt.json", f"{model_path}-err.json"
+
+        # Coarsest level, started from the steady state closest in time
+        stride = self.coarse_stride
+        level = sorted(set(range(0, n_files, stride)) | {n_files - 1})
+        tasks = []
+        for i in level:
+            if self.final_expt_file is not None and 2 * i >= n_files - 1:
+                tasks.append(
+                    (
+                        base_names[i],
+                        data_files[i],
+                        self.final_expt_file,
+                        self.final_err_file,
+                    )
+                )
+            else:
+                tasks.append(
+                    (
+                        base_names[i],
+                        data_files[i],
+                        self.initial_expt_file,
+                        self.initial_err_file,
+                    )
+                )
+        print(f"Stride {stride}: {len(tasks)} data sets")
+        self.run_dream_batch(tasks)
+        done = set(level)
+        fitted = {i for i in level if results_archive.isfile(results(i)[1])}
+
+        # Finer levels, started from the interpolation of the fitted neighbours
+        burn = self.dream_burn if self.fine_burn is None else self.fine_burn
+        while len(done) < n_files:
+            stride = max(stride // 2, 1)
+            level = [i for i in range(0, n_files, stride) if i not in done]
+            tasks = []
+            for i in level:
+                # Neighbours whose fit failed are skipped
+                neighbours = [
+                    j
+                    for j in (
+                        max((j for j in fitted if j < i), default=None),
+                        min((j for j in fitted if j > i), default=None),
+                    )
+                    if j is not None
+                ]
+                if not neighbours:
+                    tasks.append(
+                        (
+                            base_names[i],
+                            data_files[i],
+                            self.initial_expt_file,
+                            self.initial_err_file,
+                            None,
+                            burn,
+                        )
+                    )
+                    continue
+                nearest = min(neighbours, key=lambda j: abs(times[i] - times[j]))
+
+                model_path = os.path.join(
+                    self.results_dir, base_names[i], self.model_name
+                )
+                os.makedirs(os.path.dirname(model_path), exist_ok=True)
+                seed_expt = results(nearest)[0]
+                if len(neighbours) == 2:
+                    left, right = neighbours
+                    models = []
+                    for j in (left, right):
+                        models.append(results_archive.load_json(results(j)[1]))
+                    values = model_utils.predict_parameters(
+                        [times[left], times[right]], models, times[i], order=1
+                    )
+                    seed_expt = f"{model_path}-interpolated-expt.json"
+                    model_utils.predicted_expt_file(
+                        results(nearest)[0], values, seed_expt
+                    )
+                tasks.append(
+                    (
+                        base_names[i],
+                        data_files[i],
+                        seed_expt,
+                        results(nearest)[1],
+                        None,
+                        burn,
+                    )
+                )
+            print(f"Stride {stride}: {len(tasks)} data sets")
+            self.run_dream_batch(tasks)
+            done.update(level)
+            fitted.update(i for i in level if results_archive.isfile(results(i)[1]))
+
+    def surrogate_start(
+        self,
+        base_name: str,
+        data_file: str,
+        starting_expt: str,
+        starting_err: str,
+    ) -> str:
+        """
+        Use the model surrogate to find a starting point for a DREAM fit.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+        data_file : str
+            File path of the data set to fit.
+        starting_expt : str
+            File path of the starting -expt.json file.
+        starting_err : str
+            File path of the -err.json file used for the prior.
+
+        Returns
+        -------
+        str
+            File path of the -expt.json file to start the fit from.
+
+        """
+        from . import surrogate
+
+        problem = self.load_problem(data_file, starting_expt, starting_err)
+        # Frozen parameters are not inputs of the surrogate for the next data sets
+        if self._surrogate is None or list(self._surrogate.names) != problem.labels():
+            self._surrogate = surrogate.load_or_train(
+                problem, self.model_file, self.cache_dir
+            )
+
+        values = surrogate.prescreen(self._surrogate, problem)
+
+        model_path = os.path.join(self.results_dir, base_name, self.model_name)
+        os.makedirs(os.path.dirname(model_path), exist_ok=True)
+        surrogate_expt = f"{model_path}-surrogate-expt.json"
+        model_utils.predicted_expt_file(starting_expt, values, surrogate_expt)
+        return surrogate_expt
+
+    def lm_slice(
+        self,
+        base_name: str,
+        data_file: str,
+        starting_expt: str,
+        starting_err: str,
+    ) -> float:
+        """
+        Fit a data set with Levenberg-Marquardt and save the results.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+        data_file : str
+            File path of the data set to fit.
+        starting_expt : str
+            File path of the starting -expt.json file.
+        starting_err : str
+            File path of the -err.json file of the previous fit.
+
+        Returns
+        -------
+        float
+            Normalized chi^2 of the fit.
+
+        """
+        from bumps.fitters import fit as bumps_fit
+
+        problem = self.load_problem(data_file, starting_expt, starting_err)
+        result = bumps_fit(problem, method="lm", steps=self.lm_steps)
+        problem.setp(result.x)
+        chisq = problem.chisq()
+        print(f"    LM chi2: {chisq:g}")
+
+        model_path = os.path.join(self.results_dir, base_name, self.model_name)
+        model_utils.save_fit_results(
+            problem,
+            model_path,
+            model_utils.gaussian_stats(problem.labels(), result.x, result.dx),
+        )
+        # Keep a copy of the results, which a DREAM fit of the data set replaces
+        for lm_file, result_file in zip(
+            self.lm_results(base_name),
+            [f"{model_path}-1-expt.json", f"{model_path}-err.json"],
+        ):
+            shutil.copyfile(result_file, lm_file)
+        return chisq
+
+    def lm_results(self, base_name: str) -> Tuple[str, str]:
+        """
+        Return the -expt.json and -err.json files of a Levenberg-Marquardt fit.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+
+        Returns
+        -------
+        tuple
+            File paths of the -lm-expt.json and -lm-err.json files.
+
+        """
+        model_path = os.path.join(self.results_dir, base_name, self.model_name)
+        return f"{model_path}-lm-expt.json", f"{model_path}-lm-err.json"
+
+    def select_dream_slices(self, chisq: List[float]) -> List[int]:
+        """
+        Select the data sets to fit with DREAM after a Levenberg-Marquardt pass.
+
+        Parameters
+        ----------
+        chisq : list
+            Normalized chi^2 of each data set, in fitting order.
+
+        Returns
+        -------
+        list
+            Indices of the selected data sets, in fitting order.
+
+        """
+        selected = set()
+        n_slices = len(chisq)
+        if self.dream_every > 0:
+            selected.update(range(0, n_slices, self.dream_every))
+        if self.dream_chisq_jump > 0:
+            selected.update(
+                i
+                for i in range(1, n_slices)
+                if chisq[i] > self.dream_chisq_jump * chisq[i - 1]
+            )
+        if self.dream_last > 0:
+            selected.update(range(max(n_slices - self.dream_last, 0), n_slices))
+        return sorted(selected)
+
+    def change_steps(self, change: float) -> Tuple[int, int]:
+        """
+        Return the DREAM burn-in and sampling steps for a given change between data sets.
+
+        The budget grows linearly from budget_min_fraction of the full budget
+        at change_reuse to the full budget at change_full.
+
+        Parameters
+        ----------
+        change : float
+            Change statistic of the data set.
+
+        Returns
+        -------
+        tuple
+            Number of burn-in and sampling steps.
+
+        """
+        scale = (change - self.change_reuse) / max(
+            self.change_full - self.change_reuse, 1e-12
+        )
+        fraction = self.budget_min_fraction + (1 - self.budget_min_fraction) * min(
+            max(scale, 0.0), 1.0
+        )
+        return (
+            max(1, int(round(fraction * self.dream_burn))),
+            max(1, int(round(fraction * self.dream_steps))),
+        )
+
+    def reuse_posterior(
         self,
-        dyn_data_dir: str,
-        results_dir: str,
-        model_dir: Optional[str] = None,
-        model_name: str = "__model",
-        initial_err_file: Optional[str] = None,
-        initial_expt_file: Optional[str] = None,
-        final_err_file: Optional[str] = None,
-        final_expt_file: Optional[str] = None,
+        base_name: str,
+        inputs: Tuple,
+        previous_base_name: str,
+        previous_inputs: Tuple,
+    ) -> Optional[float]:
+        """
+        Fit a data set by re-weighting the posterior of the previous one.
+
+        Each posterior sample of the previous data set is weighted by the
+        ratio of the new and previous posterior densities. If enough samples
+        keep a significant weight, the re-weighted posterior is saved in a
+        reweighted sub-directory and a short DREAM chain, started from its
+        best point, is run in a verify sub-directory to check it. The
+        re-weighted results are only moved to the results of the data set
+        if the check passes.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+        inputs : tuple
+            Data file, starting -expt.json, -err.json and -cov.json files of the fit.
+        previous_base_name : str
+            Name of the results sub-directory of the previous fit.
+        previous_inputs : tuple
+            Inputs of the previous fit.
+
+        Returns
+        -------
+        float or None
+            Effective sample size of the re-weighted posterior, or None if
+            it was rejected and the data set needs a DREAM fit.
+
+        """
+        previous = model_utils.posterior_points(
+            os.path.join(self.results_dir, previous_base_name, self.model_name),
+            n_draws=self.posterior_draws,
+        )
+        if previous is None:
+            return None
+
+        problem = self.load_problem(*inputs)
+        previous_problem = self.load_problem(*previous_inputs)
+        names = problem.labels()
+        previous_names, points = previous
+        if any(name not in previous_names for name in names):
+            return None
+        points = points[:, [previous_names.index(name) for name in names]]
+
+        nllf = np.asarray([problem.nllf(point) for point in points])
+        previous_nllf = np.asarray([previous_problem.nllf(point) for point in points])
+        weights = model_utils.importance_weights(previous_nllf - nllf)
+        ess = model_utils.effective_sample_size(weights)
+        print(f"    Re-weighted posterior: {ess:.0f} effective samples")
+        if ess < self.reuse_min_ess * len(points):
+            return None
+
+        rng = np.random.default_rng(0)
+        resampled = points[rng.choice(len(points), size=len(points), p=weights)]
+        best = points[int(np.argmin(nllf))]
+        problem.setp(best)
+        reweighted_dir = os.path.join(self.results_dir, base_name, "reweighted")
+        os.makedirs(reweighted_dir, exist_ok=True)
+        reweighted_path = os.path.join(reweighted_dir, self.model_name)
+        stats = model_utils.posterior_stats(names, resampled, best)
+        model_utils.save_fit_results(problem, reweighted_path, stats)
+        model_utils.save_posterior_points(
+            reweighted_path,
+            names,
+            resampled,
+            n_draws=len(resampled),
+            reweighted=previous_base_name,
+            ess=ess,
+        )
+
+        # Short verification chain, started from the re-weighted best point
+        verify_name = os.path.join(base_name, "verify")
+        verified = self.run_dream(
+            verify_name,
+            inputs[0],
+            f"{reweighted_path}-1-expt.json",
+            *inputs[2:],
+            burn=self.verify_steps,
+            steps=self.verify_steps,
+        )
+        # A failed check only means that the data set is fit with DREAM
+        self.failed_fits.pop(verify_name, None)
+
+        zscore = np.inf
+        if verified:
+            with open(
+                os.path.join(
+                    self.results_dir, verify_name, f"{self.model_name}-err.json"
+                ),
+                "r",
+            ) as fd:
+                verify_stats = json.load(fd)
+            zscore = max(
+                abs(verify_stats[name]["mean"] - stats[name]["mean"])
+                / max(stats[name]["std"], 1e-12)
+                for name in names
+            )
+            print(f"    Verification chain: largest shift {zscore:.2g} sigma")
+
+        if zscore <= VERIFY_ZSCORE:
+            for name in os.listdir(reweighted_dir):
+                shutil.move(
+                    os.path.join(reweighted_dir, name),
+                    os.path.join(self.results_dir, base_name, name),
+                )
+        shutil.rmtree(reweighted_dir)
+        return ess if zscore <= VERIFY_ZSCORE else None
+
+    def fit_with_budget(
+        self,
+        base_name: str,
+        inputs: Tuple,
+        previous_base_name: str,
+        previous_inputs: Tuple,
     ) -> None:
         """
-        Initialize the FittingLoop object.
+        Fit a data set with a DREAM budget that depends on its change from the previous one.
 
         Parameters
         ----------
-        dyn_data_dir : str
-            Directory where the dynamic data is stored.
-        results_dir : str
-            Directory where the results will be stored.
-        model_dir : str, optional
-            Directory where the model is stored.
-        model_name : str, optional
-            Name of the model file.
-        initial_err_file : str, optional
-            File path of the initial error file.
-        initial_expt_file : str, optional
-            File path of the initial experiment file.
-        final_err_file : str, optional
-            File path of the final error file.
-        final_expt_file : str, optional
-            File path of the final experiment file.
+        base_name : str
+            Name of the results sub-directory for the fit.
+        inputs : tuple
+            Data file, starting -expt.json, -err.json and -cov.json files of the fit.
+        previous_base_name : str
+            Name of the results sub-directory of the previous fit.
+        previous_inputs : tuple
+            Inputs of the previous fit.
 
         """
-        self.fit_forward: bool = True
-        self.dyn_file_list: List[str] = []
-        self.model_dir: Optional[str] = model_dir
-        self.model_name: str = model_name
-        self.dyn_data_dir: str = dyn_data_dir
-        self.results_dir: str = results_dir
-        self.initial_err_file: Optional[str] = initial_err_file
-        self.initial_expt_file: Optional[str] = initial_expt_file
-        self.final_err_file: Optional[str] = final_err_file
-        self.final_expt_file: Optional[str] = final_expt_file
-        self.last_output: str = ""
+        change = model_utils.change_statistic(
+            data_preparation.prepare_data(inputs[0]),
+            data_preparation.prepare_data(previous_inputs[0]),
+        )
+        budget = dict(change=change)
+        self.fit_budgets[base_name] = budget
 
-    def save(self, file_path: str) -> None:
+        if change < self.change_reuse:
+            ess = self.reuse_posterior(
+                base_name, inputs, previous_base_name, previous_inputs
+            )
+            if ess is not None:
+                budget.update(mode="reused", ess=ess, burn=0, steps=0)
+                print(f"    Change {change:.3g}: re-weighted the previous posterior")
+                return
+            # The posterior moved more than the data suggested
+            burn, steps = self.dream_burn, self.dream_steps
+        else:
+            burn, steps = self.change_steps(change)
+
+        budget.update(mode="dream", burn=burn, steps=steps)
+        print(f"    Change {change:.3g}: DREAM with {burn} burn-in and {steps} steps")
+        self.run_dream(base_name, *inputs, burn=burn, steps=steps)
+
+    def cache_key(self, inputs: Tuple, burn: Optional[int] = None) -> str:
         """
-        Save all the settings to a file.
+        Return the fit cache key of a data set.
 
         Parameters
         ----------
-        file_path : str
-            File path to save the settings.
+        inputs : tuple
+            Data file, starting -expt.json, -err.json and -cov.json files of the fit.
+        burn : int, optional
+            Number of burn-in steps, if different from dream_burn.
+
+        Returns
+        -------
+        str
+            Key computed from the contents of the inputs and from the fitting options.
 
         """
-        meta_data: Dict[str, Any] = dict(
-            model_dir=self.model_dir,
+        from importlib.metadata import version
+
+        from .. import __version__
+
+        settings = {k: getattr(self, k) for k in FIT_OPTIONS if k not in CACHE_IGNORED}
+        settings.update(
             model_name=self.model_name,
-            dyn_data_dir=self.dyn_data_dir,
-            results_dir=self.results_dir,
-            initial_err_file=self.initial_err_file,
-            initial_expt_file=self.initial_expt_file,
-            final_err_file=self.final_err_file,
-            final_expt_file=self.final_expt_file,
-            dyn_file_list=self.dyn_file_list,
-            fit_forward=self.fit_forward,
+            tron=__version__,
+            refl1d=version("refl1d"),
+            bumps=version("bumps"),
         )
-        with open(file_path, "w") as fd:
-            json.dump(meta_data, fd)
+        if burn is not None:
+            settings.update(burn=burn)
+        files = [os.path.join(self.model_dir, f"{self.model_name}.py")]
+        files += list(inputs) + [self.frozen_file(inputs[0])]
+        return fit_cache.fit_key(files, settings)
 
-    def load(self, file_path: str) -> None:
+    def frozen_file(self, data_file: str) -> Optional[str]:
         """
-        Load settings from a file.
+        Write the values of the parameters frozen for a data set.
 
         Parameters
         ----------
-        file_path : str
-            File path to load the settings from.
+        data_file : str
+            File path of the data set to fit.
+
+        Returns
+        -------
+        str or None
+            File path of the -frozen.json file passed to the model, or None
+            if no parameter is frozen.
 
         """
-        with open(file_path, "r") as fd:
-            meta_data = json.load(fd)
-        self.model_dir = meta_data["model_dir"]
-        self.model_name = meta_data["model_name"]
-        self.dyn_data_dir = meta_data["dyn_data_dir"]
-        self.results_dir = meta_data["results_dir"]
-        self.initial_err_file = meta_data["initial_err_file"]
-        self.initial_expt_file = meta_data["initial_expt_file"]
-        self.final_err_file = meta_data["final_err_file"]
-        self.final_expt_file = meta_data["final_expt_file"]
-        self.fit_forward = meta_data["fit_forward"]
-        self.dyn_file_list = meta_data["dyn_file_list"]
+        values = dict(self.frozen)
+        values.update(self.frozen_nuisance.get(os.path.basename(data_file), {}))
+        if not values:
+            return None
 
-    def __str__(self) -> str:
+        frozen_dir = os.path.join(self.results_dir, "frozen")
+        os.makedirs(frozen_dir, exist_ok=True)
+        name, _ = os.path.splitext(os.path.basename(data_file))
+        frozen_file = os.path.join(frozen_dir, f"{name}-frozen.json")
+        with open(frozen_file, "w") as fd:
+            json.dump(values, fd)
+        return frozen_file
+
+    def estimate_nuisance(
+        self, dyn_file_list: List[str], starting_expt: str, starting_err: str
+    ) -> Dict[str, Dict[str, float]]:
         """
-        Return a string representation of the FittingLoop object.
+        Estimate the normalization and background of all data sets at once.
+
+        The estimates are frozen for the nuisance parameters fitted by the
+        model, when they are within the fit range of the parameter.
+
+        Parameters
+        ----------
+        dyn_file_list : list
+            List of time-resolved data sets.
+        starting_expt : str
+            File path of the -expt.json file of the starting state.
+        starting_err : str
+            File path of the -err.json file of the starting state.
 
         Returns
         -------
-        str
-            String representation of the FittingLoop object.
+        dict
+            Intensity and background estimates, keyed by data file.
 
         """
-        return (
-            f"Model: {os.path.join(self.model_dir, self.model_name)}\n"
-            f"Data: {self.dyn_data_dir}\n"
-            f"Results: {self.results_dir}\n"
-            f"Initial state: {self.initial_expt_file}\n"
-            f"Final state: {self.final_expt_file}"
+        data_files = [os.path.join(self.dyn_data_dir, f) for f in dyn_file_list]
+        problem = self.load_problem(data_files[0], starting_expt, starting_err)
+        bounds = dict(zip(problem.labels(), zip(*problem.bounds())))
+        fitted = [name for name in freezing.NUISANCE_PARAMETERS if name in bounds]
+
+        expt = model_utils.expt_from_json_file(starting_expt, keep_original_ranges=True)
+        estimates = freezing.estimate_nuisance(
+            expt, [data_preparation.prepare_data(f) for f in data_files]
         )
 
-    def print_initial_final(self) -> None:
+        nuisance = dict()
+        for _file, (intensity, background) in zip(dyn_file_list, estimates):
+            nuisance[_file] = dict(
+                intensity=float(intensity), background=float(background)
+            )
+            # Estimates outside of the fit range, such as a negative
+            # background, are left to the fit
+            frozen = {
+                name: nuisance[_file][name]
+                for name in fitted
+                if np.isfinite(nuisance[_file][name])
+                and bounds[name][0] <= nuisance[_file][name] <= bounds[name][1]
+            }
+            if frozen:
+                self.frozen_nuisance[_file] = frozen
+        return nuisance
+
+    def select_frozen(
+        self, base_name: Optional[str], time_series: List[Dict[str, Any]]
+    ) -> Dict[str, Any]:
         """
-        Print the initial and final models.
+        Select the parameters to freeze for the rest of the fitting loop.
+
+        Parameters
+        ----------
+        base_name : str, optional
+            Name of the results sub-directory of the last fit, whose posterior
+            is used for the correlations, or None before the first fit.
+        time_series : list
+            Content of the -err.json file of the starting state and of each fit.
+
+        Returns
+        -------
+        dict
+            Name of the last fit and selection statistics of each frozen parameter.
+
         """
-        print(self)
         with open(self.initial_err_file, "r") as fd:
             initial_model = json.load(fd)
         with open(self.final_err_file, "r") as fd:
             final_model = json.load(fd)
-        model_utils.print_model(initial_model, final_model)
+
+        posterior = None
+        if base_name is not None:
+            posterior = model_utils.posterior_points(
+                os.path.join(self.results_dir, base_name, self.model_name),
+                n_draws=self.posterior_draws,
+            )
+
+        frozen = freezing.select_frozen(
+            initial_model,
+            final_model,
+            time_series[1:],
+            posterior=posterior,
+            max_shift=self.freeze_max_shift,
+            max_drift=self.freeze_max_drift,
+            max_correlation=self.freeze_max_correlation,
+        )
+        self.frozen = {name: item["value"] for name, item in frozen.items()}
+        print(f"    Frozen parameters: {', '.join(self.frozen) or 'none'}")
+        return dict(after=base_name, parameters=frozen)
+
+    def record_frozen(self, base_name: str, data_file: str) -> None:
+        """
+        Add the frozen parameters to the -err.json and .par files of a fit.
+
+        The results of all data sets then hold the same parameters.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+        data_file : str
+            File path of the data set that was fit.
+
+        """
+        values = dict(self.frozen)
+        values.update(self.frozen_nuisance.get(os.path.basename(data_file), {}))
+        model_path = os.path.join(self.results_dir, base_name, self.model_name)
+        if not values or not os.path.isfile(f"{model_path}-err.json"):
+            return
+
+        with open(f"{model_path}-err.json", "r") as fd:
+            stats = json.load(fd)
+        fitted = [name for name in values if name in stats]
+        if fitted:
+            print(f"    The model did not freeze {', '.join(fitted)}")
+        stats.update(
+            freezing.frozen_stats(
+                {name: value for name, value in values.items() if name not in stats}
+            )
+        )
+        model_utils.save_stats(model_path, stats)
+
+    def filter_slice(
+        self,
+        base_name: str,
+        data_file: str,
+        starting_expt: str,
+        starting_err: str,
+    ) -> bool:
+        """
+        Update the ensemble Kalman filter with a data set and save the results.
+
+        Parameters
+        ----------
+        base_name : str
+            Name of the results sub-directory for the fit.
+        data_file : str
+            File path of the data set to fit.
+        starting_expt : str
+            File path of the starting -expt.json file.
+        starting_err : str
+            File path of the -err.json file of the previous fit.
+
+        Returns
+        -------
+        bool
+            True if the data set should be fit with DREAM.
+
+        """
+        problem = self.load_problem(data_file, starting_expt, starting_err)
+
+        if self._filter is None:
+            starting_model = results_archive.load_json(starting_err)
+            self._filter = sequential_filter.EnsembleFilter.from_problem(
+                problem,
+                starting_model,
+                n_members=self.filter_members,
+                process_noise=self.filter_process_noise,
+                n_iterations=self.filter_iterations,
+            )
+        else:
+            self._filter.forecast(problem)
+
+        chisq = self._filter.update(problem)
+        print(f"    Filter chi2: {chisq:g}")
+
+        problem.setp(self._filter.best)
+        model_utils.save_fit_results(
+            problem,
+            os.path.join(self.results_dir, base_name, self.model_name),
+            self._filter.stats(),
+        )
+        return chisq > self.filter_flag_chisq
 
     def fit(self, dyn_file_list: List[str], fit_forward: bool = True) -> None:
         """
@@ -154,6 +2101,16 @@ class FittingLoop:
         """
         self.fit_forward = fit_forward
         self.dyn_file_list = dyn_file_list
+        self.dream_slices = []
+        self.failed_fits = dict()
+        self._filter = None
+        self._surrogate = None
+        self._fit_cache = None
+        if self.fit_cache_dir and self.engine == "dream":
+            self._fit_cache = fit_cache.FitCache(
+                self.fit_cache_dir, max_bytes=int(self.fit_cache_max_gb * 1024**3)
+            )
+            self._fit_cache.evict()
 
         # Clean results directory so we don't mix up results
         if os.path.isdir(self.results_dir):
@@ -173,50 +2130,192 @@ class FittingLoop:
             starting_expt = self.final_expt_file
             starting_err = self.final_err_file
 
+        if self.engine == "amortized":
+            self.fit_amortized(list(_ordered_files), starting_expt, starting_err)
+        elif self.engine == "global":
+            self.fit_global(dyn_file_list, starting_expt, starting_err)
+        elif self.engine == "dream" and self.coarse_stride > 1:
+            self.fit_coarse_to_fine(dyn_file_list)
+        else:
+            self.fit_sequence(dyn_file_list, starting_expt, starting_err)
+
+        if self.failed_fits:
+            print(f"Failed fits: {sorted(self.failed_fits)}")
+            with open(os.path.join(self.results_dir, "failed-fits.json"), "w") as fd:
+                json.dump(self.failed_fits, fd, indent=2)
+
+        # Outputs that were not archived after their fit, such as failed fits
+        if self.archive_results:
+            n_files = results_archive.archive_results(self.results_dir)
+            print(f"Archived {n_files} more result files in {self.results_dir}")
+
+    def fit_sequence(
+        self, dyn_file_list: List[str], starting_expt: str, starting_err: str
+    ) -> None:
+        """
+        Fit the data sets one after the other, each starting from the previous fit.
+
+        Parameters
+        ----------
+        dyn_file_list : list
+            List of time-resolved data sets, ordered in increasing times.
+        starting_expt : str
+            File path of the -expt.json file of the starting state.
+        starting_err : str
+            File path of the -err.json file of the starting state.
+
+        """
+        _ordered_files = (
+            dyn_file_list if self.fit_forward else list(reversed(dyn_file_list))
+        )
+
         # Initialize our time series of models
         with open(starting_err, "r") as fd:
             initial_model = json.load(fd)
         time_series = [initial_model]
 
+        if self.engine == "lm" and self.covariance_prior:
+            warnings.warn(
+                "The Levenberg-Marquardt fits do not save a covariance: the fits "
+                'of engine="lm" are done without the correlated prior.'
+            )
+
+        # The steady-state fits only provide independent uncertainties
+        starting_cov = None
+        cov_checked = False
+        fit_times = []
+        starting_model = starting_expt
+        last_cov = None
+
+        # Name and inputs of the previous DREAM fit, for the change-aware budget
+        previous = None
+        self.fit_budgets = dict()
+
+        # Parameters frozen for the rest of the loop
+        freeze = self.freeze and self.engine == "dream"
+        self.frozen = dict()
+        self.frozen_nuisance = dict()
+        if freeze:
+            freeze = self.check_freezing(
+                os.path.join(self.dyn_data_dir, _ordered_files[0]),
+                starting_expt,
+                starting_err,
+            )
+        frozen_record = dict()
+        if freeze:
+            frozen_record["nuisance"] = self.estimate_nuisance(
+                dyn_file_list, starting_expt, starting_err
+            )
+            if self.freeze_after < 1:
+                frozen_record.update(self.select_frozen(None, time_series))
+
+        # Inputs and chi^2 of each Levenberg-Marquardt fit, and the
+        # starting point of the DREAM fit of the next data set
+        lm_inputs = []
+        lm_chisq = []
+        lm_start = (starting_expt, starting_err)
+
         t0 = time.time()
         t1 = time.time()
         for _file in _ordered_files:
             print(f"Fitting {_file}")
             _base_name, _ = os.path.splitext(_file)
             data_to_fit = os.path.join(self.dyn_data_dir, _file)
-            command = [
-                "python",
-                "-m",
-                "refl1d.main",
-                "--fit=dream",
-                "--steps=1000",
-                "--burn=1000",
-                "--batch",
-                "--overwrite",
-                f"--store={os.path.join(self.results_dir, _base_name)}",
-                os.path.join(self.model_dir, f"{self.model_name}.py"),
-                data_to_fit,
-                starting_expt,
-                starting_err,
-            ]
 
-            self.last_output = subprocess.run(command, capture_output=True, text=True)
+            if self.predictor and len(fit_times) > 1:
+                starting_expt, predicted_cov = self.predict(
+                    _base_name, fit_times, time_series[1:], starting_model, last_cov
+                )
+                starting_cov = predicted_cov
+
+            inputs = (data_to_fit, starting_expt, starting_err, starting_cov)
+            if starting_cov is not None and not cov_checked:
+                cov_checked = self.check_covariance_prior(inputs)
+            cache_key = None
+            if self._fit_cache is not None:
+                cache_key = self.cache_key(inputs)
+            cached = cache_key is not None and self._fit_cache.restore(
+                cache_key, os.path.join(self.results_dir, _base_name)
+            )
+
+            use_dream = True
+            if self.engine == "filter":
+                use_dream = self.filter_slice(
+                    _base_name, data_to_fit, starting_expt, starting_err
+                )
+            elif self.engine == "lm":
+                use_dream = False
+                lm_inputs.append((_base_name, data_to_fit, *lm_start))
+                lm_chisq.append(
+                    self.lm_slice(_base_name, data_to_fit, starting_expt, starting_err)
+                )
+
+            if cached:
+                print("    Results restored from the fit cache")
+            elif use_dream and self.surrogate:
+                self.run_dream(
+                    _base_name,
+                    data_to_fit,
+                    self.surrogate_start(
+                        _base_name, data_to_fit, starting_expt, starting_err
+                    ),
+                    starting_err,
+                    starting_cov,
+                    burn=self.surrogate_burn,
+                )
+            elif use_dream and self.change_budget and previous is not None:
+                self.fit_with_budget(_base_name, inputs, *previous)
+            elif use_dream:
+                self.run_dream(_base_name, *inputs)
 
-            # Update the starting model with the fit we just did
             _model = os.path.join(
-                self.results_dir, _base_name, f"{self.model_name}-expt.json"
+                self.results_dir, _base_name, f"{self.model_name}-1-expt.json"
             )
             _err = os.path.join(
                 self.results_dir, _base_name, f"{self.model_name}-err.json"
             )
+            if not results_archive.isfile(_err):
+                # The next data set is fit from the same starting state
+                print(f"    No result for {_base_name}, skipping it")
+                self.failed_fits.setdefault(_base_name, dict(returncode=None, log=None))
+                continue
+
+            if self.engine == "dream":
+                previous = (_base_name, inputs)
+            elif self.engine == "lm":
+                lm_start = self.lm_results(_base_name)
+
+            if freeze and not cached:
+                self.record_frozen(_base_name, data_to_fit)
+
+            # Update the starting model with the fit we just did
             starting_model = _model
+            starting_expt = _model
             starting_err = _err
 
+            if use_dream and self.covariance_prior:
+                last_cov = os.path.join(
+                    self.results_dir, _base_name, f"{self.model_name}-cov.json"
+                )
+                if not (cached and os.path.isfile(last_cov)):
+                    last_cov = self.save_covariance(_base_name)
+                starting_cov = last_cov
+
+            if cache_key is not None and not cached:
+                self._fit_cache.store(cache_key, os.path.dirname(_err))
+
             print(starting_model)
 
-            with open(os.path.join(_err), "r") as fd:
-                updated_model = json.load(fd)
-                time_series.append(updated_model)
+            updated_model = results_archive.load_json(_err)
+            time_series.append(updated_model)
+            fit_times.append(self.file_time(_file))
+
+            if freeze and len(fit_times) == self.freeze_after:
+                frozen_record.update(self.select_frozen(_base_name, time_series))
+
+            # Re-center the filter on the DREAM result
+            if use_dream and self._filter is not None:
+                self._filter.reset(updated_model)
 
             model_utils.print_model(time_series[-2], time_series[-1])
 
@@ -224,6 +2323,24 @@ class FittingLoop:
             item_time = time.time() - t1
             t1 = time.time()
             print("    Completed: %g s [total=%g m]" % (item_time, total_time))
+            self.archive_slice(_base_name)
+
+        # Second stage of the "lm" engine: uncertainties for selected data sets
+        if self.engine == "lm":
+            self.run_dream_batch(
+                [lm_inputs[i] for i in self.select_dream_slices(lm_chisq)]
+            )
+
+        if self.engine in ["filter", "lm"]:
+            print(f"Data sets fit with DREAM: {self.dream_slices}")
+
+        if self.fit_budgets:
+            with open(os.path.join(self.results_dir, "fit-budget.json"), "w") as fd:
+                json.dump(self.fit_budgets, fd, indent=2)
+
+        if frozen_record:
+            with open(os.path.join(self.results_dir, freezing.FROZEN_FILE), "w") as fd:
+                json.dump(frozen_record, fd, indent=2)
 
 
 def execute_fit(
@@ -236,6 +2353,10 @@ def execute_fit(
     first_item: int = 0,
     last_item: int = -1,
     fit_forward: bool = True,
+    covariance_prior: bool = False,
+    engine: str = "dream",
+    cores: Optional[int] = None,
+    **fit_options: Any,
 ) -> None:
     """
     Execute the fitting loop.
@@ -260,6 +2381,16 @@ def execute_fit(
         Index of the last data file to use (default: -1, which means all files until the end).
     fit_forward : bool, optional
         Flag indicating whether to fit forward in time (default: True).
+    covariance_prior : bool, optional
+        If True, use the posterior covariance of each fit as a correlated
+        prior for the next one (default: False).
+    engine : str, optional
+        Fitting engine, either "dream", "filter", "lm", "amortized" or
+        "global" (default: "dream").
+    cores : int, optional
+        Number of cores the fits may use (default: None, no budget).
+    fit_options : dict, optional
+        Additional fitting options passed to FittingLoop.
 
     """
     model_dir, model_name = os.path.split(model_file)
@@ -299,6 +2430,10 @@ def execute_fit(
         initial_expt_file=initial_expt_file,
         final_err_file=final_err_file,
         final_expt_file=final_expt_file,
+        covariance_prior=covariance_prior,
+        engine=engine,
+        cores=cores,
+        **fit_options,
     )
 
     loop.print_initial_final()
@@ -311,14 +2446,37 @@ def execute_fit(
 
     try:
         loop.fit(_good_files[first_item:last_item], fit_forward=fit_forward)
-    except Exception as e:
-        print(f"Error: {e}")
+    except Exception:
+        # Failed fits are skipped by the loop, so this is not a refl1d failure
+        print(f"Fitting loop of run {dynamic_run} stopped, last refl1d output:")
         print(loop.last_output)
+        raise
+
+
+def execute_fits(runs: List[Dict[str, Any]], cores: Optional[int] = None) -> None:
+    """
+    Execute the fitting loop for several runs concurrently.
+
+    Parameters
+    ----------
+    runs : list
+        Keyword arguments of execute_fit for each run.
+    cores : int, optional
+        Total number of cores, split between the runs (default: None,
+        runs are executed one at a time).
+
+    """
+    n_concurrent, run_cores = split_cores(cores, len(runs))
+    with ThreadPoolExecutor(n_concurrent) as executor:
+        futures = [
+            executor.submit(execute_fit, **dict(run, cores=run_cores)) for run in runs
+        ]
+        for future in futures:
+            future.result()
 
 
 if __name__ == "__main__":
     # Main execution block for running the fitting loop from the command line.
-    import sys
     import argparse
 
     parser: argparse.ArgumentParser = argparse.ArgumentParser(
@@ -342,6 +2500,91 @@ if __name__ == "__main__":
     parser.add_argument(
         "results_dir", type=str, help="Directory where the results will be stored."
     )
+    parser.add_argument(
+        "--covariance-prior",
+        action="store_true",
+        help="Use the posterior covariance of each fit as a prior for the next one.",
+    )
+    parser.add_argument(
+        "--cores",
+        type=int,
+        default=None,
+        help="Number of cores the fits may use.",
+    )
+    parser.add_argument(
+        "--compact-posterior",
+        action="store_true",
+        help="Save a thinned float32 posterior sample after each DREAM fit.",
+    )
+    parser.add_argument(
+        "--drop-chains",
+        action="store_true",
+        help="Delete the full DREAM chains once the compact posterior is saved.",
+    )
+    parser.add_argument(
+        "--change-budget",
+        action="store_true",
+        help="Scale the DREAM budget of each data set with its change from the previous one.",
+    )
+    parser.add_argument(
+        "--coarse-stride",
+        type=int,
+        default=0,
+        help="Fit every Nth data set first, then fill in the data sets in between.",
+    )
+    parser.add_argument(
+        "--fidelity-decimate",
+        type=int,
+        default=1,
+        help="Run the DREAM burn-in on every Nth Q point of the data.",
+    )
+    parser.add_argument(
+        "--freeze",
+        action="store_true",
+        help="Freeze the parameters that stay stable over the first data sets.",
+    )
+    parser.add_argument(
+        "--fit-cache",
+        type=str,
+        default=None,
+        help="Directory where fit results are cached and reused across reruns.",
+    )
+    parser.add_argument(
+        "--archive-results",
+        action="store_true",
+        help="Move the outputs of each fit to a single archive once it is done.",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="dream",
+        choices=["dream", "filter", "lm", "amortized", "global"],
+        help="Fitting engine.",
+    )
+    parser.add_argument(
+        "--fit-timeout",
+        type=float,
+        default=None,
+        help="Wall-clock time limit of each refl1d process, in seconds.",
+    )
+    parser.add_argument(
+        "--fit-retries",
+        type=int,
+        default=1,
+        help="Number of times a failed refl1d process is started again.",
+    )
+    parser.add_argument(
+        "--dream-every",
+        type=int,
+        default=0,
+        help="With the lm engine, fit every Nth data set with DREAM.",
+    )
+    parser.add_argument(
+        "--dream-last",
+        type=int,
+        default=0,
+        help="With the lm engine, fit the last N data sets with DREAM.",
+    )
 
     args: argparse.Namespace = parser.parse_args()
 
@@ -352,4 +2595,19 @@ if __name__ == "__main__":
         args.initial_expt_file,
         args.final_expt_file,
         args.results_dir,
+        covariance_prior=args.covariance_prior,
+        engine=args.engine,
+        cores=args.cores,
+        compact_posterior=args.compact_posterior,
+        keep_chains=not args.drop_chains,
+        change_budget=args.change_budget,
+        coarse_stride=args.coarse_stride,
+        fidelity_decimate=args.fidelity_decimate,
+        freeze=args.freeze,
+        fit_cache_dir=args.fit_cache,
+        archive_results=args.archive_results,
+        fit_timeout=args.fit_timeout,
+        fit_retries=args.fit_retries,
+        dream_every=args.dream_every,
+        dream_last=args.dream_last,
     )
@@ -0,0 +1,251 @@
+"""
+Selection of the parameters to freeze while fitting a series of time slices.
+
+The substrate parameters are pinned by the steady-state fits and barely move
+from one slice to the next. Freezing them once a few slices have been fitted
+reduces the dimension of the DREAM fits of the remaining slices.
+"""
+
+import numpy as np
+
+# Name of the file recording the frozen parameters of a fitting loop
+FROZEN_FILE = "frozen-parameters.json"
+
+# Probe parameters that are not part of the sample description
+NUISANCE_PARAMETERS = ["intensity", "background"]
+
+
+def steady_state_shifts(initial_model, final_model):
+    """
+    Return the change of each parameter between the two steady states.
+
+    Parameters
+    ----------
+    initial_model, final_model : dict
+        Content of the -err.json files of the steady-state fits
+
+    Returns
+    -------
+        dict of changes, in units of the combined uncertainty, keyed by parameter name
+    """
+    shifts = dict()
+    for name in initial_model:
+        if name not in final_model:
+            continue
+        delta = abs(final_model[name]["best"] - initial_model[name]["best"])
+        scale = np.hypot(initial_model[name]["std"], final_model[name]["std"])
+        shifts[name] = float(delta / scale) if scale > 0 else float(delta > 0) * np.inf
+    return shifts
+
+
+def trajectory_drifts(models):
+    """
+    Return the spread of each parameter over a series of fits.
+
+    Parameters
+    ----------
+    models : list
+        Content of the -err.json file of each fit
+
+    Returns
+    -------
+        dict of the standard deviation of the posterior means, in units of the
+        median posterior width, keyed by parameter name
+    """
+    names = [name for name in models[0] if all(name in m for m in models)]
+    means = np.asarray([[m[name]["mean"] for name in names] for m in models])
+    widths = np.median([[m[name]["std"] for name in names] for m in models], axis=0)
+    spread = np.std(means, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        drifts = np.where(widths > 0, spread / widths, np.where(spread > 0, np.inf, 0))
+    return dict(zip(names, drifts.tolist()))
+
+
+def largest_correlations(names, points, candidates):
+    """
+    Return the largest posterior correlation of each candidate with the other parameters.
+
+    Parameters
+    ----------
+    names : list
+        Name of each parameter
+    points : array
+        Posterior samples, with one row per sample
+    candidates : list
+        Names of the parameters that may be frozen. They are compared to the
+        parameters that are not candidates.
+
+    Returns
+    -------
+        dict of absolute correlations, keyed by candidate name
+    """
+    evolving = [i for i, name in enumerate(names) if name not in candidates]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = np.nan_to_num(np.corrcoef(np.asarray(points), rowvar=False))
+    corr = np.atleast_2d(corr)
+    return {
+        name: float(np.max(np.abs(corr[i, evolving]), initial=0))
+        for i, name in enumerate(names)
+        if name in candidates
+    }
+
+
+def frozen_value(name, models):
+    """
+    Return the inverse-variance weighted mean of a parameter over a series of fits.
+    """
+    means = np.asarray([m[name]["mean"] for m in models if name in m])
+    widths = np.asarray([m[name]["std"] for m in models if name in m])
+    if np.any(widths <= 0):
+        return float(np.mean(means))
+    return float(np.average(means, weights=1 / widths**2))
+
+
+def select_frozen(
+    initial_model,
+    final_model,
+    models,
+    posterior=None,
+    max_shift=1.0,
+    max_drift=0.5,
+    max_correlation=0.3,
+):
+    """
+    Select the parameters to freeze for the rest of a fitting loop.
+
+    A parameter is frozen when the two steady states agree on its value,
+    when its posterior mean is stable over the slices fitted so far, and
+    when its posterior is not correlated with the parameters that evolve.
+
+    Parameters
+    ----------
+    initial_model, final_model : dict
+        Content of the -err.json files of the steady-state fits
+    models : list
+        Content of the -err.json file of each slice fitted so far
+    posterior : tuple
+        Names and posterior samples of the last slice, used for the correlations
+    max_shift : float
+        Largest change between the steady states, in units of their combined uncertainty
+    max_drift : float
+        Largest spread of the posterior means over the slices, in units of the
+        posterior width
+    max_correlation : float
+        Largest absolute posterior correlation with an evolving parameter
+
+    Returns
+    -------
+        dict of the frozen value and of the selection statistics, keyed by parameter name
+    """
+    shifts = steady_state_shifts(initial_model, final_model)
+    drifts = trajectory_drifts(models) if len(models) > 1 else dict()
+    candidates = [
+        name
+        for name, shift in shifts.items()
+        if shift <= max_shift and drifts.get(name, 0) <= max_drift
+    ]
+    if len(models) > 1:
+        candidates = [name for name in candidates if name in drifts]
+
+    correlations = dict()
+    if posterior is not None:
+        correlations = largest_correlations(*posterior, candidates)
+        candidates = [
+            name for name in candidates if correlations.get(name, 0) <= max_correlation
+        ]
+
+    # The steady states are part of the trajectory of each parameter
+    trajectory = [initial_model, final_model] + list(models)
+    frozen = dict()
+    for name in candidates:
+        frozen[name] = dict(
+            value=frozen_value(name, trajectory),
+            shift=shifts[name],
+            drift=drifts.get(name),
+            correlation=correlations.get(name),
+        )
+    return frozen
+
+
+def estimate_nuisance(expt, data_list):
+    """
+    Estimate the normalization and background of a series of data sets.
+
+    Each data set is compared to the reflectivity of the same model, and the
+    weighted least-squares solution of R = intensity * R_model + background
+    is found for all data sets at once. The estimates are only meaningful
+    when the model describes the data well, such as the steady state a fit
+    starts from.
+
+    Parameters
+    ----------
+    expt : Experiment
+        Model the data sets are compared to
+    data_list : list
+        Q, R, dR and dQ (1-sigma) rows of each data set, as returned by
+        data_preparation.prepare_data
+
+    Returns
+    -------
+        array with one row per data set, and intensity and background columns
+    """
+    from refl1d.names import Experiment
+    from . import model_utils
+
+    # The model is only computed once for each distinct Q grid
+    grids = dict()
+    r_model = []
+    for q, r, dr, dq in data_list:
+        key = (q.tobytes(), dq.tobytes())
+        if key not in grids:
+            probe = model_utils.make_probe(q, dq)
+            grids[key] = Experiment(probe=probe, sample=expt.sample).reflectivity()[1]
+        r_model.append(grids[key])
+
+    index = np.repeat(np.arange(len(data_list)), [len(d[0]) for d in data_list])
+    m = np.concatenate(r_model)
+    r = np.concatenate([d[1] for d in data_list])
+    w = 1 / np.concatenate([d[2] for d in data_list]) ** 2
+
+    def _sum(values):
+        return np.bincount(index, w * values, minlength=len(data_list))
+
+    s_mm, s_m, s_1 = _sum(m * m), _sum(m), _sum(np.ones_like(m))
+    s_mr, s_r = _sum(m * r), _sum(r)
+    det = s_mm * s_1 - s_m**2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        intensity = (s_mr * s_1 - s_m * s_r) / det
+        background = (s_mm * s_r - s_m * s_mr) / det
+    return np.column_stack([intensity, background])
+
+
+def frozen_stats(frozen_values):
+    """
+    Return -err.json entries for frozen parameters, with no uncertainty.
+
+    Parameters
+    ----------
+    frozen_values : dict
+        Frozen value of each parameter
+
+    Returns
+    -------
+        dict of statistics, keyed by parameter name
+    """
+    stats = dict()
+    for name, value in frozen_values.items():
+        value = float(value)
+        stats[name] = dict(
+            best=value,
+            frozen=True,
+            integer=False,
+            label=name,
+            mean=value,
+            median=value,
+            p68=[value, value],
+            p68_range=[value, value],
+            p95=[value, value],
+            p95_range=[value, value],
+            std=0.0,
+        )
+    return stats
@@ -0,0 +1,260 @@
+"""
+Joint fit of all the time slices of a run.
+
+Static parameters are shared between all slices, while time-varying
+parameters are represented as B-splines in time. All slices are fit at
+once, with the reflectivity of each slice computed in a process pool.
+"""
+
+import os
+import json
+import multiprocessing
+
+import numpy as np
+
+from . import model_utils
+
+# Problems loaded by each worker process, keyed by slice index
+_WORKER_PROBLEMS = dict()
+_WORKER_INPUTS = None
+
+
+def _init_worker(model_file, slice_inputs):
+    global _WORKER_INPUTS
+    _WORKER_INPUTS = (model_file, slice_inputs)
+    _WORKER_PROBLEMS.clear()
+
+
+def _get_problem(index):
+    from bumps.fitproblem import load_problem
+
+    if index not in _WORKER_PROBLEMS:
+        model_file, slice_inputs = _WORKER_INPUTS
+        _WORKER_PROBLEMS[index] = load_problem(model_file, list(slice_inputs[index]))
+    return _WORKER_PROBLEMS[index]
+
+
+def _slice_residuals(indices, points):
+    """
+    Return the residuals of a group of slices, one array per slice.
+    """
+    residuals = []
+    for index, point in zip(indices, points):
+        problem = _get_problem(index)
+        problem.setp(point)
+        residuals.append(problem.residuals())
+    return residuals
+
+
+def spline_basis(times, n_knots):
+    """
+    Return the B-spline design matrix for a set of times.
+
+    The spline is cubic when enough knots are available, and the
+    degree is reduced otherwise, down to a constant for a single knot.
+
+    Parameters
+    ----------
+    times : array
+        Time of each slice
+    n_knots : int
+        Number of spline coefficients
+
+    Returns
+    -------
+        array of shape (number of times, n_knots)
+    """
+    from scipy.interpolate import BSpline
+
+    times = np.asarray(times, dtype=float)
+    degree = min(3, n_knots - 1)
+    t_min, t_max = np.min(times), np.max(times)
+    inner = np.linspace(t_min, t_max, n_knots - degree + 1)[1:-1]
+    knots = np.hstack([[t_min] * (degree + 1), inner, [t_max] * (degree + 1)])
+    return BSpline.design_matrix(times, knots, degree).toarray()
+
+
+class GlobalFit:
+    """
+    Joint fit of a series of slices with static and time-varying parameters.
+    """
+
+    def __init__(
+        self,
+        model_file,
+        data_files,
+        times,
+        starting_expt,
+        starting_err,
+        static_parameters=None,
+        n_knots=5,
+        processes=None,
+    ):
+        """
+        Set up the joint problem.
+
+        Parameters
+        ----------
+        model_file : str
+            refl1d model file, as created by template.create_model
+        data_files : list
+            File path of each time slice
+        times : list
+            Time of each slice
+        starting_expt : str
+            -expt.json file of the starting model
+        starting_err : str
+            -err.json file of the starting model
+        static_parameters : list
+            Names of the parameters shared by all slices
+        n_knots : int
+            Number of spline coefficients for each time-varying parameter
+        processes : int
+            Number of worker processes (default: number of CPUs)
+        """
+        from bumps.fitproblem import load_problem
+
+        self.model_file = model_file
+        self.times = np.asarray(times, dtype=float)
+        self.slice_inputs = [(f, starting_expt, starting_err) for f in data_files]
+        self.processes = processes
+
+        problem = load_problem(model_file, list(self.slice_inputs[0]))
+        self.names = problem.labels()
+        self.bounds = problem.bounds()
+        self.start = problem.getp()
+
+        static_parameters = static_parameters or []
+        self.static = [i for i, n in enumerate(self.names) if n in static_parameters]
+        self.varying = [i for i, n in enumerate(self.names) if i not in self.static]
+        self.n_knots = min(n_knots, len(self.times))
+        self.basis = spline_basis(self.times, self.n_knots)
+
+    def slice_parameters(self, theta):
+        """
+        Return the parameters of each slice for a global parameter vector.
+
+        The global vector holds the static parameters, followed by the
+        spline coefficients of each time-varying parameter.
+        """
+        n_static = len(self.static)
+        points = np.tile(self.start, (len(self.times), 1))
+        points[:, self.static] = theta[:n_static]
+        coeffs = theta[n_static:].reshape(len(self.varying), self.n_knots)
+        points[:, self.varying] = self.basis @ coeffs.T
+        return points
+
+    def _global_bounds(self):
+        low, high = self.bounds
+        n = self.n_knots
+        lower = np.hstack([low[self.static], np.repeat(low[self.varying], n)])
+        upper = np.hstack([high[self.static], np.repeat(high[self.varying], n)])
+        return lower, upper
+
+    def fit(self, max_nfev=None):
+        """
+        Run the joint fit.
+
+        Parameters
+        ----------
+        max_nfev : int
+            Maximum number of evaluations of the joint problem
+
+        Returns
+        -------
+            tuple of the slice parameters, their standard errors and the
+            normalized chi^2 of each slice
+        """
+        from scipy.optimize import least_squares
+
+        lower, upper = self._global_bounds()
+        theta0 = np.hstack(
+            [self.start[self.static], np.repeat(self.start[self.varying], self.n_knots)]
+        )
+        margin = 1e-6 * (upper - lower)
+        theta0 = np.clip(theta0, lower + margin, upper - margin)
+
+        n_slices = len(self.times)
+        processes = self.processes or os.cpu_count()
+        chunks = np.array_split(np.arange(n_slices), min(processes, n_slices))
+
+        with multiprocessing.Pool(
+            processes,
+            initializer=_init_worker,
+            initargs=(self.model_file, self.slice_inputs),
+        ) as pool:
+
+            def slice_residuals(theta):
+                points = self.slice_parameters(theta)
+                results = pool.starmap(
+                    _slice_residuals, [(chunk, points[chunk]) for chunk in chunks]
+                )
+                return [r for chunk_result in results for r in chunk_result]
+
+            result = least_squares(
+                lambda theta: np.hstack(slice_residuals(theta)),
+                theta0,
+                bounds=(lower, upper),
+                max_nfev=max_nfev,
+            )
+            residuals = slice_residuals(result.x)
+
+        chisq = np.asarray([np.mean(r**2) for r in residuals])
+
+        # Propagate the covariance of the global parameters to each slice
+        jac = result.jac
+        theta_cov = (
+            np.linalg.pinv(jac.T @ jac)
+            * np.sum(result.fun**2)
+            / max(len(result.fun) - len(result.x), 1)
+        )
+        n_static = len(self.static)
+        std = np.zeros((n_slices, len(self.names)))
+        std[:, self.static] = np.sqrt(np.diag(theta_cov)[:n_static])
+        for j, i in enumerate(self.varying):
+            start = n_static + j * self.n_knots
+            block = theta_cov[
+                start : start + self.n_knots, start : start + self.n_knots
+            ]
+            std[:, i] = np.sqrt(np.einsum("ij,jk,ik->i", self.basis, block, self.basis))
+
+        return self.slice_parameters(result.x), std, chisq
+
+
+def save_trend(trend_file, names, times, values, errors, chisq):
+    """
+    Save per-slice results in the trend format written by summary_plots.trend_data.
+
+    Parameters
+    ----------
+    trend_file : str
+        Output json file
+    names : list
+        Name of each parameter
+    times : list
+        Time of each slice
+    values : array
+        Parameter values, with one row per slice
+    errors : array
+        Parameter uncertainties, with one row per slice
+    chisq : list
+        Normalized chi^2 of each slice
+    """
+    trend_data = {name: list(map(float, values[:, i])) for i, name in enumerate(names)}
+    trend_err = {name: list(map(float, errors[:, i])) for i, name in enumerate(names)}
+    with open(trend_file, "w") as fp:
+        json.dump(
+            [list(map(float, times)), trend_data, trend_err, list(map(float, chisq))],
+            fp,
+        )
+
+
+def save_slice_results(results_dir, base_names, model_name, names, values, errors):
+    """
+    Save the .par and -err.json files of each slice.
+    """
+    for base_name, best, std in zip(base_names, values, errors):
+        model_utils.save_stats(
+            os.path.join(results_dir, base_name, model_name),
+            model_utils.gaussian_stats(names, best, std),
+        )
@@ -1,16 +1,42 @@
+import io
 import os
 import json
+import hashlib
+import functools
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
 import numpy as np
 
-import refl1d
-from refl1d.names import QProbe, Parameter, SLD, Slab, Experiment
+from . import results_archive
 
-from bumps import serialize
+# refl1d and bumps are slow to import: they are imported where they are used
+if TYPE_CHECKING:
+    from refl1d.names import QProbe
 
 ERR_MIN_ROUGH = 3
 ERR_MIN_THICK = 5
 ERR_MIN_RHO = 0.2
 
+# Number of Q grids whose calculation points are kept by make_probe
+PROBE_CACHE_SIZE = 16
+
+# Q, dQ and calculation points of each Q grid, keyed by grid and oversampling
+_PROBE_GRIDS = OrderedDict()
+
+
+def prior_floor(name):
+    """
+    Return the minimum width of the prior for a parameter, based on its name.
+    """
+    if name.endswith("rho"):
+        return ERR_MIN_RHO
+    if name.endswith("thickness"):
+        return ERR_MIN_THICK
+    if name.endswith("interface"):
+        return ERR_MIN_ROUGH
+    return 0
+
 
 def print_model(model0, model1):
     print("                   Initial \t            Step")
@@ -39,13 +65,11 @@ def sample_from_json_file(
     If model_err_json is provided, it will be used to set the width of
     the prior distribution.
     """
-    with open(model_expt_json_file, "r") as fd:
-        expt = json.load(fd)
+    expt = results_archive.load_json(model_expt_json_file)
 
     err = None
     if model_err_json_file:
-        with open(model_err_json_file, "r") as fd:
-            err = json.load(fd)
+        err = results_archive.load_json(model_err_json_file)
 
     return sample_from_json(
         expt, model_err_json=err, prior_scale=prior_scale, set_ranges=set_ranges
@@ -61,6 +85,8 @@ def sample_from_json(
     If model_err_json is provided, it will be used to set the width of
     the prior distribution.
     """
+    from refl1d.names import SLD, Slab
+
     sample = None
     for layer in model_expt_json["sample"]["layers"]:
         # dict_keys(['type', 'name', 'thickness', 'interface', 'material', 'magnetism'])
@@ -164,6 +190,537 @@ def sample_from_json(
     return sample
 
 
+def covariance_from_state(state, portion=0.5):
+    """
+    Estimate the posterior mean and covariance from a DREAM state.
+
+    Parameters
+    ----------
+    state : MCMCDraw
+        DREAM state, as returned by bumps.dream.state.load_state
+    portion : float
+        Portion of the chains to use, starting from the end
+
+    Returns
+    -------
+        dict with the parameter names, mean and covariance, which
+        can be saved as a -cov.json file
+    """
+    draw = state.draw(portion=portion)
+    return covariance_from_points(draw.labels, draw.points)
+
+
+def covariance_from_points(names, points):
+    """
+    Estimate the posterior mean and covariance from posterior samples.
+
+    Parameters
+    ----------
+    names : list
+        Name of each parameter
+    points : array
+        Posterior samples, with one row per sample
+
+    Returns
+    -------
+        dict with the parameter names, mean and covariance, which
+        can be saved as a -cov.json file
+    """
+    points = np.asarray(points, dtype=float)
+    mean = np.mean(points, axis=0)
+    cov = np.atleast_2d(np.cov(points, rowvar=False))
+    return dict(names=list(names), mean=mean.tolist(), cov=cov.tolist())
+
+
+# Files written by refl1d holding the full DREAM state
+CHAIN_SUFFIXES = ["-chain.mc.gz", "-point.mc.gz", "-stats.mc.gz"]
+
+
+def save_posterior(model_path, state, n_draws=1000, portion=0.5):
+    """
+    Save a thinned posterior sample in float32, next to the DREAM state.
+
+    The samples are written to <model_path>-posterior.npy, which can be
+    memory-mapped, and the parameter names to <model_path>-posterior.json.
+
+    Parameters
+    ----------
+    model_path : str
+        Path of the fit results, without extension
+    state : MCMCDraw
+        DREAM state, as returned by bumps.dream.state.load_state
+    n_draws : int
+        Number of samples to keep
+    portion : float
+        Portion of the chains to use, starting from the end
+
+    Returns
+    -------
+        file path of the -posterior.npy file
+    """
+    draw = state.draw(portion=portion)
+    return save_posterior_points(
+        model_path,
+        draw.labels,
+        draw.points,
+        n_draws=n_draws,
+        portion=portion,
+        n_chain=len(draw.points),
+    )
+
+
+def save_posterior_points(model_path, names, points, n_draws=1000, **info):
+    """
+    Save posterior samples in the format written by save_posterior.
+
+    Parameters
+    ----------
+    model_path : str
+        Path of the fit results, without extension
+    names : list
+        Name of each parameter
+    points : array
+        Posterior samples, with one row per sample
+    n_draws : int
+        Number of evenly spaced samples to keep
+    info : dict
+        Additional information saved with the parameter names
+
+    Returns
+    -------
+        file path of the -posterior.npy file
+    """
+    index = np.unique(np.linspace(0, len(points) - 1, n_draws).astype(int))
+    np.save(f"{model_path}-posterior.npy", np.asarray(points)[index].astype(np.float32))
+    with open(f"{model_path}-posterior.json", "w") as fd:
+        json.dump(dict(names=list(names), **info), fd)
+    return f"{model_path}-posterior.npy"
+
+
+def load_posterior(model_path, n_draws=None):
+    """
+    Load a posterior sample saved with save_posterior.
+
+    Parameters
+    ----------
+    model_path : str
+        Path of the fit results, without extension
+    n_draws : int
+        If given, only read this number of evenly spaced samples
+
+    Returns
+    -------
+        tuple of the parameter names and the samples, with one row
+        per sample. Without n_draws, the samples are memory-mapped, unless
+        they are read from a results archive.
+    """
+    names = results_archive.load_json(f"{model_path}-posterior.json")["names"]
+    if os.path.isfile(f"{model_path}-posterior.npy"):
+        points = np.load(f"{model_path}-posterior.npy", mmap_mode="r")
+    else:
+        points = np.load(
+            io.BytesIO(results_archive.read_bytes(f"{model_path}-posterior.npy"))
+        )
+    if n_draws is not None and n_draws < len(points):
+        index = np.unique(np.linspace(0, len(points) - 1, n_draws).astype(int))
+        points = np.asarray(points[index])
+    return names, points
+
+
+def has_posterior(model_path):
+    """
+    Return True if a compact posterior sample was saved for a fit.
+    """
+    return results_archive.isfile(f"{model_path}-posterior.npy")
+
+
+def remove_chains(model_path):
+    """
+    Delete the full DREAM state of a fit, keeping its other outputs.
+    """
+    for suffix in CHAIN_SUFFIXES:
+        if os.path.isfile(f"{model_path}{suffix}"):
+            os.remove(f"{model_path}{suffix}")
+
+
+def posterior_points(model_path, n_draws=1000, portion=0.5):
+    """
+    Return posterior samples of a fit, from its compact posterior or its DREAM state.
+
+    Parameters
+    ----------
+    model_path : str
+        Path of the fit results, without extension
+    n_draws : int
+        Number of evenly spaced samples to read
+    portion : float
+        Portion of the chains to use when reading the DREAM state
+
+    Returns
+    -------
+        tuple of the parameter names and the samples, or None if the fit
+        has no posterior sample
+    """
+    if has_posterior(model_path):
+        names, points = load_posterior(model_path, n_draws=n_draws)
+        return names, np.asarray(points, dtype=float)
+    if not results_archive.isfile(f"{model_path}{CHAIN_SUFFIXES[0]}"):
+        return None
+
+    from bumps.dream.state import load_state
+
+    with results_archive.local_files(model_path, CHAIN_SUFFIXES) as local_path:
+        draw = load_state(local_path).draw(portion=portion)
+    index = np.unique(np.linspace(0, len(draw.points) - 1, n_draws).astype(int))
+    return list(draw.labels), draw.points[index]
+
+
+def importance_weights(log_weights):
+    """
+    Return normalized importance weights from their logarithm.
+
+    Samples with a non-finite log-weight, such as those outside the
+    parameter ranges, get a weight of zero.
+    """
+    log_weights = np.asarray(log_weights, dtype=float)
+    finite = np.isfinite(log_weights)
+    weights = np.zeros(len(log_weights))
+    if np.any(finite):
+        weights[finite] = np.exp(log_weights[finite] - np.max(log_weights[finite]))
+        weights /= np.sum(weights)
+    return weights
+
+
+def effective_sample_size(weights):
+    """
+    Return the effective number of samples for a set of normalized importance weights.
+    """
+    norm = np.sum(np.asarray(weights) ** 2)
+    return 1.0 / norm if norm > 0 else 0.0
+
+
+def prior_covariance(model_cov_json, prior_scale=1):
+    """
+    Return the covariance matrix to use for a correlated prior.
+
+    The posterior covariance is scaled by prior_scale**2 and the
+    minimum prior widths are added to its diagonal as variances, so
+    that a parameter that was tightly constrained in the previous
+    fit is still allowed to move.
+
+    Parameters
+    ----------
+    model_cov_json : dict
+        Content of a -cov.json file
+    prior_scale : float
+        Optional parameter to multiply the width of the Bayesian prior by
+    """
+    cov = prior_scale**2 * np.asarray(model_cov_json["cov"])
+    floors = np.asarray([prior_floor(name) for name in model_cov_json["names"]])
+    return cov + np.diag(floors**2)
+
+
+@functools.lru_cache(maxsize=None)
+def _correlated_prior_problem():
+    """
+    Create the CorrelatedPriorProblem class, which derives from FitProblem.
+    """
+    from refl1d.names import FitProblem
+
+    class CorrelatedPriorProblem(FitProblem):
+        """
+        FitProblem with a multivariate Gaussian prior on the fit parameters.
+
+        Parameters not found in the list of names keep their own prior.
+        DREAM sees the prior through parameter_nllf. The Levenberg-Marquardt
+        fitters of bumps minimize residuals() followed by parameter_residuals(),
+        so the whitened prior residuals are added to parameter_residuals only,
+        and not to residuals(), where they would be counted twice.
+        """
+
+        def __init__(self, models, names, mean, cov, **kwargs):
+            super().__init__(models, **kwargs)
+            labels = self.labels()
+            idx = [i for i, name in enumerate(names) if name in labels]
+            self.prior_names = [names[i] for i in idx]
+            self._prior_index = [labels.index(name) for name in self.prior_names]
+            self._prior_mean = np.asarray(mean)[idx]
+            _cov = np.asarray(cov)[np.ix_(idx, idx)]
+            self._prior_whitening = np.linalg.inv(np.linalg.cholesky(_cov))
+
+        def prior_residuals(self):
+            """
+            Return the whitened distance between the parameters and the prior mean.
+            """
+            delta = self.getp()[self._prior_index] - self._prior_mean
+            return self._prior_whitening @ delta
+
+        def parameter_nllf(self):
+            nllf, failing = super().parameter_nllf()
+            return nllf + 0.5 * np.sum(self.prior_residuals() ** 2), failing
+
+        def parameter_residuals(self):
+            return super().parameter_residuals() + list(self.prior_residuals())
+
+    CorrelatedPriorProblem.__qualname__ = "CorrelatedPriorProblem"
+    return CorrelatedPriorProblem
+
+
+def __getattr__(name):
+    # Classes deriving from refl1d types are created on first access
+    if name == "CorrelatedPriorProblem":
+        return _correlated_prior_problem()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def recenter_covariance(model_cov_json, values):
+    """
+    Return a copy of the content of a -cov.json file with a new mean.
+
+    Parameters
+    ----------
+    model_cov_json : dict
+        Content of a -cov.json file
+    values : dict
+        New values of the mean, keyed by parameter name
+    """
+    mean = [
+        values.get(name, mu)
+        for name, mu in zip(model_cov_json["names"], model_cov_json["mean"])
+    ]
+    return dict(model_cov_json, mean=mean)
+
+
+def predict_parameters(times, models, next_time, order=1, which="best"):
+    """
+    Extrapolate the parameters of a series of fits to a later time.
+
+    Each parameter is fit with a polynomial in time, which is then
+    evaluated at next_time. The order is reduced when too few fits
+    are available.
+
+    Parameters
+    ----------
+    times : list
+        Time of each fit
+    models : list
+        Content of the -err.json file of each fit
+    next_time : float
+        Time to extrapolate to
+    order : int
+        Order of the polynomial
+    which : str
+        Value to use for each fit, either 'best' or 'mean'
+
+    Returns
+    -------
+        dict of predicted values, keyed by parameter name
+    """
+    predicted = dict()
+    for name in models[-1]:
+        _times = [t for t, m in zip(times, models) if name in m]
+        _values = [m[name][which] for m in models if name in m]
+        deg = min(order, len(_times) - 1)
+        if deg < 1:
+            predicted[name] = _values[-1]
+            continue
+        coeffs = np.polyfit(_times, _values, deg)
+        predicted[name] = float(np.polyval(coeffs, next_time))
+    return predicted
+
+
+def predicted_expt_file(model_expt_json_file, values, output_file):
+    """
+    Write a copy of an experiment json file with new parameter values.
+
+    The values are clipped to the range of each fit parameter.
+
+    Parameters
+    ----------
+    model_expt_json_file : str
+        -expt.json file to start from
+    values : dict
+        New parameter values, keyed by parameter name
+    output_file : str
+        -expt.json file to write
+
+    Returns
+    -------
+        dict of the clipped values, keyed by parameter name
+    """
+    from bumps import serialize
+    from bumps.parameter import unique
+
+    expt = expt_from_json_file(model_expt_json_file, keep_original_ranges=True)
+    clipped = dict(values)
+    for par in unique(expt.parameters()):
+        if par.fixed or par.name not in values:
+            continue
+        value = values[par.name]
+        if par.bounds is not None:
+            value = float(np.clip(value, par.bounds[0], par.bounds[1]))
+        par.value = clipped[par.name] = value
+
+    with open(output_file, "w") as fd:
+        json.dump(serialize.serialize(expt), fd)
+    return clipped
+
+
+def fit_problem(expt, model_cov_json_file=None, prior_scale=1):
+    """
+    Return the FitProblem for an Experiment.
+
+    If model_cov_json_file is provided, the posterior covariance of the
+    previous fit will be used as a correlated prior.
+
+    Parameters
+    ----------
+    expt : Experiment
+        Experiment to fit
+    model_cov_json_file : str
+        -cov.json file containing the covariance from the previous fit
+    prior_scale : float
+        Optional parameter to multiply the width of the Bayesian prior by
+
+    Returns
+    -------
+        FitProblem
+    """
+    from refl1d.names import FitProblem
+
+    if not model_cov_json_file or prior_scale <= 0:
+        return FitProblem(expt)
+
+    cov = results_archive.load_json(model_cov_json_file)
+
+    return _correlated_prior_problem()(
+        expt, cov["names"], cov["mean"], prior_covariance(cov, prior_scale)
+    )
+
+
+def posterior_stats(names, points, best):
+    """
+    Compute the parameter statistics from a set of posterior samples.
+
+    The output follows the structure of the -err.json files written by
+    bumps after a DREAM fit, so that it can be used in their place.
+
+    Parameters
+    ----------
+    names : list
+        Name of each parameter
+    points : array
+        Posterior samples, with one row per sample
+    best : array
+        Best value of each parameter
+
+    Returns
+    -------
+        dict of statistics, keyed by parameter name
+    """
+    points = np.atleast_2d(points)
+    stats = dict()
+    for i, name in enumerate(names):
+        column = points[:, i]
+        p68 = np.percentile(column, [16, 84]).tolist()
+        p95 = np.percentile(column, [2.5, 97.5]).tolist()
+        stats[name] = dict(
+            best=float(best[i]),
+            index=i + 1,
+            integer=False,
+            label=name,
+            mean=float(np.mean(column)),
+            median=float(np.median(column)),
+            p68=p68,
+            p68_range=p68,
+            p95=p95,
+            p95_range=p95,
+            std=float(np.std(column)),
+        )
+    return stats
+
+
+def gaussian_stats(names, best, std):
+    """
+    Compute the parameter statistics for a Gaussian approximation of the posterior.
+
+    This is used for optimizers, such as Levenberg-Marquardt, that only
+    report the best value and the standard error of each parameter.
+
+    Parameters
+    ----------
+    names : list
+        Name of each parameter
+    best : array
+        Best value of each parameter
+    std : array
+        Standard error of each parameter
+
+    Returns
+    -------
+        dict of statistics, keyed by parameter name
+    """
+    stats = dict()
+    for i, name in enumerate(names):
+        value, err = float(best[i]), float(std[i])
+        p68 = [value - err, value + err]
+        p95 = [value - 1.96 * err, value + 1.96 * err]
+        stats[name] = dict(
+            best=value,
+            index=i + 1,
+            integer=False,
+            label=name,
+            mean=value,
+            median=value,
+            p68=p68,
+            p68_range=p68,
+            p95=p95,
+            p95_range=p95,
+            std=err,
+        )
+    return stats
+
+
+def save_fit_results(problem, model_path, stats):
+    """
+    Save the results of a fit not performed by the refl1d command line.
+
+    The problem is expected to be set to its best parameters. The files
+    follow the naming used by refl1d so that the results of all fitting
+    engines can be read the same way.
+
+    Parameters
+    ----------
+    problem : FitProblem
+        Problem that was fit
+    model_path : str
+        Output path, including the model name
+    stats : dict
+        Parameter statistics, as returned by posterior_stats
+    """
+    save_stats(model_path, stats)
+    problem.save(model_path)
+
+
+def save_stats(model_path, stats):
+    """
+    Save the best parameters and their statistics as .par and -err.json files.
+
+    Parameters
+    ----------
+    model_path : str
+        Output path, including the model name
+    stats : dict
+        Parameter statistics, as returned by posterior_stats
+    """
+    os.makedirs(os.path.dirname(model_path), exist_ok=True)
+    with open(f"{model_path}.par", "w") as fd:
+        for name, item in stats.items():
+            fd.write("%s %.15g\n" % (name, item["best"]))
+    with open(f"{model_path}-err.json", "w") as fd:
+        json.dump(stats, fd, indent=2)
+
+
 def fix_all_parameters(expt, verbose=False):
     """
     Fix all the parameters within an Experiment object
@@ -175,6 +732,8 @@ def fix_all_parameters(expt, verbose=False):
     verbose : bool
         If True, print out parameters that were not fixed
     """
+    from refl1d.names import Parameter
+
     pars = expt.parameters()
 
     def _fix_parameters(item):
@@ -194,9 +753,49 @@ def fix_all_parameters(expt, verbose=False):
     _fix_parameters(pars)
 
 
+def freeze_parameters(expt, model_frozen_json_file=None):
+    """
+    Fix parameters of an Experiment at the values given in a -frozen.json file.
+
+    Values are clipped to the fit range of their parameter, and parameters
+    with a value that is not finite are left free.
+
+    Parameters
+    ----------
+    expt : Experiment
+        Experiment object to process
+    model_frozen_json_file : str
+        -frozen.json file with the value of each frozen parameter, keyed by name
+
+    Returns
+    -------
+        list of the names of the parameters that were frozen
+    """
+    if not model_frozen_json_file:
+        return []
+
+    from bumps.parameter import unique
+
+    with open(model_frozen_json_file, "r") as fd:
+        values = json.load(fd)
+
+    frozen = []
+    for par in unique(expt.parameters()):
+        if par.name not in values or par.fixed or not np.isfinite(values[par.name]):
+            continue
+        value = values[par.name]
+        # A parameter is never pinned outside of its fit range
+        if par.bounds is not None:
+            value = float(np.clip(value, *par.bounds))
+        par.value = value
+        par.fixed = True
+        frozen.append(par.name)
+    return frozen
+
+
 def expt_from_json_file(
     model_expt_json_file: str,
-    probe: QProbe | None = None,
+    probe: "QProbe | None" = None,
     model_err_json_file: str = None,
     prior_scale: float = 1,
     set_ranges: bool = False,
@@ -231,7 +830,10 @@ def expt_from_json_file(
     -------
         Experiment
     """
-    with open(model_expt_json_file, "rt") as input_file:
+    from bumps import serialize
+    from refl1d.names import Experiment
+
+    with results_archive.open_text(model_expt_json_file) as input_file:
         serialized = input_file.read()
         serialized_dict = json.loads(serialized)
         expt = serialize.deserialize(serialized_dict, migration=True)
@@ -254,10 +856,130 @@ def expt_from_json_file(
     return expt
 
 
+def _grid_key(Q, dQ, oversampling):
+    digest = hashlib.sha1(Q.tobytes())
+    digest.update(dQ.tobytes())
+    digest.update(str(oversampling).encode())
+    return digest.hexdigest()
+
+
+def _subset_calc_q(Q, dQ, oversampling):
+    """
+    Return the calculation points of a cached grid that contains Q and dQ.
+    """
+    for grid_q, grid_dq, grid_oversampling, calc_q in _PROBE_GRIDS.values():
+        if grid_oversampling != oversampling or len(grid_q) < len(Q):
+            continue
+        index = np.searchsorted(grid_q, Q)
+        if np.any(index >= len(grid_q)):
+            continue
+        if np.array_equal(grid_q[index], Q) and np.array_equal(grid_dq[index], dQ):
+            if oversampling is None:
+                return np.unique(Q)
+            # Keep the points within the resolution of the subset
+            low = np.min(Q - 4 * dQ)
+            high = np.max(Q + 4 * dQ)
+            return calc_q[(calc_q >= low) & (calc_q <= high)]
+    return None
+
+
+def make_probe(Q, dQ, R=None, dR=None, oversampling=None, name=None):
+    """
+    Create a QProbe, reusing the calculation points of previous probes on the same Q grid.
+
+    The Q values at which the theory is computed, including the points used
+    to oversample the resolution, only depend on Q and dQ. The time slices of
+    a run share the same grid, so these points are computed once per grid,
+    or taken from a cached grid that contains Q, and only R and dR change.
+
+    Parameters
+    ----------
+    Q, dQ : array
+        Q values and their resolution (1-sigma), in increasing Q
+    R, dR : array
+        Measured reflectivity and its uncertainty
+    oversampling : int
+        Number of points used to oversample the resolution of each Q value
+    name : str
+        Name of the probe
+
+    Returns
+    -------
+        QProbe
+    """
+    import refl1d
+    from refl1d.names import QProbe
+
+    Q = np.array(Q, dtype=float)
+    dQ = np.array(dQ, dtype=float)
+    probe = QProbe(Q, dQ, R=R, dR=dR, name=name)
+
+    # The calculation points are set through the private _calc_Q attribute,
+    # which QProbe.calc_Q returns in refl1d 1.0. Other versions compute their own.
+    if not refl1d.__version__.startswith("1.0"):
+        if oversampling is not None:
+            probe.oversample(oversampling)
+        probe.oversampling = oversampling
+        return probe
+
+    key = _grid_key(Q, dQ, oversampling)
+    if key in _PROBE_GRIDS:
+        _PROBE_GRIDS.move_to_end(key)
+        calc_q = _PROBE_GRIDS[key][-1]
+    else:
+        calc_q = _subset_calc_q(Q, dQ, oversampling)
+        if calc_q is None:
+            if oversampling is not None:
+                probe.oversample(oversampling)
+            calc_q = probe.calc_Q
+        _PROBE_GRIDS[key] = (Q, dQ, oversampling, calc_q)
+        while len(_PROBE_GRIDS) > PROBE_CACHE_SIZE:
+            _PROBE_GRIDS.popitem(last=False)
+
+    probe.oversampling = oversampling
+    probe._calc_Q = calc_q
+    return probe
+
+
 def calculate_reflectivity(model_expt_json_file, q, q_resolution=0.025):
     """
-    Reflectivity calculation using refl1d
+    Reflectivity calculation using refl1d, with a resolution dQ/Q of q_resolution
     """
-    expt = expt_from_json_file(model_expt_json_file, q, q_resolution=q_resolution)
+    q = np.asarray(q, dtype=float)
+    probe = make_probe(q, q_resolution * q)
+    expt = expt_from_json_file(model_expt_json_file, probe=probe)
     _, r = expt.reflectivity()
     return r
+
+
+def change_statistic(data, previous_data, min_q=0.0):
+    """
+    Return the change in reflectivity between two data sets.
+
+    This is the mean of the squared difference between the two curves,
+    in units of their combined uncertainty, over the Q values they share.
+    It is close to 1 when the data sets are statistically identical.
+
+    Parameters
+    ----------
+    data : array
+        Q, R and dR of the data set
+    previous_data : array
+        Q, R and dR of the data set to compare to
+    min_q : float
+        Smallest Q value to include
+
+    Returns
+    -------
+        change statistic, or infinity if the data sets share no Q value
+    """
+    q, r, dr = np.asarray(data, dtype=float)[:3]
+    previous_q, previous_r, previous_dr = np.asarray(previous_data, dtype=float)[:3]
+    keep = q >= min_q
+    q, r, dr = q[keep], r[keep], dr[keep]
+    _, i, j = np.intersect1d(q, previous_q, return_indices=True)
+    if len(i) == 0:
+        return np.inf
+    return float(
+        np.mean((r[i] - previous_r[j]) ** 2 / (dr[i] ** 2 + previous_dr[j] ** 2))
+    )
@@ -0,0 +1,302 @@
+"""
+Per-run archive of fit results.
+
+The outputs of each time slice are appended to a single archive file in the
+results directory, with one index line per file, and removed from the slice
+directories. Only the files read back by the fitting loop and the summaries
+are archived.
+
+The readers in this module accept the path a file would have in the
+directory layout, so results can be read the same way from either layout.
+"""
+
+import io
+import os
+import json
+import tempfile
+import functools
+import threading
+import contextlib
+
+import numpy as np
+
+# Archive and index files, in the results directory of a run
+ARCHIVE_FILE = "results.archive"
+INDEX_FILE = "results.index"
+
+# Outputs of a fit that are kept in the archive
+ARCHIVED_SUFFIXES = [
+    ".par",
+    "-err.json",
+    "-expt.json",
+    "-refl.dat",
+    "-profile.dat",
+    "-cov.json",
+    "-posterior.npy",
+    "-posterior.json",
+    "-chain.mc.gz",
+    "-point.mc.gz",
+    "-stats.mc.gz",
+    "-fidelity-check.json",
+    "-dream.log",
+]
+
+# Appends to the same archive from concurrent fits are serialized
+_LOCKS = dict()
+_LOCKS_LOCK = threading.Lock()
+
+
+def _lock(results_dir):
+    with _LOCKS_LOCK:
+        return _LOCKS.setdefault(os.path.abspath(results_dir), threading.Lock())
+
+
+@functools.lru_cache(maxsize=32)
+def _read_index(index_file, size, mtime):
+    # The size and modification time are part of the key, so appends are seen
+    members = dict()
+    with open(index_file, "r") as fd:
+        for line in fd:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                # Line of an append that was interrupted
+                continue
+            members[item["name"]] = (item["offset"], item["size"])
+    return members
+
+
+def members(results_dir):
+    """
+    Return the offset and size of each file in the archive of a run.
+
+    Parameters
+    ----------
+    results_dir : str
+        Results directory of the run
+
+    Returns
+    -------
+        dict of (offset, size) tuples, keyed by the path of the file relative
+        to the results directory. The dict is empty if there is no archive.
+    """
+    index_file = os.path.join(results_dir, INDEX_FILE)
+    if not os.path.isfile(index_file):
+        return dict()
+    stat = os.stat(index_file)
+    return _read_index(os.path.abspath(index_file), stat.st_size, stat.st_mtime_ns)
+
+
+def append(results_dir, name, data):
+    """
+    Append a file to the archive of a run.
+
+    A file added again under the same name replaces the previous one.
+
+    Parameters
+    ----------
+    results_dir : str
+        Results directory of the run
+    name : str
+        Path of the file relative to the results directory
+    data : bytes
+        Content of the file
+    """
+    with _lock(results_dir):
+        with open(os.path.join(results_dir, ARCHIVE_FILE), "ab") as fd:
+            offset = fd.seek(0, os.SEEK_END)
+            fd.write(data)
+        # The index line is written last, so that an interrupted append is ignored.
+        # A partial line left by an interrupted append is ended first.
+        line = json.dumps(dict(name=name, offset=offset, size=len(data))) + "\n"
+        with open(os.path.join(results_dir, INDEX_FILE), "ab+") as fd:
+            if fd.seek(0, os.SEEK_END) > 0:
+                fd.seek(-1, os.SEEK_END)
+                if fd.read(1) != b"\n":
+                    line = "\n" + line
+            fd.write(line.encode())
+
+
+def archive_slice(results_dir, base_name, remove=True):
+    """
+    Move the outputs of a fit into the archive of its run.
+
+    Only the files of the results sub-directory whose name ends with one of
+    ARCHIVED_SUFFIXES are archived. The other files and the nested
+    sub-directories, such as the verification fits, are left in place. The
+    results sub-directory is removed once it is empty.
+
+    Parameters
+    ----------
+    results_dir : str
+        Results directory of the run
+    base_name : str
+        Name of the results sub-directory of the fit
+    remove : bool
+        If True, remove the archived files afterwards
+
+    Returns
+    -------
+        list of the archived files, relative to the results directory
+    """
+    slice_dir = os.path.join(results_dir, base_name)
+    archived = []
+    for name in sorted(os.listdir(slice_dir)):
+        path = os.path.join(slice_dir, name)
+        if not os.path.isfile(path) or not name.endswith(tuple(ARCHIVED_SUFFIXES)):
+            continue
+        with open(path, "rb") as fd:
+            append(results_dir, f"{base_name}/{name}", fd.read())
+        archived.append(f"{base_name}/{name}")
+        if remove:
+            os.remove(path)
+    if remove and not os.listdir(slice_dir):
+        os.rmdir(slice_dir)
+    return archived
+
+
+def archive_results(results_dir, remove=True):
+    """
+    Move the outputs of all the fits of a run into its archive.
+
+    Sub-directories without fit outputs, such as the inputs of the frozen
+    parameters, are left unchanged.
+
+    Parameters
+    ----------
+    results_dir : str
+        Results directory of the run
+    remove : bool
+        If True, remove the archived files afterwards
+
+    Returns
+    -------
+        number of archived files
+    """
+    n_files = 0
+    for base_name in sorted(os.listdir(results_dir)):
+        if os.path.isdir(os.path.join(results_dir, base_name)):
+            n_files += len(archive_slice(results_dir, base_name, remove=remove))
+    return n_files
+
+
+def _locate(path):
+    # Results directory and member name of a file in the directory layout
+    slice_dir, name = os.path.split(path)
+    results_dir, base_name = os.path.split(slice_dir)
+    member = f"{base_name}/{name}"
+    if member in members(results_dir):
+        return results_dir, member
+    return None
+
+
+def isfile(path):
+    """
+    Return True if a result file exists, on disk or in the archive of its run.
+    """
+    return os.path.isfile(path) or _locate(path) is not None
+
+
+def read_bytes(path):
+    """
+    Return the content of a result file, on disk or in the archive of its run.
+    """
+    if os.path.isfile(path):
+        with open(path, "rb") as fd:
+            return fd.read()
+    location = _locate(path)
+    if location is None:
+        raise FileNotFoundError(path)
+    results_dir, member = location
+    offset, size = members(results_dir)[member]
+    with open(os.path.join(results_dir, ARCHIVE_FILE), "rb") as fd:
+        fd.seek(offset)
+        return fd.read(size)
+
+
+def open_text(path):
+    """
+    Open a result file for reading text, on disk or in the archive of its run.
+    """
+    if os.path.isfile(path):
+        return open(path, "r")
+    return io.StringIO(read_bytes(path).decode())
+
+
+def loadtxt(path, **kwargs):
+    """
+    Read a result file with numpy.loadtxt, on disk or in the archive of its run.
+    """
+    with open_text(path) as fd:
+        return np.loadtxt(fd, **kwargs)
+
+
+def load_json(path):
+    """
+    Read a json result file, on disk or in the archive of its run.
+    """
+    with open_text(path) as fd:
+        return json.load(fd)
+
+
+@contextlib.contextmanager
+def local_files(model_path, suffixes):
+    """
+    Provide the outputs of a fit on disk, for readers that need file paths.
+
+    Files that are only found in the archive are extracted to a temporary
+    directory, which is removed on exit.
+
+    Parameters
+    ----------
+    model_path : str
+        Path of the fit results, without extension
+    suffixes : list
+        Suffixes of the files to provide
+
+    Yields
+    ------
+        path of the fit results, without extension, to read the files from
+    """
+    archived = [
+        suffix
+        for suffix in suffixes
+        if not os.path.isfile(f"{model_path}{suffix}")
+        and isfile(f"{model_path}{suffix}")
+    ]
+    if not archived:
+        yield model_path
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        local_path = os.path.join(directory, os.path.basename(model_path))
+        for suffix in suffixes:
+            if isfile(f"{model_path}{suffix}"):
+                with open(f"{local_path}{suffix}", "wb") as fd:
+                    fd.write(read_bytes(f"{model_path}{suffix}"))
+        yield local_path
+
+
+def write_bytes(path, data):
+    """
+    Write a result file next to the other outputs of its fit.
+
+    If the outputs of the fit were moved to the archive of its run, the file
+    is appended to the archive instead.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file in the directory layout
+    data : bytes
+        Content of the file
+    """
+    slice_dir, name = os.path.split(path)
+    results_dir, base_name = os.path.split(slice_dir)
+    if os.path.isdir(slice_dir) or not os.path.isfile(
+        os.path.join(results_dir, INDEX_FILE)
+    ):
+        with open(path, "wb") as fd:
+            fd.write(data)
+    else:
+        append(results_dir, f"{base_name}/{name}", data)
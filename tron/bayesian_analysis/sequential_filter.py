@@ -0,0 +1,192 @@
+"""
+Ensemble Kalman filter for time-resolved data sets.
+
+The fit parameters of the model are treated as a state vector that drifts
+from one time slice to the next. Each slice is assimilated with an ensemble
+smoother using multiple data assimilation (ES-MDA), which only requires
+forward reflectivity calculations and is much cheaper than a DREAM fit.
+"""
+
+import numpy as np
+
+from . import model_utils
+
+
+class EnsembleFilter:
+    """
+    Ensemble Kalman filter over the fit parameters of a refl1d problem.
+    """
+
+    def __init__(
+        self,
+        names,
+        mean,
+        std,
+        n_members=64,
+        process_noise=1.0,
+        n_iterations=4,
+        seed=None,
+    ):
+        """
+        Initialize the ensemble.
+
+        Parameters
+        ----------
+        names : list
+            Name of each fit parameter.
+        mean : array
+            Initial value of each parameter.
+        std : array
+            Initial uncertainty of each parameter.
+        n_members : int, optional
+            Number of ensemble members.
+        process_noise : float, optional
+            Width of the random walk between two slices, in units of the
+            minimum prior width of each parameter.
+        n_iterations : int, optional
+            Number of data assimilation steps for each slice.
+        seed : int, optional
+            Seed for the random number generator.
+
+        """
+        self.names = list(names)
+        self.process_noise = process_noise
+        self.n_iterations = n_iterations
+        self.rng = np.random.default_rng(seed)
+        self.ensemble = np.asarray(mean) + np.asarray(std) * self.rng.standard_normal(
+            (n_members, len(self.names))
+        )
+        self.chisq = np.zeros(n_members)
+
+    @classmethod
+    def from_problem(cls, problem, model_err_json, **kwargs):
+        """
+        Create an ensemble around the starting point of a problem.
+
+        Parameters
+        ----------
+        problem : FitProblem
+            Problem to take the parameters and starting values from.
+        model_err_json : dict
+            Content of the -err.json file of the previous fit.
+        kwargs : dict
+            Additional arguments passed to the constructor.
+
+        """
+        names = problem.labels()
+        std = [
+            (
+                model_err_json[name]["std"] + model_utils.prior_floor(name)
+                if name in model_err_json
+                else model_utils.prior_floor(name)
+            )
+            for name in names
+        ]
+        return cls(names, problem.getp(), std, **kwargs)
+
+    def reset(self, model_err_json):
+        """
+        Re-center the ensemble on the result of another fit.
+
+        Parameters
+        ----------
+        model_err_json : dict
+            Content of the -err.json file of the fit.
+
+        """
+        for i, name in enumerate(self.names):
+            if name in model_err_json:
+                self.ensemble[:, i] = model_err_json[name]["best"] + model_err_json[
+                    name
+                ]["std"] * self.rng.standard_normal(len(self.ensemble))
+
+    def _align(self, problem):
+        """
+        Return the ensemble with the columns ordered as the problem parameters.
+        """
+        names = problem.labels()
+        start = problem.getp()
+        ensemble = np.tile(start, (len(self.ensemble), 1))
+        for i, name in enumerate(names):
+            if name in self.names:
+                ensemble[:, i] = self.ensemble[:, self.names.index(name)]
+        self.names = names
+        return ensemble
+
+    def _evaluate(self, problem, ensemble):
+        """
+        Return the normalized residuals of each ensemble member.
+        """
+        residuals = []
+        for point in ensemble:
+            problem.setp(point)
+            residuals.append(problem.residuals())
+        return np.asarray(residuals)
+
+    def forecast(self, problem):
+        """
+        Propagate the ensemble to the next slice.
+
+        Parameters
+        ----------
+        problem : FitProblem
+            Problem for the next slice.
+
+        """
+        ensemble = self._align(problem)
+        low, high = problem.bounds()
+        width = np.where(np.isfinite(high - low), high - low, 0)
+        floors = np.asarray([model_utils.prior_floor(name) for name in self.names])
+        step = self.process_noise * np.where(floors > 0, floors, 0.01 * width)
+        ensemble += step * self.rng.standard_normal(ensemble.shape)
+        self.ensemble = np.clip(ensemble, low, high)
+
+    def update(self, problem):
+        """
+        Assimilate the data of a slice.
+
+        Parameters
+        ----------
+        problem : FitProblem
+            Problem holding the data for the slice.
+
+        Returns
+        -------
+        float
+            Normalized chi^2 of the best ensemble member.
+
+        """
+        ensemble = self._align(problem)
+        low, high = problem.bounds()
+        n_members = len(ensemble)
+        alpha = self.n_iterations
+
+        for _ in range(self.n_iterations):
+            residuals = self._evaluate(problem, ensemble)
+            # The residuals are normalized by the data uncertainties,
+            # so the observation error covariance is the identity.
+            d_x = ensemble - np.mean(ensemble, axis=0)
+            d_r = residuals - np.mean(residuals, axis=0)
+            c_xr = d_x.T @ d_r / (n_members - 1)
+            c_rr = d_r.T @ d_r / (n_members - 1)
+            noise = np.sqrt(alpha) * self.rng.standard_normal(residuals.shape)
+            gain = np.linalg.solve(c_rr + alpha * np.eye(len(c_rr)), c_xr.T).T
+            ensemble = np.clip(ensemble + (noise - residuals) @ gain.T, low, high)
+
+        residuals = self._evaluate(problem, ensemble)
+        self.chisq = np.mean(residuals**2, axis=1)
+        self.ensemble = ensemble
+        return float(np.min(self.chisq))
+
+    @property
+    def best(self):
+        """
+        Return the ensemble member with the lowest chi^2.
+        """
+        return self.ensemble[np.argmin(self.chisq)]
+
+    def stats(self):
+        """
+        Return the parameter statistics in the -err.json format.
+        """
+        return model_utils.posterior_stats(self.names, self.ensemble, self.best)
@@ -1,66 +1,130 @@
-import sys
+import io
 import os
 import json
+import hashlib
+import importlib
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
 import numpy as np
-from matplotlib import pyplot as plt
-import matplotlib.lines as mlines
 
-from matplotlib.path import Path
-from matplotlib.patches import PathPatch
+from . import data_preparation, fit_uncertainties, model_utils, results_archive
 
-try:
-    import bumps
-    from bumps import dream
-    HAS_BUMPS  = True
-except Exception:
+if TYPE_CHECKING:
+    from bumps.fitproblem import FitProblem
+
+
+class _LazyModule:
+    """
+        Module proxy that only imports the module on first attribute access.
+        matplotlib, bumps and refl1d are slow to import, and are not needed
+        until a plot is made.
+    """
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+
+plt = _LazyModule("matplotlib.pyplot")
+
+# Above this number of time slices, the summary only shows the reflectivity and SLD
+# as images, since figures with one curve per slice become unreadable.
+MAX_LINE_SLICES = 50
+
+HAS_BUMPS = importlib.util.find_spec("bumps") is not None
+if not HAS_BUMPS:
     print("Summary_plot could not import bumps")
-    HAS_BUMPS = False
 
-if HAS_BUMPS:
-    from . import fit_uncertainties, model_utils
-    from refl1d.names import FitProblem
+
+def load_problem(json_file: str) -> "FitProblem":
+    import bumps.cli
     from bumps.serialize import load_file
     from refl1d.bumps_interface import fitplugin
 
-
-def load_problem(json_file: str) -> FitProblem:
     bumps.cli.install_plugin(fitplugin)
     return load_file(json_file)
 
-def plot_sld(profile_file, label, show_cl=True, z_offset=0.0):
+def result_file(dyn_fit_dir, data_name, model_name, suffix):
+    """
+        Return the path of a refl1d output file for a time slice.
+        refl1d 1.0 numbers the outputs of each model, as in __model-1-profile.dat.
+    """
+    numbered = os.path.join(dyn_fit_dir, str(data_name), '%s-1-%s' % (model_name, suffix))
+    if results_archive.isfile(numbered):
+        return numbered
+    return os.path.join(dyn_fit_dir, str(data_name), '%s-%s' % (model_name, suffix))
+
+
+def sld_contour(profile_file):
+    """
+        Compute the 90% confidence band of an SLD profile from its DREAM chain.
+
+        :param profile_file: File containing the SLD profile.
+        :return: z, best, low and high arrays, or None if the chain is missing.
+    """
+    expt_file = profile_file.replace('-profile.dat', '-expt.json')
+    if '-1-' in profile_file:
+        profile_file = profile_file.replace('-1-', '-')
+    model_path = profile_file.replace('-profile.dat', '')
+
+    # Sanity check
+    mc_file = profile_file.replace('-profile.dat', '-chain.mc')
+    if not results_archive.isfile(mc_file):
+        mc_file = profile_file.replace('-profile.dat', '-chain.mc.gz')
+    if not results_archive.isfile(mc_file) and not model_utils.has_posterior(model_path):
+        print("Could not find: %s" % mc_file)
+        return None
+
+    from refl1d.names import FitProblem
+
+    # Load the model that was used for fitting, with its fitted parameters
+    expt = model_utils.expt_from_json_file(expt_file, set_ranges=True, keep_original_ranges=True)
+    problem = FitProblem(expt)
+
+    # Use the compact posterior sample when available
+    points = state = None
+    if model_utils.has_posterior(model_path):
+        names, points = model_utils.load_posterior(model_path)
+        points = np.asarray(points, dtype=float)[:, [names.index(name) for name in problem.labels()]]
+    else:
+        from bumps import dream
+
+        with results_archive.local_files(model_path, model_utils.CHAIN_SUFFIXES) as local_path:
+            state = dream.state.load_state(local_path)
+
+    # Draws are added until the band converges, in a fixed order so that the band is reproducible
+    contours, n_draws = fit_uncertainties.adaptive_sld_contour(problem, state, cl=90, align=-1,
+                                                               points=points, seed=0)
+    print("SLD band for %s: %d posterior draws" % (model_path, n_draws))
+    return contours[0]
+
+
+def plot_sld(profile_file, label, show_cl=True, z_offset=0.0, contour=None):
     """
         :param profile_file: File containing the SLD profile.
         :param label: Label for the plot.
         :param show_cl: Show the confidence limits.
         :param z_offset: Offset to apply to the z-axis when plotting.
+        :param contour: Confidence band computed with sld_contour. It is computed here if not provided.
     """
-    if not os.path.isfile(profile_file):
+    if not results_archive.isfile(profile_file):
         print("Could not find %s" % profile_file)
         return
 
-    pre_sld = np.loadtxt(profile_file).T
+    pre_sld = results_archive.loadtxt(profile_file).T
     linewidth = 1 if show_cl else 2
 
-    expt_file = profile_file.replace('-profile.dat', '-expt.json')
-    if '-1-' in profile_file:
-        profile_file = profile_file.replace('-1-', '-')
-
     if show_cl and HAS_BUMPS:
-        # Sanity check
-        mc_file = profile_file.replace('-profile.dat', '-chain.mc')
-        if not os.path.isfile(mc_file):
-            mc_file = profile_file.replace('-profile.dat', '-chain.mc.gz')
-        if not os.path.isfile(mc_file):
-            print("Could not find: %s" % mc_file)
+        if contour is None:
+            contour = sld_contour(profile_file)
+        if contour is None:
             return
 
-        # Load the model that was used for fitting
-        expt = model_utils.expt_from_json_file(expt_file, set_ranges=True)
-        problem = FitProblem(expt)
-        model_path = profile_file.replace('-profile.dat', '')
-        state = dream.state.load_state(model_path)
-
-        z, best, low, high = fit_uncertainties.get_sld_contour(problem, state, cl=90, align=-1)[0]
+        z, best, low, high = contour
 
         # Find the starting point of the distribution
         for i in range(len(best)-1, 0, -1):
@@ -76,9 +140,10 @@ def plot_sld(profile_file, label, show_cl=True, z_offset=0.0):
 
 
 def plot_dyn_data(dynamic_run, initial_state, final_state, first_index=0, last_index=-1,
-                  dyn_data_dir=None, dyn_fit_dir=None, model_name='__model', scale=1):
+                  dyn_data_dir=None, dyn_fit_dir=None, model_name='__model', scale=1, show=False):
     """
         Plot the dynamic data for a given run, and display the initial and final states.
+        The figure is left open for saving, and only displayed if show is True.
     """
     # Fit results
     pre_fit = None
@@ -118,22 +183,21 @@ def plot_dyn_data(dynamic_run, initial_state, final_state, first_index=0, last_i
     for _file in _good_files[first_index:last_index]:
         if _file.startswith('r%d_t' % dynamic_run):
             scale *= 1
-            _data = np.loadtxt(os.path.join(dyn_data_dir, _file)).T
+            _data = data_preparation.prepare_data(os.path.join(dyn_data_dir, _file), q_max=np.inf)
             _data_name, _ = os.path.splitext(_file)
             _time = int(_data_name.replace('r%d_t' % dynamic_run, ''))
             _label = '%d < t < %d s' % (_time, _time+delta_t)
  
             # Get fit if it exists
-            fit_file = os.path.join(dyn_fit_dir, _data_name, '%s-refl.dat' % model_name)
+            fit_file = result_file(dyn_fit_dir, _data_name, model_name, 'refl.dat')
 
-            if os.path.isfile(fit_file):
-                fit_data = np.loadtxt(fit_file).T
+            if results_archive.isfile(fit_file):
+                fit_data = results_archive.loadtxt(fit_file).T
                 plt.plot(fit_data[0], fit_data[4]*scale, markersize=2, marker='', linewidth=1, color='black')
 
-            if len(_data)>1:
-                idx = _data[2]<_data[1]
-                plt.errorbar(_data[0][idx], _data[1][idx]*scale,
-                             yerr=_data[2][idx]*scale, linewidth=1,
+            if _data.shape[1] > 0:
+                plt.errorbar(_data[0], _data[1]*scale,
+                             yerr=_data[2]*scale, linewidth=1,
                              markersize=2, marker='.',  linestyle='', label=_label)
 
                 scale *= multiplier
@@ -156,7 +220,8 @@ def plot_dyn_data(dynamic_run, initial_state, final_state, first_index=0, last_i
     plt.xscale('log')
     ax.yaxis.labelpad = 1
 
-    plt.show()
+    if show:
+        plt.show()
     return file_list
 
 
@@ -164,8 +229,15 @@ def plot_dyn_sld(file_list, initial_state, final_state,
                  dyn_fit_dir=None, model_name='__model',
                  show_cl=True, legend_font_size=6,
                  max_z=None, reverse=True, sld_range=None,
-                 initial_z_offset=0, final_z_offset=0
+                 initial_z_offset=0, final_z_offset=0,
+                 contours=None, show=False
                 ):
+    """
+        Plot the SLD profile of each time slice.
+        Confidence bands are taken from contours, a dict keyed by profile file, when provided.
+        The figure is left open for saving, and only displayed if show is True.
+    """
+    contours = contours or dict()
 
     fig, ax = plt.subplots(dpi=200, figsize=(5, 4.1))
     plt.subplots_adjust(left=0.15, right=.95, top=0.95, bottom=0.15)
@@ -178,9 +250,9 @@ def plot_dyn_sld(file_list, initial_state, final_state,
     delta_t = int(file_list[1][0]) - int(file_list[0][0])
 
     for _file in _file_list:
-        profile_file = os.path.join(dyn_fit_dir, str(_file[2]), '%s-profile.dat' % model_name)
+        profile_file = result_file(dyn_fit_dir, _file[2], model_name, 'profile.dat')
         plot_sld(profile_file, '%d < t < %d s' % (int(_file[0]), int(_file[0])+delta_t),
-                 show_cl=HAS_BUMPS and show_cl)
+                 show_cl=HAS_BUMPS and show_cl, contour=contours.get(profile_file))
             
     # Plot final OCP
     if final_state is not None:
@@ -194,7 +266,8 @@ def plot_dyn_sld(file_list, initial_state, final_state,
         plt.ylim(sld_range[0], sld_range[1])
     plt.xlabel('z ($\AA$)', fontsize=14)
     plt.ylabel('SLD ($10^{-6}/\AA^2$)', fontsize=14)
-    plt.show()
+    if show:
+        plt.show()
 
 
 def trend_data(file_list, initial_state, final_state, label='',
@@ -206,7 +279,7 @@ def trend_data(file_list, initial_state, final_state, label='',
     """
     # Get the varying parameters, which are assumed to be the same for all data sets
     par_file = os.path.join(dyn_fit_dir, str(file_list[0][2]), '%s.par' % model_name)
-    if not os.path.isfile(par_file):
+    if not results_archive.isfile(par_file):
         par_file = os.path.join(dyn_fit_dir, str(file_list[-1][2]), '%s.par' % model_name)
 
     trend_data = dict()
@@ -214,7 +287,7 @@ def trend_data(file_list, initial_state, final_state, label='',
     chi2 = []  #TODO: NOT FILLED YET WITH REFL1D V1
     timestamp = []
 
-    with open(par_file, 'r') as fd:
+    with results_archive.open_text(par_file) as fd:
         for line in fd.readlines():
             par = ' '.join(line.split(' ')[0:2])
             if 'intensity' not in par:
@@ -228,8 +301,8 @@ def trend_data(file_list, initial_state, final_state, label='',
         err_file = os.path.join(dyn_fit_dir, str(_file[2]), '%s.err' % model_name)
         err_json = os.path.join(dyn_fit_dir, str(_file[2]), '%s-err.json' % model_name)
 
-        if os.path.isfile(err_json):
-            with open(err_json) as fd:
+        if results_archive.isfile(err_json):
+            with results_archive.open_text(err_json) as fd:
                 m = json.load(fd)
                 for par in trend_data.keys():
                     trend_data[par].append(m[par][which])
@@ -243,8 +316,8 @@ def trend_data(file_list, initial_state, final_state, label='',
     steady_times = dict()
 
     initial_file = os.path.join(fit_dir, str(initial_state), '__model-expt.json')
-    if os.path.isfile(initial_file):
-        with open(initial_file) as fd:
+    if results_archive.isfile(initial_file):
+        with results_archive.open_text(initial_file) as fd:
             m = json.load(fd)
             for par in trend_data.keys():
                 for layer in m['sample']['layers']:
@@ -261,8 +334,8 @@ def trend_data(file_list, initial_state, final_state, label='',
 
     
     final_file = os.path.join(fit_dir, str(final_state), '__model-expt.json')
-    if os.path.isfile(final_file):
-        with open(final_file) as fd:
+    if results_archive.isfile(final_file):
+        with results_archive.open_text(final_file) as fd:
             m = json.load(fd)
             for par in trend_data.keys():
                 for layer in m['sample']['layers']:
@@ -347,7 +420,22 @@ def write_md_table(trend_data_file):
                 output.write(entry)
 
 
-def detect_changes(dynamic_run, dyn_data_dir, first=0, last=-1, out_array=None):
+def detect_changes(dynamic_run, dyn_data_dir, first=0, last=-1, out_array=None, prepared=False):
+    """
+        Plot the change between consecutive data sets of a dynamic run.
+
+        The change is model_utils.change_statistic, over the Q values shared by
+        both data sets.
+
+        :param dynamic_run: Run number.
+        :param dyn_data_dir: Directory containing the data sets.
+        :param first: Index of the first data set.
+        :param last: Index of the last data set, which is excluded.
+        :param out_array: Prefix of the output files, if given.
+        :param prepared: If True, compare the points returned by data_preparation.prepare_data,
+                         as the fitting loop does to set the DREAM budget.
+        :return: Times and changes, for each data set after the first.
+    """
 
     compiled_array = []
     compiled_times = []
@@ -363,9 +451,7 @@ def detect_changes(dynamic_run, dyn_data_dir, first=0, last=-1, out_array=None):
     t = []
     skipped = 0
     previous = None
-    previous_q = None
-    previous_err = None
-    
+
     min_q = 0.0154
     for _file in _good_files[first:last]:
         if _file.startswith('r%d_t' % dynamic_run):
@@ -378,52 +464,19 @@ def detect_changes(dynamic_run, dyn_data_dir, first=0, last=-1, out_array=None):
             compiled_array.append([_data[0][idx], _data[1][idx], _data[2][idx]])
             compiled_times.append(_time)
 
+            _points = _data[:3]
+            if prepared:
+                _points = data_preparation.prepare_data(os.path.join(dyn_data_dir, _file))
             if previous is not None:
-                if len(_data[1]) == len(previous):
-                    delta = np.mean((_data[1]-previous)**2/(_data[2]**2+previous_err**2))
-                    chi2.append(delta)
-                    _asym = np.mean((_data[1]-previous)/(_data[1]+previous))
-                    asym.append(_asym)
-                    t.append(_time)
-                    
-                elif True:
-                    old_r = []
-                    old_err = []
-                    new_r = []
-                    new_err = []
-                    
-                    for i, q in enumerate(_data[0]):
-                        idx = np.argwhere(previous_q == q)
-                        #print(idx)
-                        if len(idx) > 0:
-                            new_r.append(_data[1][i])
-                            new_err.append(_data[2][i])
-                            old_r.append(previous[idx[0][0]])
-                            old_err.append(previous_err[idx[0][0]])
-
-                    old_r = np.asarray(old_r)
-                    old_err = np.asarray(old_err)
-                    new_r = np.asarray(new_r)
-                    new_err = np.asarray(new_err)
-
-                    delta = np.mean((new_r - old_r)**2 / (new_err**2 + old_err**2))
-                    #delta = np.mean((new_r - old_r)**2 / (new_err**2))
-                    chi2.append(delta)
-                    _asym = np.mean((new_r-old_r)/(new_r+old_r))
-                    asym.append(_asym)
-                    t.append(_time)
-                
-                previous_q = _data[0]
-                previous = _data[1]
-                previous_err = _data[2]
-
-                        
-                    #print("Unequal length: %s" % _file)
+                delta = model_utils.change_statistic(_points, previous)
+                chi2.append(delta)
+                _, i, j = np.intersect1d(_points[0], previous[0], return_indices=True)
+                _asym = np.mean((_points[1][i]-previous[1][j])/(_points[1][i]+previous[1][j]))
+                asym.append(_asym)
+                t.append(_time)
             else:
                 print("Ref %s" % _file)
-                previous_q = _data[0]
-                previous = _data[1]
-                previous_err = _data[2]
+            previous = _points
 
     if out_array:
         #np.save(out_array, np.asarray(compiled_array))
@@ -520,25 +573,409 @@ def package_json_data(dynamic_run, dyn_data_dir, out_array=None):
         
     return compiled_times, compiled_array
 
-def main(dynamic_run, dyn_data_dir, model_file, initial_state, final_state, results_dir,
-         first_item=0, last_item=-1):
+def bin_onto_grid(x_list, y_list, edges):
+    """
+        Average a set of curves onto a common grid, with one row per curve.
+        All the points are binned at once, so the cost does not depend on the number of curves.
+
+        :param x_list: List of x arrays, one per curve.
+        :param y_list: List of y arrays, one per curve.
+        :param edges: Bin edges of the common grid.
+        :return: Array of shape (number of curves, number of bins), with NaN in empty bins.
+    """
+    n_rows, n_bins = len(x_list), len(edges) - 1
+    rows = np.repeat(np.arange(n_rows), [len(x) for x in x_list])
+    x = np.concatenate(x_list)
+    y = np.concatenate(y_list)
+    cols = np.searchsorted(edges, x, side='right') - 1
+    # The last bin includes its upper edge
+    cols[x == edges[-1]] = n_bins - 1
+    valid = (cols >= 0) & (cols < n_bins) & np.isfinite(y)
+    flat = rows[valid] * n_bins + cols[valid]
+    sums = np.bincount(flat, weights=y[valid], minlength=n_rows * n_bins)
+    counts = np.bincount(flat, minlength=n_rows * n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        grid = sums / counts
+    return grid.reshape(n_rows, n_bins)
+
+
+def _time_edges(times):
+    # Edges of the time bins, centered on each time
+    times = np.asarray(times, dtype=float)
+    if len(times) < 2:
+        return np.asarray([times[0] - 0.5, times[0] + 0.5])
+    mid = (times[1:] + times[:-1]) / 2
+    return np.hstack([2 * times[0] - mid[0], mid, 2 * times[-1] - mid[-1]])
+
+
+def plot_refl_map(file_list, dyn_data_dir, n_q=None, rq4=True, ax=None):
+    """
+        Show the reflectivity of all time slices as a time x Q image.
+
+        :param file_list: List of [time, name, name] entries, as returned by dyn_file_list.
+        :param dyn_data_dir: Directory containing the time slices.
+        :param n_q: Number of Q bins, on a logarithmic scale (default: number of points per slice).
+        :param rq4: If True, show R*Q^4 instead of R.
+        :param ax: Matplotlib axes to draw on.
+    """
+    ax = ax or plt.gca()
+    data = [data_preparation.prepare_data(os.path.join(dyn_data_dir, '%s.txt' % _file[1]), q_max=np.inf)
+            for _file in file_list]
+    q_list = [_data[0] for _data in data]
+    r_list = [_data[1] * _data[0]**4 if rq4 else _data[1] for _data in data]
+    q_all = np.concatenate(q_list)
+    n_q = n_q or int(np.median([len(q) for q in q_list]))
+    edges = np.logspace(np.log10(np.min(q_all)), np.log10(np.max(q_all)), n_q + 1)
+    grid = bin_onto_grid(q_list, r_list, edges)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        image = np.log10(np.where(grid > 0, grid, np.nan))
+    mesh = ax.pcolormesh(edges, _time_edges([_file[0] for _file in file_list]), image,
+                         shading='flat', rasterized=True)
+    ax.set_xscale('log')
+    ax.set_xlabel('Q ($1/\\AA$)')
+    ax.set_ylabel('Time (seconds)')
+    plt.colorbar(mesh, ax=ax, label='log$_{10}$(RQ$^4$)' if rq4 else 'log$_{10}$(R)')
+    return grid
+
+
+def plot_residual_map(file_list, dyn_fit_dir, model_name='__model', n_q=None, ax=None):
+    """
+        Show the normalized residuals (R - theory) / dR of all fits as a time x Q image.
+
+        :param file_list: List of [time, name, name] entries, as returned by dyn_file_list.
+        :param dyn_fit_dir: Directory containing the fit results.
+        :param model_name: Name of the refl1d model.
+        :param n_q: Number of Q bins, on a logarithmic scale (default: number of points per slice).
+        :param ax: Matplotlib axes to draw on.
+    """
+    ax = ax or plt.gca()
+    times, q_list, res_list = [], [], []
+    for _file in file_list:
+        fit_file = result_file(dyn_fit_dir, _file[2], model_name, 'refl.dat')
+        if results_archive.isfile(fit_file):
+            fit_data = results_archive.loadtxt(fit_file).T
+            times.append(_file[0])
+            q_list.append(fit_data[0])
+            res_list.append((fit_data[2] - fit_data[4]) / fit_data[3])
+    if not times:
+        print("No fit results found in %s" % dyn_fit_dir)
+        return None
+    q_all = np.concatenate(q_list)
+    n_q = n_q or int(np.median([len(q) for q in q_list]))
+    edges = np.logspace(np.log10(np.min(q_all)), np.log10(np.max(q_all)), n_q + 1)
+    grid = bin_onto_grid(q_list, res_list, edges)
+    mesh = ax.pcolormesh(edges, _time_edges(times), grid, shading='flat', rasterized=True,
+                         cmap='RdBu_r', vmin=-3, vmax=3)
+    ax.set_xscale('log')
+    ax.set_xlabel('Q ($1/\\AA$)')
+    ax.set_ylabel('Time (seconds)')
+    plt.colorbar(mesh, ax=ax, label='(R - theory) / dR')
+    return grid
+
+
+def plot_sld_map(file_list, dyn_fit_dir, model_name='__model', n_z=300, max_z=None, ax=None):
+    """
+        Show the SLD profiles of all fits as a time x z image.
+        As in plot_sld, z is measured from the end of the profile.
+
+        :param file_list: List of [time, name, name] entries, as returned by dyn_file_list.
+        :param dyn_fit_dir: Directory containing the fit results.
+        :param model_name: Name of the refl1d model.
+        :param n_z: Number of z bins.
+        :param max_z: Largest z value to show.
+        :param ax: Matplotlib axes to draw on.
+    """
+    ax = ax or plt.gca()
+    times, z_list, sld_list = [], [], []
+    for _file in file_list:
+        profile_file = result_file(dyn_fit_dir, _file[2], model_name, 'profile.dat')
+        if results_archive.isfile(profile_file):
+            profile = results_archive.loadtxt(profile_file).T
+            times.append(_file[0])
+            z_list.append(profile[0][-1] - profile[0])
+            sld_list.append(profile[1])
+    if not times:
+        print("No SLD profiles found in %s" % dyn_fit_dir)
+        return None
+    z_max = max_z if max_z is not None else np.max(np.concatenate(z_list))
+    edges = np.linspace(0, z_max, n_z + 1)
+    grid = bin_onto_grid(z_list, sld_list, edges)
+    mesh = ax.pcolormesh(edges, _time_edges(times), grid, shading='flat', rasterized=True)
+    ax.set_xlabel('z ($\\AA$)')
+    ax.set_ylabel('Time (seconds)')
+    plt.colorbar(mesh, ax=ax, label='SLD ($10^{-6}/\\AA^2$)')
+    return grid
+
+
+def plot_dyn_maps(file_list, dyn_data_dir, dyn_fit_dir, model_name='__model', show=False):
+    """
+        Show the reflectivity, residual and SLD maps of a run in a single figure.
+        The figure has one image per panel, whatever the number of time slices.
+        The figure is left open for saving, and only displayed if show is True.
+    """
+    fig, axs = plt.subplots(3, 1, dpi=150, figsize=(6, 12))
+    plt.subplots_adjust(left=0.15, right=.95, top=0.98, bottom=0.05, hspace=0.3)
+    plot_refl_map(file_list, dyn_data_dir, ax=axs[0])
+    plot_residual_map(file_list, dyn_fit_dir, model_name=model_name, ax=axs[1])
+    plot_sld_map(file_list, dyn_fit_dir, model_name=model_name, ax=axs[2])
+    if show:
+        plt.show()
+
+
+def dyn_file_list(dynamic_run, dyn_data_dir, first_index=0, last_index=-1):
+    """
+        Return the [time, name, name] entries of the non-empty data sets of a run,
+        as returned by plot_dyn_data.
+    """
+    _good_files = [_f for _f in sorted(os.listdir(dyn_data_dir)) if _f.startswith('r%d_t' % dynamic_run)]
+    file_list = []
+    for _file in _good_files[first_index:last_index]:
+        _data = data_preparation.prepare_data(os.path.join(dyn_data_dir, _file), q_max=np.inf)
+        if _data.shape[1] > 0:
+            _data_name, _ = os.path.splitext(_file)
+            _time = int(_data_name.replace('r%d_t' % dynamic_run, ''))
+            file_list.append([_time, _data_name, _data_name])
+    return file_list
+
+
+def render_figure(plot_function, output_files, *args, **kwargs):
+    """
+        Draw a figure without displaying it, save it to each output file and close it.
+        This is meant to run in a worker process, where matplotlib uses the Agg backend.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    plot_function(*args, **kwargs)
+    for output_file in output_files:
+        plt.savefig(output_file)
+    plt.close('all')
+
+
+def _pool(processes=None):
+    # Spawned workers do not inherit the GUI state of the calling process
+    return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+
+
+class SummaryManifest:
+    """
+        Record of the inputs behind each summary artifact, with their content hashes,
+        so that only the artifacts whose inputs changed are regenerated.
+        Content hashes are only recomputed for files whose size or time stamp changed.
+    """
+    def __init__(self, results_dir, force=False):
+        self.path = os.path.join(results_dir, 'summary-manifest.json')
+        self.files = dict()
+        self.artifacts = dict()
+        if os.path.isfile(self.path) and not force:
+            with open(self.path) as fd:
+                data = json.load(fd)
+            self.files = data.get('files', dict())
+            self.artifacts = data.get('artifacts', dict())
+
+    def file_hash(self, path):
+        if not os.path.isfile(path):
+            # Results moved to the archive of their run are hashed on each call
+            if results_archive.isfile(path):
+                return hashlib.sha1(results_archive.read_bytes(path)).hexdigest()
+            return None
+        stat = os.stat(path)
+        cached = self.files.get(path)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as fd:
+            for block in iter(lambda: fd.read(1 << 20), b''):
+                digest.update(block)
+        self.files[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def inputs(self, files, settings=None):
+        """
+            Return the description of a set of input files and plot settings.
+        """
+        return dict(files={f: self.file_hash(f) for f in files}, settings=settings or dict())
+
+    def is_current(self, key, inputs, outputs):
+        """
+            Return True if the outputs of an artifact exist and were produced from the same inputs.
+        """
+        return self.artifacts.get(key) == inputs and all(results_archive.isfile(f) for f in outputs)
+
+    def update(self, key, inputs):
+        self.artifacts[key] = inputs
+
+    def save(self):
+        with open(self.path, 'w') as fd:
+            json.dump(dict(files=self.files, artifacts=self.artifacts), fd)
+
+
+def _contour_inputs(profile_file):
+    # Files used by sld_contour, where the DREAM state is named without the model number
+    model_path = profile_file.replace('-1-', '-').replace('-profile.dat', '')
+    return [profile_file, profile_file.replace('-profile.dat', '-expt.json'), model_path + '-chain.mc'] \
+        + [model_path + suffix for suffix in model_utils.CHAIN_SUFFIXES] + [model_path + '-posterior.npy']
+
+
+def _figure_files(results_dir, name, dynamic_run):
+    return [os.path.join(results_dir, '%s-%d.%s' % (name, dynamic_run, ext)) for ext in ['png', 'svg']]
+
+
+def _submit_run(executor, manifest, dynamic_run, dyn_data_dir, model_file, initial_state, final_state,
+                results_dir, first_item=0, last_item=-1):
+    """
+        Submit the reflectivity and trend figures and the SLD contours of a run,
+        for the artifacts whose inputs changed since they were last produced.
+        Return the futures, keyed by artifact, and the inputs of the SLD figure,
+        which needs the contours.
+    """
     initial_refl = initial_state.replace('expt.json', 'refl.dat')
     final_refl = final_state.replace('expt.json', 'refl.dat')
     model_name = os.path.basename(model_file).replace('.py', '')
+    file_list = dyn_file_list(dynamic_run, dyn_data_dir, first_item, last_item)
+    settings = dict(first_item=first_item, last_item=last_item, model_name=model_name)
+    futures = dict()
+
+    line_plots = len(file_list) <= MAX_LINE_SLICES
+
+    # Reflectivity data
+    _good_files = [_f for _f in sorted(os.listdir(dyn_data_dir)) if _f.startswith('r%d_t' % dynamic_run)]
+    _data_files = [os.path.join(dyn_data_dir, _f) for _f in _good_files[first_item:last_item]]
+    _fit_files = [result_file(results_dir, os.path.splitext(_f)[0], model_name, 'refl.dat')
+                  for _f in _good_files[first_item:last_item]]
+    inputs = manifest.inputs(_data_files + _fit_files + [initial_refl, final_refl], settings)
+    outputs = _figure_files(results_dir, 'dyn', dynamic_run)
+    if line_plots and not manifest.is_current('dyn-%d' % dynamic_run, inputs, outputs):
+        futures['dyn-%d' % dynamic_run] = (inputs, executor.submit(
+            render_figure, plot_dyn_data, outputs, dynamic_run, initial_refl, final_refl,
+            dyn_data_dir=dyn_data_dir, dyn_fit_dir=results_dir, model_name=model_name,
+            first_index=first_item, last_index=last_item, show=False))
+
+    # Fit parameters as a function of time
+    steady_dir = os.path.dirname(os.path.dirname(initial_state))
+    initial_dir = os.path.basename(os.path.dirname(initial_state))
+    final_dir = os.path.basename(os.path.dirname(final_state))
+    _err_files = [os.path.join(results_dir, str(_file[2]), '%s%s' % (model_name, ext))
+                  for _file in file_list for ext in ['-err.json', '.par']]
+    _steady_files = [os.path.join(steady_dir, d, '__model-expt.json') for d in [initial_dir, final_dir]]
+    inputs = manifest.inputs(_err_files + _steady_files, settings)
+    outputs = _figure_files(results_dir, 'trend', dynamic_run)
+    if not manifest.is_current('trend-%d' % dynamic_run, inputs, outputs):
+        futures['trend-%d' % dynamic_run] = (inputs, executor.submit(
+            render_figure, trend_data, outputs, file_list, initial_dir, final_dir,
+            fit_dir=steady_dir, dyn_fit_dir=results_dir, model_name=model_name))
+
+    # Reflectivity, residual and SLD images
+    profile_files = [result_file(results_dir, _file[2], model_name, 'profile.dat') for _file in file_list]
+    inputs = manifest.inputs(_data_files + _fit_files + profile_files, settings)
+    outputs = _figure_files(results_dir, 'maps', dynamic_run)
+    if not manifest.is_current('maps-%d' % dynamic_run, inputs, outputs):
+        futures['maps-%d' % dynamic_run] = (inputs, executor.submit(
+            render_figure, plot_dyn_maps, outputs, file_list, dyn_data_dir, results_dir,
+            model_name=model_name, show=False))
+
+    # SLD contours of each time slice, cached next to the profile
+    contours = dict()
+    for profile_file in profile_files:
+        if not line_plots or not HAS_BUMPS or not results_archive.isfile(profile_file):
+            continue
+        key = 'contour:%s' % profile_file
+        cache_file = profile_file.replace('-profile.dat', '-contour.npz')
+        inputs = manifest.inputs(_contour_inputs(profile_file))
+        if manifest.is_current(key, inputs, [cache_file]):
+            with np.load(io.BytesIO(results_archive.read_bytes(cache_file))) as cached:
+                contours[profile_file] = np.ma.masked_array(cached['data'], mask=cached['mask'])
+        else:
+            futures[key] = (inputs, executor.submit(sld_contour, profile_file))
 
-    # Generate plot of the reflectivity data
-    plotted_data = plot_dyn_data(dynamic_run, initial_refl, final_refl,
-                                 dyn_data_dir=dyn_data_dir, dyn_fit_dir=results_dir, model_name=model_name,
-                                 first_index=first_item, last_index=last_item)
-    plt.savefig(os.path.join(results_dir, 'dyn-%d.png' % dynamic_run))
-    plt.savefig(os.path.join(results_dir, 'dyn-%d.svg' % dynamic_run))
-
-    # Generate plot of the SLD profiles
     initial_sld = initial_state.replace('expt.json', 'profile.dat')
     final_sld = final_state.replace('expt.json', 'profile.dat')
+    _sld_files = [f for p in profile_files for f in _contour_inputs(p)]
+    sld_inputs = dict(key='sld-%d' % dynamic_run, file_list=file_list if line_plots else [],
+                      inputs=manifest.inputs(_sld_files + [initial_sld, final_sld], settings),
+                      initial_state=initial_sld, final_state=final_sld,
+                      output_files=_figure_files(results_dir, 'sld', dynamic_run),
+                      dyn_fit_dir=results_dir, model_name=model_name, contours=contours)
+    return futures, sld_inputs
+
 
-    plot_dyn_sld(plotted_data, initial_sld, final_sld,
-                 dyn_fit_dir=results_dir, 
-                 show_cl=True, model_name=model_name, legend_font_size=8)
-    plt.savefig(os.path.join(results_dir, 'sld-%d.png' % dynamic_run))
-    plt.savefig(os.path.join(results_dir, 'sld-%d.svg' % dynamic_run))
+def render_runs(runs, processes=None, force=False):
+    """
+        Render the summary figures of several runs on a pool of processes.
+        Only the figures and contours whose inputs changed are recomputed,
+        unless force is True.
+
+        :param runs: List of dicts of arguments of main, one per run.
+        :param processes: Number of worker processes (default: number of CPUs).
+        :param force: If True, regenerate all the figures and contours.
+    """
+    manifests = {run['results_dir']: SummaryManifest(run['results_dir'], force=force) for run in runs}
+
+    with _pool(processes) as executor:
+        submitted = [(run['results_dir'], _submit_run(executor, manifests[run['results_dir']], **run))
+                     for run in runs]
+
+        for results_dir, (futures, sld_inputs) in submitted:
+            manifest = manifests[results_dir]
+
+            # Cache the contours that were recomputed
+            contours = sld_inputs.pop('contours')
+            for key in [k for k in futures if k.startswith('contour:')]:
+                inputs, future = futures.pop(key)
+                profile_file = key[len('contour:'):]
+                contour = future.result()
+                if contour is not None:
+                    buffer = io.BytesIO()
+                    np.savez(buffer, data=np.ma.getdata(contour), mask=np.ma.getmaskarray(contour))
+                    results_archive.write_bytes(profile_file.replace('-profile.dat', '-contour.npz'),
+                                                buffer.getvalue())
+                    contours[profile_file] = contour
+                    manifest.update(key, inputs)
+
+            key = sld_inputs.pop('key')
+            inputs = sld_inputs.pop('inputs')
+            output_files = sld_inputs.pop('output_files')
+            if len(sld_inputs['file_list']) > 1 and not manifest.is_current(key, inputs, output_files):
+                futures[key] = (inputs, executor.submit(
+                    render_figure, plot_dyn_sld, output_files,
+                    sld_inputs.pop('file_list'), sld_inputs.pop('initial_state'), sld_inputs.pop('final_state'),
+                    show_cl=True, legend_font_size=8, contours=contours, show=False, **sld_inputs))
+
+            for key, (inputs, future) in futures.items():
+                future.result()
+                manifest.update(key, inputs)
+            manifest.save()
+
+
+def show_figures(results_dir, dynamic_run):
+    """
+        Display the saved summary figures of a run.
+
+        :param results_dir: Directory where the figures were saved.
+        :param dynamic_run: Run number of the dynamic data.
+    """
+    for name in ['dyn', 'sld', 'trend', 'maps']:
+        png_file = _figure_files(results_dir, name, dynamic_run)[0]
+        if not os.path.isfile(png_file):
+            continue
+        image = plt.imread(png_file)
+        fig = plt.figure(figsize=(image.shape[1] / 150, image.shape[0] / 150), dpi=150)
+        fig.canvas.manager.set_window_title(os.path.basename(png_file))
+        plt.axes([0, 0, 1, 1]).imshow(image)
+        plt.axis('off')
+    plt.show()
+
+
+def main(dynamic_run, dyn_data_dir, model_file, initial_state, final_state, results_dir,
+         first_item=0, last_item=-1, processes=None, force=False, show=False):
+    """
+        Save the reflectivity, SLD and trend figures of a run.
+        Figures and SLD contours are computed concurrently on a pool of processes,
+        and only when their inputs changed since the last call, unless force is True.
+        With show=True, the saved figures are then displayed.
+    """
+    render_runs([dict(dynamic_run=dynamic_run, dyn_data_dir=dyn_data_dir, model_file=model_file,
+                      initial_state=initial_state, final_state=final_state, results_dir=results_dir,
+                      first_item=first_item, last_item=last_item)],
+                processes=processes, force=force)
+    if show:
+        show_figures(results_dir, dynamic_run)
@@ -0,0 +1,314 @@
+"""
+Neural network surrogate for the reflectivity of a refl1d model.
+
+The surrogate is trained on reflectivity curves simulated over the
+parameter ranges of a model, as written by template.create_model,
+and is used to cheaply pre-screen the parameter space before the
+exact refl1d calculation takes over. It only runs on the CPU.
+"""
+
+import os
+import hashlib
+
+import numpy as np
+
+try:
+    import torch
+
+    HAS_TORCH = True
+except ImportError:
+    HAS_TORCH = False
+
+from . import model_utils
+
+# Smallest reflectivity used when taking the log
+R_MIN = 1e-12
+
+
+def surrogate_key(model_file, problem):
+    """
+    Return a key identifying a model file, its parameter ranges and Q values.
+
+    Parameters
+    ----------
+    model_file : str
+        refl1d model file
+    problem : FitProblem
+        Problem loaded from the model file
+    """
+    expt = list(problem.models)[0]
+    digest = hashlib.sha1()
+    with open(model_file, "rb") as fd:
+        digest.update(fd.read())
+    digest.update(" ".join(problem.labels()).encode())
+    digest.update(np.asarray(problem.bounds(), dtype=float).tobytes())
+    digest.update(np.asarray(expt.probe.Q, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+class ReflectivitySurrogate:
+    """
+    Multi-layer perceptron mapping fit parameters to log10(R) on a Q grid.
+    """
+
+    def __init__(self, names, bounds, q, hidden=128, n_layers=3):
+        """
+        Create an untrained surrogate.
+
+        Parameters
+        ----------
+        names : list
+            Name of each fit parameter
+        bounds : array
+            Parameter ranges, as a 2 x N array
+        q : array
+            Q values at which the reflectivity is predicted
+        hidden : int
+            Number of units in each hidden layer
+        n_layers : int
+            Number of hidden layers
+        """
+        if not HAS_TORCH:
+            raise ImportError("The reflectivity surrogate requires pytorch")
+        self.names = list(names)
+        self.bounds = np.asarray(bounds, dtype=float)
+        self.q = np.asarray(q, dtype=float)
+        self.hidden = hidden
+        self.n_layers = n_layers
+
+        layers = []
+        n_in = len(self.names)
+        for _ in range(n_layers):
+            layers += [torch.nn.Linear(n_in, hidden), torch.nn.SiLU()]
+            n_in = hidden
+        layers.append(torch.nn.Linear(n_in, len(self.q)))
+        self.network = torch.nn.Sequential(*layers).to("cpu")
+
+        # Output normalization, set during training
+        self.offset = np.zeros(len(self.q))
+        self.scale = np.ones(len(self.q))
+
+    def _normalize(self, points):
+        low, high = self.bounds
+        return (np.atleast_2d(points) - low) / (high - low)
+
+    def predict(self, points):
+        """
+        Return log10(R) on the surrogate Q grid for a set of parameter vectors.
+
+        Parameters
+        ----------
+        points : array
+            Parameter values, with one row per parameter set
+        """
+        x = torch.as_tensor(self._normalize(points), dtype=torch.float32)
+        with torch.no_grad():
+            y = self.network(x).numpy()
+        return y * self.scale + self.offset
+
+    def chisq(self, points, q, r, dr):
+        """
+        Return the normalized chi^2 of a set of parameter vectors for a data set.
+
+        The surrogate prediction is interpolated onto the Q values of the data.
+
+        Parameters
+        ----------
+        points : array
+            Parameter values, with one row per parameter set
+        q, r, dr : array
+            Measured reflectivity
+        """
+        log_r = self.predict(points)
+        theory = np.asarray([10 ** np.interp(q, self.q, curve) for curve in log_r])
+        return np.mean(((theory - r) / dr) ** 2, axis=1)
+
+    @classmethod
+    def train(cls, problem, n_samples=5000, epochs=300, batch_size=256, seed=None):
+        """
+        Train a surrogate on curves simulated over the parameter ranges of a problem.
+
+        Parameters
+        ----------
+        problem : FitProblem
+            Problem loaded from the model file, with finite parameter ranges
+        n_samples : int
+            Number of simulated curves
+        epochs : int
+            Number of training epochs
+        batch_size : int
+            Mini-batch size
+        seed : int
+            Seed for the random number generators
+        """
+        rng = np.random.default_rng(seed)
+        if seed is not None:
+            torch.manual_seed(seed)
+        expt = list(problem.models)[0]
+        bounds = problem.bounds()
+        surrogate = cls(problem.labels(), bounds, expt.probe.Q)
+
+        original = problem.getp()
+        points = rng.uniform(bounds[0], bounds[1], size=(n_samples, len(original)))
+        curves = []
+        for point in points:
+            problem.setp(point)
+            _, r = expt.reflectivity()
+            curves.append(np.log10(np.maximum(r, R_MIN)))
+        problem.setp(original)
+        curves = np.asarray(curves)
+
+        surrogate.offset = np.mean(curves, axis=0)
+        surrogate.scale = np.std(curves, axis=0) + 1e-6
+        x = torch.as_tensor(surrogate._normalize(points), dtype=torch.float32)
+        y = torch.as_tensor(
+            (curves - surrogate.offset) / surrogate.scale, dtype=torch.float32
+        )
+
+        optimizer = torch.optim.Adam(surrogate.network.parameters(), lr=1e-3)
+        scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs)
+        for _ in range(epochs):
+            order = torch.randperm(n_samples)
+            for i in range(0, n_samples, batch_size):
+                batch = order[i : i + batch_size]
+                optimizer.zero_grad()
+                loss = torch.mean((surrogate.network(x[batch]) - y[batch]) ** 2)
+                loss.backward()
+                optimizer.step()
+            scheduler.step()
+        return surrogate
+
+    def save(self, file_path):
+        """
+        Save the surrogate weights and settings.
+        """
+        torch.save(
+            dict(
+                names=self.names,
+                bounds=self.bounds,
+                q=self.q,
+                hidden=self.hidden,
+                n_layers=self.n_layers,
+                offset=self.offset,
+                scale=self.scale,
+                state=self.network.state_dict(),
+            ),
+            file_path,
+        )
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        Load a surrogate saved with save().
+        """
+        data = torch.load(file_path, map_location="cpu", weights_only=False)
+        surrogate = cls(
+            data["names"],
+            data["bounds"],
+            data["q"],
+            hidden=data["hidden"],
+            n_layers=data["n_layers"],
+        )
+        surrogate.offset = data["offset"]
+        surrogate.scale = data["scale"]
+        surrogate.network.load_state_dict(data["state"])
+        return surrogate
+
+
+def load_or_train(problem, model_file, cache_dir, **kwargs):
+    """
+    Return the surrogate for a model, training it if it is not in the cache.
+
+    Parameters
+    ----------
+    problem : FitProblem
+        Problem loaded from the model file
+    model_file : str
+        refl1d model file
+    cache_dir : str
+        Directory where trained surrogates are stored
+    kwargs : dict
+        Additional arguments passed to ReflectivitySurrogate.train
+    """
+    model_name = os.path.splitext(os.path.basename(model_file))[0]
+    cache_file = os.path.join(
+        cache_dir, f"{model_name}-{surrogate_key(model_file, problem)}.pt"
+    )
+    if os.path.isfile(cache_file):
+        return ReflectivitySurrogate.load(cache_file)
+
+    print(f"Training surrogate for {model_file}")
+    surrogate = ReflectivitySurrogate.train(problem, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    surrogate.save(cache_file)
+    return surrogate
+
+
+def prescreen(surrogate, problem, n_walkers=256, n_steps=200, n_exact=16, seed=None):
+    """
+    Find a starting point for a fit using the surrogate.
+
+    A population of random-walk Metropolis chains is run on the surrogate
+    likelihood, starting around the current parameters of the problem.
+    The best candidates are then evaluated with the exact refl1d model.
+
+    Parameters
+    ----------
+    surrogate : ReflectivitySurrogate
+        Trained surrogate for the model
+    problem : FitProblem
+        Problem holding the data to fit
+    n_walkers : int
+        Number of chains
+    n_steps : int
+        Number of steps for each chain
+    n_exact : int
+        Number of candidates evaluated with the exact model
+    seed : int
+        Seed for the random number generator
+
+    Returns
+    -------
+        dict of starting values, keyed by parameter name
+    """
+    rng = np.random.default_rng(seed)
+    expt = list(problem.models)[0]
+    q, r, dr = expt.probe.Q, expt.probe.R, expt.probe.dR
+    low, high = problem.bounds()
+    start = problem.getp()
+
+    floors = np.asarray([model_utils.prior_floor(name) for name in surrogate.names])
+    step = np.where(floors > 0, floors, 0.01 * (high - low))
+    walkers = np.clip(
+        start + step * rng.standard_normal((n_walkers, len(start))), low, high
+    )
+    chisq = surrogate.chisq(walkers, q, r, dr)
+    n_points = len(q)
+
+    candidates = [walkers.copy()]
+    candidate_chisq = [chisq.copy()]
+    for _ in range(n_steps):
+        proposal = np.clip(
+            walkers + step * rng.standard_normal(walkers.shape), low, high
+        )
+        new_chisq = surrogate.chisq(proposal, q, r, dr)
+        # Acceptance on the log-likelihood, -chi^2/2 summed over all points
+        accept = np.log(rng.uniform(size=n_walkers)) < 0.5 * n_points * (
+            chisq - new_chisq
+        )
+        walkers[accept] = proposal[accept]
+        chisq[accept] = new_chisq[accept]
+        candidates.append(walkers.copy())
+        candidate_chisq.append(chisq.copy())
+
+    candidates = np.vstack(candidates)
+    candidate_chisq = np.hstack(candidate_chisq)
+    best = candidates[np.argsort(candidate_chisq)[:n_exact]]
+
+    # Validate the best candidates, and the starting point, with the exact model
+    exact = []
+    for point in np.vstack([start, best]):
+        exact.append(problem.nllf(point))
+    chosen = np.vstack([start, best])[int(np.argmin(exact))]
+    problem.setp(start)
+    return dict(zip(surrogate.names, chosen.tolist()))
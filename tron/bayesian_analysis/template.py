@@ -43,8 +43,8 @@ _model_template = """import sys
 import numpy as np
 import os
 
-from refl1d.names import QProbe, Parameter, FitProblem
-from tron.bayesian_analysis import model_utils
+from refl1d.names import Parameter
+from tron.bayesian_analysis import data_preparation, model_utils
 
 
 # Parse input arguments ########################################################
@@ -57,6 +57,12 @@ expt_file = sys.argv[2]
 # Third argument is the error information used for setting the prior
 err_file = sys.argv[3]
 
+# Optional fourth argument is the posterior covariance used for a correlated prior
+cov_file = sys.argv[4] if len(sys.argv) > 4 and sys.argv[4] != "none" else None
+
+# Optional fifth argument holds the parameters frozen by the fitting loop
+frozen_file = sys.argv[5] if len(sys.argv) > 5 else None
+
 # 0.1 was used so far (Jan 2023) with good results
 prior_scale = 1
 
@@ -64,18 +70,13 @@ prior_scale = 1
 q_min = 0.0
 q_max = 0.4
 
-try:
-    Q, R, dR, dQ = np.loadtxt(reduced_file).T
-except:
-    Q, R, dR = np.loadtxt(reduced_file).T
-    dQ = 0.028*Q
+# Relative bin width to rebin the data, or None to use the data as is
+dq_over_q = None
 
-i_min = np.min([i for i in range(len(Q)) if Q[i]>q_min])
-i_max = np.max([i for i in range(len(Q)) if Q[i]<q_max])+1
-
-# SNS data is FWHM
-dQ_std = dQ/2.35
-probe = QProbe(Q[i_min:i_max], dQ_std[i_min:i_max], data=(R[i_min:i_max], dR[i_min:i_max]))
+# Drop the points with dR >= R and convert the resolution to a standard deviation
+Q, R, dR, dQ_std = data_preparation.prepare_data(reduced_file, q_min=q_min, q_max=q_max,
+                                                 dq_over_q=dq_over_q)
+probe = model_utils.make_probe(Q, dQ_std, R=R, dR=dR)
 
 # Experiment ###################################################################
 expt = model_utils.expt_from_json_file(expt_file, probe=probe,
@@ -87,6 +88,8 @@ $ranges
 
 #probe.intensity.range(0.90, 1.1)
 
+model_utils.freeze_parameters(expt, frozen_file)
+
 ################################################################################
-problem = FitProblem(expt)
+problem = model_utils.fit_problem(expt, cov_file, prior_scale=prior_scale)
 """
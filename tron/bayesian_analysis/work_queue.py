@@ -0,0 +1,527 @@
+"""
+Work queue to distribute DREAM fits over several processes or nodes.
+
+The queue is a SQLite database, which can be placed on a filesystem shared
+by the analysis nodes, or on a local disk to run several workers on a
+single machine. Each time slice of a run is a task that depends on the
+previous slice, so that the slices of a run are fit in order while
+separate runs are fit concurrently. Workers lease a task, renew the lease
+with a heartbeat while the fit is running, and report its result. A lease
+that is not renewed is reclaimed, so that a task held by a worker that
+died is picked up by another one.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+
+from .fitting_loop import FittingLoop, split_cores
+
+# Default lease duration, in seconds
+LEASE_TIME = 300
+
+# Number of times a task is attempted before it is marked as failed
+MAX_ATTEMPTS = 3
+
+# Fitting options that are only supported by execute_task with these values
+SUPPORTED_VALUES = dict(
+    engine=["dream"],
+    predictor=[False],
+    change_budget=[False],
+    freeze=[False],
+    coarse_stride=[0, 1],
+    fit_cache_dir=[None],
+    archive_results=[False],
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run TEXT NOT NULL,
+    slice TEXT NOT NULL,
+    depends_on INTEGER REFERENCES tasks(id),
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT
+)
+"""
+
+
+def worker_name():
+    """
+    Return a name identifying the current process across nodes.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    SQLite-backed queue of fit tasks.
+    """
+
+    def __init__(self, db_path, lease_time=LEASE_TIME, max_attempts=MAX_ATTEMPTS):
+        """
+        Open the queue, creating the database if needed.
+
+        Parameters
+        ----------
+        db_path : str
+            File path of the SQLite database
+        lease_time : float
+            Time, in seconds, after which a lease that was not renewed is reclaimed
+        max_attempts : int
+            Number of times a task is attempted before it is marked as failed
+        """
+        self.db_path = db_path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        with self._connect() as db:
+            db.execute(_SCHEMA)
+
+    def _connect(self):
+        # Autocommit mode: transactions are opened explicitly where needed
+        return sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+
+    def submit(self, run, slice_name, payload, depends_on=None):
+        """
+        Add a task to the queue.
+
+        Parameters
+        ----------
+        run : str
+            Name of the run the task belongs to
+        slice_name : str
+            Name of the time slice
+        payload : dict
+            Inputs of the task, as a json-serializable dict
+        depends_on : int
+            Id of a task that has to be completed first
+
+        Returns
+        -------
+            id of the new task
+        """
+        with self._connect() as db:
+            cursor = db.execute(
+                "INSERT INTO tasks (run, slice, depends_on, payload) VALUES (?, ?, ?, ?)",
+                (run, slice_name, depends_on, json.dumps(payload)),
+            )
+            return cursor.lastrowid
+
+    def lease(self, worker):
+        """
+        Lease the next task whose dependency is completed.
+
+        Expired leases are reclaimed first.
+
+        Parameters
+        ----------
+        worker : str
+            Name of the worker
+
+        Returns
+        -------
+            dict describing the task, with the result of its dependency,
+            or None if no task is ready
+        """
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute(
+                "UPDATE tasks SET state='failed', worker=NULL, error='lease expired' "
+                "WHERE state='leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            db.execute(
+                "UPDATE tasks SET state='pending', worker=NULL "
+                "WHERE state='leased' AND lease_expires < ?",
+                (now,),
+            )
+            row = db.execute(
+                "SELECT t.id, t.run, t.slice, t.payload, d.result FROM tasks t "
+                "LEFT JOIN tasks d ON t.depends_on = d.id "
+                "WHERE t.state='pending' AND (t.depends_on IS NULL OR d.state='done') "
+                "ORDER BY t.id LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                db.execute(
+                    "UPDATE tasks SET state='leased', worker=?, lease_expires=?, "
+                    "attempts=attempts+1 WHERE id=?",
+                    (worker, now + self.lease_time, row[0]),
+                )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+        if row is None:
+            return None
+        return dict(
+            id=row[0],
+            run=row[1],
+            slice=row[2],
+            payload=json.loads(row[3]),
+            dependency=json.loads(row[4]) if row[4] is not None else None,
+        )
+
+    def heartbeat(self, task_id, worker):
+        """
+        Renew the lease on a task.
+
+        Returns
+        -------
+            True if the worker still holds the lease
+        """
+        with self._connect() as db:
+            cursor = db.execute(
+                "UPDATE tasks SET lease_expires=? "
+                "WHERE id=? AND worker=? AND state='leased'",
+                (time.time() + self.lease_time, task_id, worker),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, task_id, worker, result):
+        """
+        Report the result of a task.
+
+        Parameters
+        ----------
+        task_id : int
+            Id of the task
+        worker : str
+            Name of the worker holding the lease
+        result : dict
+            Outputs of the task, as a json-serializable dict
+        """
+        with self._connect() as db:
+            db.execute(
+                "UPDATE tasks SET state='done', result=?, lease_expires=NULL "
+                "WHERE id=? AND worker=?",
+                (json.dumps(result), task_id, worker),
+            )
+
+    def fail(self, task_id, worker, error):
+        """
+        Report a failed task. It is put back in the queue until it has
+        been attempted max_attempts times.
+        """
+        with self._connect() as db:
+            db.execute(
+                "UPDATE tasks SET state=CASE WHEN attempts >= ? THEN 'failed' "
+                "ELSE 'pending' END, worker=NULL, lease_expires=NULL, error=? "
+                "WHERE id=? AND worker=?",
+                (self.max_attempts, error, task_id, worker),
+            )
+
+    def status(self, run=None):
+        """
+        Return the number of tasks in each state.
+
+        Parameters
+        ----------
+        run : str
+            If given, only count the tasks of this run
+        """
+        query = "SELECT state, COUNT(*) FROM tasks"
+        args = ()
+        if run is not None:
+            query += " WHERE run=?"
+            args = (run,)
+        with self._connect() as db:
+            return dict(db.execute(query + " GROUP BY state", args).fetchall())
+
+    def tasks(self, run=None):
+        """
+        Return the id, slice, state, result and error of each task.
+        """
+        query = "SELECT id, run, slice, state, result, error FROM tasks"
+        args = ()
+        if run is not None:
+            query += " WHERE run=?"
+            args = (run,)
+        with self._connect() as db:
+            rows = db.execute(query + " ORDER BY id", args).fetchall()
+        return [
+            dict(
+                id=row[0],
+                run=row[1],
+                slice=row[2],
+                state=row[3],
+                result=json.loads(row[4]) if row[4] is not None else None,
+                error=row[5],
+            )
+            for row in rows
+        ]
+
+    def is_idle(self):
+        """
+        Return True if no task is pending or leased, or if the pending
+        tasks are blocked by a failed dependency.
+        """
+        with self._connect() as db:
+            (n_active,) = db.execute(
+                "SELECT COUNT(*) FROM tasks t LEFT JOIN tasks d ON t.depends_on = d.id "
+                "WHERE t.state='leased' OR (t.state='pending' "
+                "AND (t.depends_on IS NULL OR d.state IN ('pending', 'leased', 'done')))"
+            ).fetchone()
+        return n_active == 0
+
+
+def submit_fit(queue, loop, dyn_file_list, fit_forward=True):
+    """
+    Submit the time slices of a run as a chain of dependent DREAM fits.
+
+    The results directory is prepared as in FittingLoop.fit, and the
+    settings of the loop are saved there for the workers to use. A
+    ValueError is raised if the loop uses fitting options, listed in
+    SUPPORTED_VALUES, that the workers do not honour.
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        Queue to submit to
+    loop : FittingLoop
+        Fitting loop holding the model, data and settings of the run
+    dyn_file_list : list
+        List of time-resolved data sets, ordered in increasing times
+    fit_forward : bool
+        Flag indicating whether to fit forward in time
+
+    Returns
+    -------
+        list of task ids
+    """
+    unsupported = {
+        name: getattr(loop, name)
+        for name, values in SUPPORTED_VALUES.items()
+        if getattr(loop, name) not in values
+    }
+    if unsupported:
+        raise ValueError(
+            f"Fitting options not supported by the work queue: {unsupported}"
+        )
+
+    loop.fit_forward = fit_forward
+    loop.dyn_file_list = dyn_file_list
+    if os.path.isdir(loop.results_dir):
+        shutil.rmtree(loop.results_dir)
+    os.mkdir(loop.results_dir)
+    settings_file = os.path.join(loop.results_dir, "fit_parameters.json")
+    loop.save(settings_file)
+
+    if fit_forward:
+        starting_expt, starting_err = loop.initial_expt_file, loop.initial_err_file
+    else:
+        starting_expt, starting_err = loop.final_expt_file, loop.final_err_file
+    ordered_files = dyn_file_list if fit_forward else list(reversed(dyn_file_list))
+
+    task_ids = []
+    depends_on = None
+    for _file in ordered_files:
+        base_name, _ = os.path.splitext(_file)
+        payload = dict(
+            settings=settings_file,
+            data_file=os.path.join(loop.dyn_data_dir, _file),
+            starting_expt=starting_expt,
+            starting_err=starting_err,
+        )
+        depends_on = queue.submit(loop.results_dir, base_name, payload, depends_on)
+        task_ids.append(depends_on)
+    return task_ids
+
+
+def execute_task(task, cores=None, cancel_event=None):
+    """
+    Run the DREAM fit of a time slice.
+
+    The starting model and uncertainties, and the covariance if a correlated
+    prior is used, are taken from the result of the previous slice, as in
+    FittingLoop.fit_sequence.
+
+    Parameters
+    ----------
+    task : dict
+        Task, as returned by WorkQueue.lease
+    cores : int
+        Number of cores for the fit
+    cancel_event : threading.Event
+        Event that kills the fit when it is set
+
+    Returns
+    -------
+        dict with the -expt.json, -err.json and covariance files of the fit
+    """
+    payload = task["payload"]
+    loop = FittingLoop(None, None)
+    loop.load(payload["settings"])
+    if cores is not None:
+        loop.cores = cores
+    loop.cancel_event = cancel_event
+
+    starting_expt = payload["starting_expt"]
+    starting_err = payload["starting_err"]
+    starting_cov = None
+    if task["dependency"] is not None:
+        starting_expt = task["dependency"]["expt"]
+        starting_err = task["dependency"]["err"]
+        starting_cov = task["dependency"]["cov"]
+
+    base_name = task["slice"]
+    data_file = payload["data_file"]
+    if loop.surrogate:
+        loop.run_dream(
+            base_name,
+            data_file,
+            loop.surrogate_start(base_name, data_file, starting_expt, starting_err),
+            starting_err,
+            starting_cov,
+            burn=loop.surrogate_burn,
+        )
+    else:
+        loop.run_dream(base_name, data_file, starting_expt, starting_err, starting_cov)
+
+    model_path = os.path.join(loop.results_dir, base_name, loop.model_name)
+    if not os.path.isfile(f"{model_path}-err.json"):
+        raise RuntimeError(
+            f"DREAM fit of {base_name} failed, see {loop.log_file(base_name)}:\n"
+            f"{loop.last_output.stderr}"
+        )
+
+    return dict(
+        expt=f"{model_path}-1-expt.json",
+        err=f"{model_path}-err.json",
+        cov=loop.save_covariance(base_name) if loop.covariance_prior else None,
+    )
+
+
+def worker_loop(db_path, cores=None, poll=10, exit_when_idle=False, worker=None):
+    """
+    Lease and execute tasks until the queue is idle or forever.
+
+    Parameters
+    ----------
+    db_path : str
+        File path of the SQLite database
+    cores : int
+        Number of cores for each fit
+    poll : float
+        Time, in seconds, to wait when no task is ready
+    exit_when_idle : bool
+        If True, return once no task is pending or leased
+    worker : str
+        Name of the worker (default: host name and process id)
+    """
+    queue = WorkQueue(db_path)
+    worker = worker or worker_name()
+    while True:
+        task = queue.lease(worker)
+        if task is None:
+            if exit_when_idle and queue.is_idle():
+                return
+            time.sleep(poll)
+            continue
+
+        print(f"{worker}: fitting {task['slice']} of {task['run']}")
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def beat():
+            while not stop.wait(queue.lease_time / 3):
+                if not queue.heartbeat(task["id"], worker):
+                    # The task was reclaimed by another worker: stop the fit
+                    lost.set()
+                    return
+
+        heartbeat = threading.Thread(target=beat, daemon=True)
+        heartbeat.start()
+        try:
+            result = execute_task(task, cores=cores, cancel_event=lost)
+        except Exception as exc:
+            if not lost.is_set():
+                queue.fail(task["id"], worker, str(exc))
+        else:
+            if not lost.is_set():
+                queue.complete(task["id"], worker, result)
+        finally:
+            stop.set()
+            heartbeat.join()
+        if lost.is_set():
+            print(f"{worker}: lost the lease on {task['slice']} of {task['run']}")
+
+
+def run_workers(db_path, n_workers, cores=None, poll=1, exit_when_idle=True):
+    """
+    Start several workers on this machine and wait for them to finish.
+
+    Parameters
+    ----------
+    db_path : str
+        File path of the SQLite database
+    n_workers : int
+        Number of worker processes
+    cores : int
+        Total number of cores, split between the workers
+    poll : float
+        Time, in seconds, to wait when no task is ready
+    exit_when_idle : bool
+        If True, workers return once no task is pending or leased
+    """
+    _, worker_cores = split_cores(cores, n_workers)
+    workers = [
+        multiprocessing.Process(
+            target=worker_loop,
+            args=(db_path,),
+            kwargs=dict(cores=worker_cores, poll=poll, exit_when_idle=exit_when_idle),
+        )
+        for _ in range(n_workers)
+    ]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Work queue for DREAM fits.")
+    parser.add_argument("db_path", type=str, help="SQLite database of the queue.")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of local worker processes."
+    )
+    parser.add_argument(
+        "--cores", type=int, default=None, help="Number of cores for all workers."
+    )
+    parser.add_argument(
+        "--exit-when-idle",
+        action="store_true",
+        help="Stop once no task is pending or leased.",
+    )
+    parser.add_argument(
+        "--status", action="store_true", help="Print the state of the queue and exit."
+    )
+    args = parser.parse_args()
+
+    if args.status:
+        print(WorkQueue(args.db_path).status())
+        sys.exit(0)
+
+    run_workers(
+        args.db_path,
+        args.workers,
+        cores=args.cores,
+        poll=10,
+        exit_when_idle=args.exit_when_idle,
+    )
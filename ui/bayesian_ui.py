@@ -339,7 +339,7 @@ class BayesianModel(QWidget):
                                self.final_state_file.path_label.text(),
                                self.output_dir.path_label.text(),
                                first_item=int(self.first_time_ledit.text()),
-                               last_item=int(self.last_time_ledit.text()))
+                               last_item=int(self.last_time_ledit.text()), show=True)
         except Exception as exc:
             print(exc)
             self.show_dialog(str(exc))
@@ -362,7 +362,7 @@ class BayesianModel(QWidget):
                             self.final_state_file.path_label.text(),
                             self.output_dir.path_label.text(),
                             first_item=int(self.first_time_ledit.text()),
-                            last_item=int(self.last_time_ledit.text()))
+                            last_item=int(self.last_time_ledit.text()), show=True)
         except Exception as exc:
             print(exc)
             self.show_dialog(str(exc))